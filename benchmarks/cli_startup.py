@@ -0,0 +1,68 @@
+# Start up benchmark for the nodewatts CLI. Measures the import time of nodewatts.__main__
+# with python -X importtime and the wall time of "nodewatts --help", and fails when either
+# exceeds its budget or when a heavy dependency is imported at start up.
+#
+#   python benchmarks/cli_startup.py [--runs 5] [--import-budget 150] [--help-budget 400]
+import argparse
+import json
+import os
+import statistics as stat
+import subprocess
+import sys
+import time
+
+# Only needed by later stages, must not be imported by the CLI module itself
+HEAVY_MODULES = ["scipy", "numpy", "networkx", "pandas", "flask", "pymongo", "psutil",
+                 "jsonschema", "thespian", "powerapi", "smartwatts", "pgrep"]
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(args: list) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable] + args, capture_output=True, text=True, cwd=PACKAGE_ROOT)
+
+
+# Cumulative import time of nodewatts.__main__ in milliseconds
+def import_time() -> float:
+    proc = run_python(["-X", "importtime", "-c", "import nodewatts.__main__"])
+    for line in proc.stderr.splitlines():
+        fields = [f.strip() for f in line.split("|")]
+        if len(fields) == 3 and fields[2] == "nodewatts.__main__":
+            return int(fields[1]) / 1000
+    raise RuntimeError("nodewatts.__main__ missing from importtime output:\n" + proc.stderr)
+
+
+def help_time() -> float:
+    start = time.perf_counter()
+    proc = run_python(["-m", "nodewatts", "--help"])
+    elapsed = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError("nodewatts --help failed:\n" + proc.stderr)
+    return elapsed
+
+
+def heavy_imports() -> list:
+    proc = run_python(["-c", "import json, sys, nodewatts.__main__; print(json.dumps(sorted(sys.modules)))"])
+    loaded = json.loads(proc.stdout)
+    return sorted({m.split(".")[0] for m in loaded} & set(HEAVY_MODULES))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="nodewatts CLI start up benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget", type=float, default=150, help="milliseconds")
+    parser.add_argument("--help-budget", type=float, default=400, help="milliseconds")
+    args = parser.parse_args()
+
+    imports = stat.median(import_time() for _ in range(args.runs))
+    helps = stat.median(help_time() for _ in range(args.runs))
+    heavy = heavy_imports()
+    print("import nodewatts.__main__: {:.1f} ms (budget {:.0f} ms)".format(imports, args.import_budget))
+    print("nodewatts --help:          {:.1f} ms (budget {:.0f} ms)".format(helps, args.help_budget))
+    print("heavy modules at start up: " + (", ".join(heavy) if heavy else "none"))
+    ok = imports <= args.import_budget and helps <= args.help_budget and not heavy
+    print("PASS" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
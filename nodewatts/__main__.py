@@ -1,34 +1,39 @@
-from nodewatts.subprocess_manager import NWSubprocessError, SubprocessManager
 import nodewatts.log as log
-from nodewatts.db import DatabaseError
-from nodewatts.nwengine.__main__ import run_engine, EngineError
-from nodewatts.viz_server import server as viz
-from nodewatts.cgroup import CgroupInterface
-from nodewatts.db import Database
-from nodewatts.sensor_handler import SensorHandler
-from nodewatts.profiler_handler import ProfilerHandler
 from nodewatts.config import NWConfig, InvalidConfig
 from nodewatts.error import NodewattsError
 import os
 import sys
 import argparse
 import json
-import errno
 import shutil
 import logging
 import traceback
 import signal
-import pgrep
+import shlex
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from nodewatts.db import Database
+    from nodewatts.profiler_handler import ProfilerHandler
+    from nodewatts.sensor_handler import SensorHandler
 logger = None
 
 
+# Only what every invocation needs is imported at module level. The profiling stages,
+# the engine (scipy, networkx) and the visualization server (flask) import their
+# dependencies when they run, which keeps CLI start up fast. See benchmarks/cli_startup.py.
+
 # Simple solution for gracefully cleaning up any changes made to system directories
 # in the case of a SIGINT or SIGTERM
 # Note that when smartwatts is run, its own term_handler will take over
 # handling of these signals. However, a called to the below term_handler
 # will still be made to cleanup the tmp directory
 global_state = []
-tmpPath = os.path.join(NWConfig.dirs.site_data_dir, 'tmp')
+# Session directory, set once the config is loaded
+tmpPath = None
+# Journal of the session's completed stages, see nodewatts/journal.py
+journal = None
+# Database of the session's raw data, dropped on cleanup unless the session is kept
+session_db = None
 
 
 def term_handler(signum, frame):
@@ -44,10 +49,33 @@ def global_cleanup():
     if len(global_state) > 0:
         for instance in global_state:
             instance.cleanup()
+    NWConfig.release_ports()
+    if tmpPath is None:
+        return
+    kill_session_sensors(tmpPath)
+    # Once the workload has been captured the session is kept so it can be resumed
+    if journal is not None and journal.done("collect") and journal.next_stage() is not None:
+        nw_logger.info("Captured data of session " + journal.get("session")["session_id"]
+                       + " was kept. Run again with --resume to continue from the "
+                       + journal.next_stage() + " stage.")
+        return
+    if session_db is not None:
+        from nodewatts.db import DatabaseError
+        try:
+            session_db.drop_raw_data()
+        except DatabaseError as e:
+            nw_logger.warning("Failed to drop internal raw data from db.")
+            nw_logger.warning(str(e))
     if os.path.exists(tmpPath):
         shutil.rmtree(tmpPath)
-    # Unexpected crashes sometimes leave sensor running, this will catch those cases
-    pids = pgrep.pgrep("nodewatts-hwpc-sensor")
+
+
+# Unexpected crashes sometimes leave sensor running, this will catch those cases.
+# Only this session's sensors are matched, their config lives in the session directory.
+def kill_session_sensors(session_dir: str) -> None:
+    from nodewatts.subprocess_manager import SubprocessManager
+    import pgrep
+    pids = pgrep.pgrep("-f " + shlex.quote("nodewatts-hwpc-sensor --config-file " + session_dir))
     for pid in pids:
         SubprocessManager.kill_process_tree(pid)
 
@@ -63,28 +91,36 @@ def create_cli_parser() -> argparse.ArgumentParser:
                         help="Run with debug flag")
     parser.add_argument('--visualizer', '-V', action='store_true',
                         help="Start up visulization server only")
-    parser.add_argument('--config_file', type=str,
-                        required=True, help="Path to configuration file")
+    parser.add_argument('--serve', action='store_true',
+                        help="With --visualizer, serve the visualizer to several users with a multi-worker server")
+    parser.add_argument('--resume', nargs='?', const="latest", default=None, metavar="SESSION_ID",
+                        help="Resume an interrupted session of this config, by default the latest one")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--config_file', type=str,
+                        help="Path to configuration file")
+    source.add_argument('--batch', type=str,
+                        help="Path to a batch file listing several configuration files to profile")
     return parser
 
 
 def validate_module_configs(config: NWConfig) -> None:
-    if not os.path.exists(config.sensor_config_path):
+    if not os.path.exists(config.sensor_base_config_path):
         logger.error("Sensor config file missing at path: " +
-                     config.sensor_config_path)
+                     config.sensor_base_config_path)
         sys.exit(1)
-    if not os.path.exists(config.sw_config_path):
+    if not os.path.exists(config.sw_base_config_path):
+        from nodewatts.subprocess_manager import NWSubprocessError, SubprocessManager
         logger.info("No smartwatts configuration detected. Configuring...")
         proc = SubprocessManager(config)
         try:
             stdout, stderr = proc.nodewatts_process_blocking("sh resources/bin/smartwatts-autoconfig.sh "
-                                                             + os.path.join(NWConfig.dirs.site_config_dir, "smartwatts_config.json"))
+                                                             + config.sw_base_config_path)
         except NWSubprocessError as e:
             logger.error(
                 "Failed to run smartwatts config script. Error:" + str(e))
             sys.exit(1)
 
-    with open(config.sensor_config_path, "r") as f:
+    with open(config.sensor_base_config_path, "r") as f:
         try:
             sensor_raw = json.load(f)
         except json.decoder.JSONDecodeError:
@@ -92,7 +128,7 @@ def validate_module_configs(config: NWConfig) -> None:
             sys.exit(1)
     NWConfig.validate_sensor_config(sensor_raw)
 
-    with open(config.sw_config_path, "r") as f:
+    with open(config.sw_base_config_path, "r") as f:
         try:
             sw_raw = json.load(f)
         except json.decoder.JSONDecodeError as e:
@@ -101,23 +137,63 @@ def validate_module_configs(config: NWConfig) -> None:
     NWConfig.validate_smartwatts_config(sw_raw)
 
 
-def collect_raw_data(config: NWConfig):
-    proc_manager = SubprocessManager(config)
+def calibrate_sampling(config: NWConfig, profiler: "ProfilerHandler", sensor: "SensorHandler") -> None:
+    from nodewatts.calibration import SamplingCalibrator
+    from nodewatts.db import Database
+    SamplingCalibrator(config, profiler, sensor,
+                       Database(config.engine_conf_args["internal_db_uri"], config.raw_store_path,
+                                config.session_id)).run()
+
+
+# The power model runs in stream mode alongside the sensor, so estimates are ready
+# shortly after the test suite ends.
+def collect_raw_data(config: NWConfig, db: "Database"):
+    from nodewatts.smartwatts import SmartwattsHandler
+    from nodewatts.subprocess_manager import AsyncSubprocessManager
+    from nodewatts.profiler_handler import ProfilerHandler
+    from nodewatts.sensor_handler import SensorHandler
+    from nodewatts.cgroup import CgroupInterface
+    from nodewatts.db import DatabaseError
+    proc_manager = AsyncSubprocessManager(config)
     try:
         profiler = ProfilerHandler(config, proc_manager)
-        cgroup = CgroupInterface(proc_manager)
+        cgroup = CgroupInterface(proc_manager, config.cgroup_name)
         sensor = SensorHandler(config, proc_manager)
-        global_state.extend([profiler, cgroup, sensor])
+        smartwatts = SmartwattsHandler(config, db)
+        global_state.extend([profiler, cgroup, sensor, smartwatts])
         profiler.setup_env()
         cgroup.create_cgroup()
         server_pid = profiler.start_server()
         cgroup.add_PID(server_pid)
+        profiler.follow_workers(cgroup.add_process_cgroup)
+        if config.sampling_autotune:
+            calibrate_sampling(config, profiler, sensor)
+        smartwatts.start_stream()
         sensor.start_sensor()
         profiler.run_test_suite()
+        request_records = profiler.load_request_records()
         profiler.cleanup()
         global_state.remove(profiler)
         sensor.cleanup()
         global_state.remove(sensor)
+        collected = profiler.fail_code is None and sensor.fail_code is None
+        if collected:
+            config.engine_conf_args["profile_title"] = profiler.profile_title
+            config.engine_conf_args["sensor_start"] = sensor.start_time
+            config.engine_conf_args["sensor_end"] = sensor.end_time
+            if request_records:
+                logger.debug("Saving " + str(len(request_records)) + " workload request records.")
+                try:
+                    db.save_request_records(profiler.profile_title, request_records)
+                except DatabaseError as e:
+                    logger.error("Failed to save workload request records. " + str(e))
+                    raise
+            journal.record("collect", profile_title=profiler.profile_title,
+                           sensor_start=sensor.start_time, sensor_end=sensor.end_time)
+        smartwatts.finish_stream()
+        global_state.remove(smartwatts)
+        if collected:
+            journal.record("formula")
         cgroup.cleanup()
         global_state.remove(cgroup)
     except NodewattsError as e:
@@ -140,58 +216,186 @@ def collect_raw_data(config: NWConfig):
                 "Sensor exited unexpectedly - unable to contine. Run again in verbose mode to inspect error.")
             sys.exit(1)
 
-        config.engine_conf_args["profile_title"] = profiler.profile_title
-        config.engine_conf_args["sensor_start"] = sensor.start_time
-        config.engine_conf_args["sensor_end"] = sensor.end_time
+
+# Resumes a session from its journal. The formula is finished if sensor reports are still
+# waiting to be processed, then the report is generated.
+def resume(config: NWConfig):
+    global tmpPath, journal, session_db
+    from nodewatts.journal import SessionJournal
+    from nodewatts.db import Database, DatabaseError
+    from nodewatts.smartwatts import SmartwattsHandler
+    journal = SessionJournal(config.session_dir)
+    if not journal.done("collect"):
+        logger.error("Session " + config.session_id + " did not finish collecting data and cannot be "
+                     + "resumed. Run again without --resume.")
+        sys.exit(1)
+    if not journal.lock():
+        logger.error("Session " + config.session_id + " is running in another NodeWatts process.")
+        sys.exit(1)
+    tmpPath = config.session_dir
+    config.tmp_path = tmpPath
+    kill_session_sensors(tmpPath)
+    with open(config.sw_config_path) as f:
+        config.smartwatts_config = json.load(f)
+    collected = journal.get("collect")
+    for key in ("profile_title", "sensor_start", "sensor_end"):
+        config.engine_conf_args[key] = collected[key]
+    logger.info("Resuming session " + config.session_id + " from the " + str(journal.next_stage()) + " stage.")
+    db = Database(config.engine_conf_args["internal_db_uri"], config.raw_store_path, config.session_id)
+    session_db = db
+
+    if not journal.done("formula"):
+        smartwatts = SmartwattsHandler(config, db)
+        global_state.append(smartwatts)
+        try:
+            if db.pending_sensor_reports() > 0:
+                smartwatts.start_stream()
+                smartwatts.finish_stream()
+            latest = db.latest_power_timestamp()
+            if latest is None or latest < collected["sensor_end"]:
+                # Reports streamed over a socket are lost with the formula, nothing to replay
+                logger.warning("Power estimates stop before the end of the capture. The report "
+                               + "will only cover the estimates produced before the interruption.")
+        except (NodewattsError, DatabaseError) as e:
+            global_cleanup()
+            sys.exit(1)
+        global_state.remove(smartwatts)
+        journal.record("formula")
+
+    if not journal.done("engine"):
+        generate_report(config)
+    finish_session(config, db)
+
+
+# Continuous mode: server, sensor and a streaming power model stay up while the cpu
+# profile is rotated every window. Each window is turned into its own report while the
+# next one is captured.
+def run_continuous(config: NWConfig, db: "Database"):
+    from nodewatts.smartwatts import SmartwattsHandler
+    from nodewatts.continuous import WindowProcessor
+    from nodewatts.subprocess_manager import AsyncSubprocessManager
+    from nodewatts.profiler_handler import ProfilerHandler
+    from nodewatts.sensor_handler import SensorHandler
+    from nodewatts.cgroup import CgroupInterface
+    proc_manager = AsyncSubprocessManager(config)
+    try:
+        profiler = ProfilerHandler(config, proc_manager)
+        cgroup = CgroupInterface(proc_manager, config.cgroup_name)
+        sensor = SensorHandler(config, proc_manager)
+        smartwatts = SmartwattsHandler(config, db)
+        global_state.extend([profiler, cgroup, sensor, smartwatts])
+        profiler.setup_env()
+        cgroup.create_cgroup()
+        server_pid = profiler.start_server()
+        cgroup.add_PID(server_pid)
+        profiler.follow_workers(cgroup.add_process_cgroup)
+        if config.sampling_autotune:
+            calibrate_sampling(config, profiler, sensor)
+        smartwatts.start_stream()
+        sensor.start_sensor()
+        processor = WindowProcessor(config, db)
+        profiler.run_windows(config.continuous["window_seconds"], config.continuous["duration"],
+                             processor.process)
+        profiler.cleanup()
+        global_state.remove(profiler)
+        sensor.cleanup()
+        global_state.remove(sensor)
+        smartwatts.cleanup()
+        global_state.remove(smartwatts)
+        cgroup.cleanup()
+        global_state.remove(cgroup)
+    except NodewattsError as e:
+        global_cleanup()
+        sys.exit(1)
+    except Exception as e:
+        logger.critical("FATAL - Unexpected error. Unable to guarentee resource cleanup. "
+                        + "Please ensure your entry file contains no NodeWatts code and "
+                        + "the system perf_event cgroup is removed before running again. ")
+        logger.critical(traceback.format_exc())
+        global_cleanup()
+        sys.exit(1)
+    else:
+        if profiler.fail_code is not None:
+            logger.error(
+                "Web server exited unexpectedly - unable to contine. Run again in verbose mode to inspect error.")
+            sys.exit(1)
+        if sensor.fail_code is not None:
+            logger.error(
+                "Sensor exited unexpectedly - unable to contine. Run again in verbose mode to inspect error.")
+            sys.exit(1)
+        logger.info("Processed " + str(processor.processed) + " windows. Session total: "
+                    + "{:.2f}".format(processor.session_joules) + " J.")
 
 
-def run(config: NWConfig):
-    validate_module_configs(config)
+# Creates a fresh session directory and writes the session's module configs into it
+def setup_session(config: NWConfig) -> None:
+    global tmpPath
+    logger.debug("Setting up session directory for session " + config.session_id)
+    try:
+        if os.path.exists(config.session_dir):
+            shutil.rmtree(config.session_dir)
+        os.makedirs(config.session_dir)
+        os.chmod(config.session_dir, 0o777)
+    except OSError as e:
+        logger.error("Error creating session working directory: \n" + str(e))
+        sys.exit(1)
+    tmpPath = config.session_dir
+    config.tmp_path = tmpPath
     config.inject_config_vars()
     with open(config.sw_config_path) as f:
         config.smartwatts_config = json.load(f)
+
+
+def run(config: NWConfig):
+    global journal, session_db
+    from nodewatts.db import Database, DatabaseError
+    from nodewatts.journal import SessionJournal
+    validate_module_configs(config)
+    if SessionJournal.in_use(config.session_dir):
+        logger.error("Session " + config.session_id + " is running in another NodeWatts process.")
+        sys.exit(1)
+    setup_session(config)
+    journal = SessionJournal(config.session_dir)
+    journal.lock()
+    journal.record("session", session_id=config.session_id, config_file=os.path.abspath(config.config_file))
     logger.info("Configuration Successful - Starting NodeWatts")
-    db = Database(config.engine_conf_args["internal_db_uri"])
+    db = Database(config.engine_conf_args["internal_db_uri"], config.raw_store_path, config.session_id)
+    session_db = db
     try:
         logging.debug("Cleaning up existing raw data.")
         db.drop_raw_data()
+        db.drop_orphaned_raw_data(os.path.dirname(config.session_dir))
+        db.ensure_indexes()
     except DatabaseError as e:
         logger.debug("Failed to drop existing raw data from previous sessions")
         logger.error(str(e))
         sys.exit(1)
 
-    logger.debug("Setting up temporary directory")
-    try:
-        os.mkdir(tmpPath)
-        os.chmod(tmpPath, 0o777)
-    except OSError as e:
-        if e.errno == errno.EEXIST:
-            shutil.rmtree(tmpPath)
-            os.mkdir(tmpPath)
-            os.chmod(tmpPath, 0o777)
-        else:
-            logger.error("Error creating temp working directory: \n" + str(e))
-            sys.exit(1)
-    config.tmp_path = tmpPath
-
-    collect_raw_data(config)
-
     if config.sw_verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    from nodewatts.smartwatts import SmartwattsError, SmartwattsHandler
-    try:
-        smartwatts = SmartwattsHandler(config, db)
-        smartwatts.run_formula()
-    except SmartwattsError:
-        sys.exit(1)
+    if config.continuous is not None:
+        run_continuous(config, db)
+    else:
+        collect_raw_data(config, db)
+        generate_report(config)
+    finish_session(config, db)
+
 
+def generate_report(config: NWConfig) -> None:
+    from nodewatts.nwengine.__main__ import run_engine, EngineError
     try:
         logger.info("Generating nodewatts profile.")
         run_engine(config.engine_conf_args)
     except EngineError:
+        logger.error("Report generation failed. The session's data was kept, run again with "
+                     + "--resume " + config.session_id + " to retry.")
         sys.exit(1)
+    journal.record("engine", report_name=config.engine_conf_args["report_name"])
 
+
+def finish_session(config: NWConfig, db: "Database") -> None:
+    from nodewatts.db import DatabaseError
     try:
         logger.debug("Cleaning up raw data")
         db.drop_raw_data()
@@ -206,17 +410,196 @@ def run(config: NWConfig):
                        config.engine_conf_args["internal_db_uri"])
 
 
-def run_viz_server(port: int, mongo_uri="mongodb://localhost:27017") -> None:
+# Batch mode: entries are profiled one after the other under a single session. The sensor,
+# the streaming power model, the database connection and the agent's dependencies are set
+# up once and shared. Each entry gets its own cgroup, so its power estimates are told apart
+# by target. Reports are built in a pool of engine processes once every entry is collected.
+def run_batch(main_conf: NWConfig, batch_path: str):
+    global session_db
+    from concurrent.futures import ProcessPoolExecutor
+    from nodewatts.batch import BatchError, failure_reason, load_batch, run_engine_job, report_summary
+    from nodewatts.smartwatts import SmartwattsHandler
+    from nodewatts.subprocess_manager import AsyncSubprocessManager
+    from nodewatts.profiler_handler import ProfilerHandler
+    from nodewatts.sensor_handler import SensorHandler, SensorException
+    from nodewatts.cgroup import CgroupInterface
+    from nodewatts.db import Database, DatabaseError
+    from nodewatts.mongo import clients
+    import multiprocessing
+    import time
+    import uuid
+    try:
+        settings, entries = load_batch(batch_path)
+    except BatchError as e:
+        logger.error("Batch Error: " + str(e))
+        sys.exit(1)
+    session_id = uuid.uuid4().hex[:8]
+    for i, entry in enumerate(entries):
+        conf = NWConfig()
+        conf.verbose = main_conf.verbose
+        conf.visualizer = False
+        try:
+            NWConfig.validate(entry.raw)
+            entry.raw["sessionId"] = session_id
+            entry.raw["reportName"] = settings["name"] + "-" + entry.label
+            conf.populate(entry.raw)
+            if conf.continuous is not None or conf.sampling_autotune:
+                raise InvalidConfig("continuous mode and sampling autoTune are not supported in batch mode")
+        except InvalidConfig as e:
+            logger.error("Configuration Error in " + entry.label + ": " + str(e))
+            sys.exit(1)
+        conf.cgroup_name = "nodewatts-" + session_id + "-" + str(i)
+        conf.engine_conf_args["cgroup_name"] = conf.cgroup_name
+        entry.config = conf
+    # The sensor and the power model are shared, so entries must agree on their settings
+    first = entries[0].config
+    for entry in entries[1:]:
+        if (entry.config.cpu_tdp, entry.config.sensor_frequency, entry.config.raw_store_path) != \
+                (first.cpu_tdp, first.sensor_frequency, first.raw_store_path):
+            logger.error("Configuration Error in " + entry.label + ": cpu-tdp, sampling.sensorFrequency "
+                         + "and database.rawStore must be the same for every batch entry.")
+            sys.exit(1)
+
+    clients.configure(**first.db_options)
+    validate_module_configs(first)
+    setup_session(first)
+    for entry in entries[1:]:
+        entry.config.tmp_path = first.tmp_path
+        entry.config.smartwatts_config = first.smartwatts_config
+    logger.info("Configuration Successful - Starting NodeWatts batch of " + str(len(entries)) + " entries")
+    db = Database(first.engine_conf_args["internal_db_uri"], first.raw_store_path, session_id)
+    session_db = db
+    try:
+        db.drop_raw_data()
+        db.drop_orphaned_raw_data(os.path.dirname(first.session_dir))
+        db.ensure_indexes()
+    except DatabaseError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if first.sw_verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    def deps_key(conf: NWConfig) -> tuple:
+        return (conf.root_path, conf.use_nvm, getattr(conf, "node_version", None), conf.override_nvm_path)
+
+    proc_manager = AsyncSubprocessManager(first)
+    try:
+        sensor = SensorHandler(first, proc_manager)
+        smartwatts = SmartwattsHandler(first, db)
+        global_state.extend([sensor, smartwatts])
+        smartwatts.start_stream()
+        sensor.start_sensor()
+        for i, entry in enumerate(entries):
+            conf = entry.config
+            logger.info("Profiling batch entry " + str(i + 1) + "/" + str(len(entries)) + ": " + entry.label)
+            entry_manager = AsyncSubprocessManager(conf)
+            profiler = ProfilerHandler(conf, entry_manager)
+            cgroup = CgroupInterface(entry_manager, conf.cgroup_name)
+            profiler.db_service_dir = os.path.join(
+                first.session_dir, "db-service-" + conf.user + "-" + (conf.node_version if conf.use_nvm else "default"))
+            profiler.reuse_deps = i > 0 and deps_key(entries[i - 1].config) == deps_key(conf)
+            global_state.extend([profiler, cgroup])
+            try:
+                profiler.setup_env()
+                cgroup.create_cgroup()
+                start = round(time.monotonic_ns() / 1000)
+                server_pid = profiler.start_server()
+                cgroup.add_PID(server_pid)
+                profiler.follow_workers(cgroup.add_process_cgroup)
+                profiler.run_test_suite()
+                request_records = profiler.load_request_records()
+            except NodewattsError as e:
+                # A failing entry should not cost the rest of the batch
+                entry.error = failure_reason("profiling failed", e)
+                request_records = []
+            profiler.keep_deps = entry.error is None and i + 1 < len(entries) \
+                and deps_key(entries[i + 1].config) == deps_key(conf)
+            profiler.cleanup()
+            global_state.remove(profiler)
+            cgroup.cleanup()
+            global_state.remove(cgroup)
+            if sensor.poll_sensor() is not None:
+                logger.error("Sensor exited unexpectedly - unable to contine.")
+                raise SensorException(None)
+            if entry.error is not None:
+                continue
+            if profiler.fail_code is not None:
+                entry.error = "web server exited unexpectedly"
+                continue
+            conf.engine_conf_args["profile_title"] = profiler.profile_title
+            conf.engine_conf_args["sensor_start"] = start
+            conf.engine_conf_args["sensor_end"] = round(time.monotonic_ns() / 1000)
+            if request_records:
+                db.save_request_records(profiler.profile_title, request_records)
+        sensor.cleanup()
+        global_state.remove(sensor)
+        smartwatts.finish_stream()
+        global_state.remove(smartwatts)
+    except NodewattsError as e:
+        global_cleanup()
+        sys.exit(1)
+    except Exception as e:
+        logger.critical("FATAL - Unexpected error. Unable to guarentee resource cleanup. "
+                        + "Please ensure your entry file contains no NodeWatts code and "
+                        + "the system perf_event cgroup is removed before running again. ")
+        logger.critical(traceback.format_exc())
+        global_cleanup()
+        sys.exit(1)
+    if sensor.fail_code is not None:
+        logger.error("Sensor exited unexpectedly - unable to contine. Run again in verbose mode to inspect error.")
+        sys.exit(1)
+
+    collected = [entry for entry in entries if entry.error is None]
+    logger.info("Generating " + str(len(collected)) + " nodewatts profiles.")
+    # Engine workers are spawned rather than forked, they open their own database connections
+    with ProcessPoolExecutor(max_workers=min(settings["engine_workers"], max(len(collected), 1)),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        jobs = {pool.submit(run_engine_job, entry.config.engine_conf_args): entry for entry in collected}
+        for job, entry in jobs.items():
+            try:
+                entry.summary = job.result()
+            except Exception as e:
+                # Any failure of the engine only costs its own entry, the pool's included
+                logger.debug(traceback.format_exc())
+                entry.error = failure_reason("report generation failed", e)
+    report_summary(entries, settings["summary_file"])
+
+    try:
+        logger.debug("Cleaning up raw data")
+        db.drop_raw_data()
+    except DatabaseError as e:
+        logger.warning("Failed to drop internal raw data from db.")
+        logger.warning(str(e))
+    shutil.rmtree(tmpPath)
+    if any(entry.error is not None for entry in entries):
+        sys.exit(1)
+
+
+def run_viz_server(port: int, mongo_uri="mongodb://localhost:27017", serve_options=None) -> None:
+    from nodewatts.viz_server import server as viz
     logger.info("Starting visulization server")
-    viz.run(port, mongo_uri)
+    if serve_options is None:
+        viz.run(port, mongo_uri)
+        return
+    try:
+        viz.serve(serve_options["host"], port, mongo_uri, serve_options["workers"], serve_options["threads"])
+    except NodewattsError as e:
+        logger.error(str(e))
+        sys.exit(1)
 
 
 def main():
     conf = NWConfig()
     parser = create_cli_parser()
     parser.parse_args(namespace=conf)
+    if conf.serve and not conf.visualizer:
+        parser.error("--serve requires --visualizer")
     global logger
     logger = log.setup_logger(conf.verbose, "Main")
+    if conf.batch is not None:
+        run_batch(conf, conf.batch)
+        logger.info("Batch complete! Exiting NodeWatts...")
+        sys.exit(0)
     if not NWConfig.validate_config_path(conf.config_file):
         logger.error("Config file path is invalid")
         sys.exit(1)
@@ -230,9 +613,30 @@ def main():
     except InvalidConfig as e:
         logger.error("Configuration Error: " + str(e))
         sys.exit(1)
-    conf.populate(raw)
+    if conf.resume is not None:
+        session_id = conf.resume
+        if session_id == "latest":
+            from nodewatts.journal import SessionJournal
+            session_id = SessionJournal.find_resumable(
+                os.path.join(NWConfig.dirs.site_data_dir, "sessions"), conf.config_file)
+            if session_id is None:
+                logger.error("No interrupted session of " + conf.config_file + " to resume.")
+                sys.exit(1)
+        raw["sessionId"] = session_id
+    try:
+        conf.populate(raw)
+    except InvalidConfig as e:
+        logger.error("Configuration Error: " + str(e))
+        sys.exit(1)
+    from nodewatts.mongo import clients
+    clients.configure(**conf.db_options)
     if conf.visualizer:
-        run_viz_server(conf.viz_port, conf.engine_conf_args["internal_db_uri"])
+        run_viz_server(conf.viz_port, conf.engine_conf_args["internal_db_uri"],
+                       conf.viz_server if conf.serve else None)
+    elif conf.resume is not None:
+        resume(conf)
+        logger.info("Profile generated! Exiting NodeWatts...")
+        sys.exit(0)
     else:
         run(conf)
         logger.info("Profile generated! Exiting NodeWatts...")
@@ -0,0 +1,179 @@
+from nodewatts.error import NodewattsError
+from nodewatts.nwengine.__main__ import run_engine
+from nodewatts.nwengine.cpu_profile import function_key
+
+import itertools
+import json
+import logging
+import os
+import re
+logger = logging.getLogger("Main")
+
+
+class BatchError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+class BatchEntry:
+    def __init__(self, label: str, raw: dict):
+        self.label = label
+        self.raw = raw
+        self.config = None
+        self.error = None
+        self.summary = None
+
+
+# Reads a batch file. It lists config files to profile one after the other, a matrix
+# that expands a base config over node versions and environments, or both:
+#   {"name": "nightly", "configs": ["api.json", "worker.json"],
+#    "matrix": {"config": "api.json", "nodeVersions": ["16.15.1", "18.12.0"],
+#               "env": [{"NODE_ENV": "production"}, {"NODE_ENV": "development"}]},
+#    "engineWorkers": 2, "summaryFile": "nightly-summary.json"}
+# Config paths are relative to the batch file.
+def load_batch(path: str) -> (dict, list):
+    try:
+        with open(path) as f:
+            batch = json.load(f)
+    except OSError as e:
+        raise BatchError("Failed to read batch file: " + str(e)) from None
+    except json.decoder.JSONDecodeError:
+        raise BatchError("Batch file must be in valid json format") from None
+    if not isinstance(batch, dict):
+        raise BatchError("Batch file: expected object")
+    base_dir = os.path.dirname(os.path.abspath(path))
+    settings = {
+        "name": batch.get("name", os.path.splitext(os.path.basename(path))[0]),
+        "engine_workers": batch.get("engineWorkers", min(4, os.cpu_count() or 1)),
+        "summary_file": batch.get("summaryFile")
+    }
+    if not isinstance(settings["name"], str):
+        raise BatchError("name: expected string")
+    if not isinstance(settings["engine_workers"], int) or settings["engine_workers"] < 1:
+        raise BatchError("engineWorkers: expected positive int")
+    if settings["summary_file"] is not None:
+        if not isinstance(settings["summary_file"], str):
+            raise BatchError("summaryFile: expected string")
+        settings["summary_file"] = os.path.join(base_dir, settings["summary_file"])
+
+    entries = []
+    configs = batch.get("configs", [])
+    if not isinstance(configs, list) or not all(isinstance(c, str) for c in configs):
+        raise BatchError("configs: expected list of config file paths")
+    for config_path in configs:
+        entries.append(BatchEntry(_config_label(config_path), _load_config(base_dir, config_path)))
+    if "matrix" in batch:
+        entries.extend(_expand_matrix(base_dir, batch["matrix"]))
+    if not entries:
+        raise BatchError("Batch file lists no configs")
+
+    # Labels name the reports, so they must be unique
+    seen = {}
+    for entry in entries:
+        if entry.label in seen:
+            seen[entry.label] += 1
+            entry.label += "-" + str(seen[entry.label])
+        else:
+            seen[entry.label] = 1
+    return settings, entries
+
+
+def _expand_matrix(base_dir: str, matrix: dict) -> list:
+    if not isinstance(matrix, dict):
+        raise BatchError("matrix: expected object")
+    if not isinstance(matrix.get("config"), str):
+        raise BatchError("matrix: config: expected string")
+    versions = matrix.get("nodeVersions", [None])
+    envs = matrix.get("env", [None])
+    if not isinstance(versions, list) or not all(v is None or isinstance(v, str) for v in versions):
+        raise BatchError("matrix: nodeVersions: expected list of full node versions")
+    if not isinstance(envs, list) or not all(e is None or isinstance(e, dict) for e in envs):
+        raise BatchError("matrix: env: expected list of objects")
+    base = _load_config(base_dir, matrix["config"])
+    entries = []
+    for version, env in itertools.product(versions, envs):
+        raw = json.loads(json.dumps(base))
+        label = _config_label(matrix["config"])
+        if version is not None:
+            raw["nvm-mode"] = True
+            raw["nvm-node-version"] = version
+            label += "-node" + version
+        if env:
+            raw["env"] = dict(raw.get("env", {}), **env)
+            label += "-" + ",".join(k + "=" + str(v) for k, v in sorted(env.items()))
+        entries.append(BatchEntry(label, raw))
+    return entries
+
+
+def _load_config(base_dir: str, path: str) -> dict:
+    full_path = os.path.join(base_dir, path)
+    try:
+        with open(full_path) as f:
+            raw = json.load(f)
+    except OSError as e:
+        raise BatchError("Failed to read config file " + path + ": " + str(e)) from None
+    except json.decoder.JSONDecodeError:
+        raise BatchError("Config file " + path + " must be in valid json format") from None
+    if not isinstance(raw, dict):
+        raise BatchError("Config file " + path + ": expected object")
+    return raw
+
+
+def _config_label(path: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.=,-]", "_", os.path.splitext(os.path.basename(path))[0])
+
+
+# Runs in an engine pool worker. Only a small summary is sent back, the report itself
+# is saved to the database by the engine.
+def run_engine_job(args: dict, top_n=3) -> dict:
+    report = run_engine(args)
+    functions = {}
+    for node in report["node_map"].values():
+        if node["joules"] > 0:
+            key = function_key(node["call_frame"])
+            functions[key] = functions.get(key, 0) + node["joules"]
+    seconds = (args["sensor_end"] - args["sensor_start"]) / 1e6
+    return {
+        "report_name": args["report_name"],
+        "joules": report["stats"]["joules"],
+        "seconds": seconds,
+        "watts": report["stats"]["joules"] / seconds if seconds > 0 else 0,
+        "top_functions": sorted(functions.items(), key=lambda x: x[1], reverse=True)[:top_n]
+    }
+
+
+# Why an entry failed, for the summary. Errors that were logged where they were raised
+# carry no message, their type still tells what failed.
+def failure_reason(stage: str, e: BaseException) -> str:
+    return stage + ": " + (str(e) if e.args and e.args[0] is not None else type(e).__name__)
+
+
+# Logs one table comparing every entry against the first one that succeeded, and
+# optionally writes it as json
+def report_summary(entries: list, summary_file=None) -> None:
+    baseline = next((e.summary for e in entries if e.summary is not None), None)
+    width = max(len(e.label) for e in entries)
+    logger.info("Batch summary:")
+    logger.info("    " + "entry".ljust(width) + "  " + "joules".rjust(10) + "  " + "watts".rjust(8)
+                + "  " + "vs first".rjust(9) + "  top function")
+    rows = []
+    for entry in entries:
+        row = {"label": entry.label, "error": entry.error}
+        if entry.summary is None:
+            logger.info("    " + entry.label.ljust(width) + "  failed: " + str(entry.error))
+        else:
+            row.update(entry.summary)
+            row["top_functions"] = [{"function": k, "joules": v} for k, v in entry.summary["top_functions"]]
+            change = None
+            if baseline["joules"] > 0:
+                change = (entry.summary["joules"] - baseline["joules"]) / baseline["joules"]
+            row["change_vs_first"] = change
+            top = entry.summary["top_functions"][0][0] if entry.summary["top_functions"] else "-"
+            logger.info("    " + entry.label.ljust(width) + "  " + "{:10.2f}".format(entry.summary["joules"])
+                        + "  " + "{:8.2f}".format(entry.summary["watts"]) + "  "
+                        + ("-" if change is None else "{:+.1%}".format(change)).rjust(9) + "  " + top)
+        rows.append(row)
+    if summary_file is not None:
+        with open(summary_file, "w") as f:
+            json.dump(rows, f, indent=2)
+        logger.info("Batch summary written to " + summary_file)
@@ -0,0 +1,154 @@
+from nodewatts.config import NWConfig
+from nodewatts.db import Database, DatabaseError
+from nodewatts.error import NodewattsError
+from nodewatts.profiler_handler import ProfilerHandler
+from nodewatts.sensor_handler import SensorHandler
+
+import csv
+import glob
+import json
+import logging
+import os
+import shutil
+import statistics as stat
+import time
+import psutil
+logger = logging.getLogger("Main")
+
+
+class CalibrationError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+# Picks the highest V8 and sensor sampling rates the pipeline can sustain.
+# Candidates are tried from coarsest to finest and the search stops at the first one
+# that fails, since finer rates only cost more. A rate fails when it is not actually
+# achieved (the sensor drops reports, or V8 samples further apart than requested), or
+# when it costs more CPU than the overhead budget. Overheads are expressed as a
+# percentage of the machine's total CPU capacity.
+class SamplingCalibrator:
+    # Microseconds. 1000 is the v8-profiler default.
+    v8_candidates = [1000, 500, 250, 100]
+    # Milliseconds
+    sensor_candidates = [20, 10, 5, 2, 1]
+    # Tolerated fraction of missing sensor reports
+    max_dropped = 0.05
+    # Tolerated ratio of achieved to requested V8 sampling interval
+    max_interval_stretch = 1.5
+
+    def __init__(self, config: NWConfig, profiler: ProfilerHandler, sensor: SensorHandler, db: Database):
+        self.config = config
+        self.profiler = profiler
+        self.sensor = sensor
+        self.db = db
+        self.budget = config.sampling_overhead_budget
+        self.cpu_count = psutil.cpu_count()
+
+    # Updates the config with the chosen rates and rewrites the module config files
+    def run(self) -> None:
+        logger.info("Calibrating sampling rates. This may take a moment.")
+        try:
+            self.config.sensor_frequency = self._calibrate_sensor()
+            self.config.v8_sampling_interval = self._calibrate_v8()
+        except DatabaseError as e:
+            logger.error("Database error during calibration: " + str(e))
+            raise CalibrationError(None) from None
+        self.profiler.set_sampling_interval(self.config.v8_sampling_interval)
+        self.config.inject_config_vars()
+        self.config.smartwatts_config["sensor-report-sampling-interval"] = self.config.sensor_frequency
+        logger.info("Calibration complete. V8 sampling interval: " + str(self.config.v8_sampling_interval)
+                    + "us, sensor frequency: " + str(self.config.sensor_frequency) + "ms.")
+
+    def _calibrate_sensor(self) -> int:
+        chosen = None
+        path = os.path.join(self.config.tmp_path, "hwpc_calibration.json")
+        csv_dir = os.path.join(self.config.tmp_path, "hwpc_calibration")
+        embedded = self.config.raw_store_path is not None
+        with open(self.config.sensor_config_path) as f:
+            sensor_conf = json.load(f)
+        for freq in self.sensor_candidates:
+            sensor_conf["frequency"] = freq
+            if embedded:
+                # The session's sensor config streams to the formula, which is not running yet
+                shutil.rmtree(csv_dir, ignore_errors=True)
+                sensor_conf["output"] = {"type": "csv", "uri": csv_dir}
+            with open(path, "w") as f:
+                json.dump(sensor_conf, f)
+            self.db.drop_sensor_data()
+            self.sensor.start_sensor(path)
+            proc = psutil.Process(self.sensor.sensor_process.pid)
+            cpu_before, wall_before = self._cpu_seconds(proc), time.monotonic()
+            time.sleep(self.config.calibration_seconds)
+            overhead = self._overhead(self._cpu_seconds(proc) - cpu_before, time.monotonic() - wall_before)
+            self.sensor.stop_sensor()
+            timestamps = self._csv_timestamps(csv_dir) if embedded else self.db.sensor_timestamps()
+            dropped = self._dropped_fraction(timestamps, freq * 1000)
+            logger.debug("Sensor frequency " + str(freq) + "ms: " + "{:.1%}".format(dropped)
+                         + " reports dropped, " + "{:.2f}".format(overhead) + "% cpu overhead.")
+            if dropped > self.max_dropped or overhead > self.budget:
+                break
+            chosen = freq
+        self.db.drop_sensor_data()
+        if chosen is None:
+            logger.error("Sensor could not sustain even the coarsest calibration frequency of "
+                         + str(self.sensor_candidates[0]) + "ms.")
+            raise CalibrationError(None)
+        return chosen
+
+    def _calibrate_v8(self) -> int:
+        chosen = None
+        baseline = None
+        for interval in self.v8_candidates:
+            title = self.profiler.profile_title + "-calibration-" + str(interval)
+            wall, cpu = self.profiler.calibration_run(title, interval)
+            deltas = self.db.get_profile_deltas(title)
+            # The profile is saved asynchronously by the agent after it replies
+            for _ in range(10):
+                if deltas is not None:
+                    break
+                time.sleep(0.5)
+                deltas = self.db.get_profile_deltas(title)
+            self.db.delete_profile(title)
+            if deltas is None or len(deltas) < 3:
+                logger.warning("No usable calibration profile at " + str(interval) + "us.")
+                break
+            achieved = stat.median(deltas[1:])
+            usage = self._overhead(cpu, wall)
+            if baseline is None:
+                baseline = usage
+            overhead = usage - baseline
+            logger.debug("V8 interval " + str(interval) + "us: achieved " + "{:.0f}".format(achieved)
+                         + "us, " + "{:.2f}".format(overhead) + "% cpu overhead over " + str(self.v8_candidates[0]) + "us.")
+            if achieved > interval * self.max_interval_stretch or overhead > self.budget:
+                break
+            chosen = interval
+        # The coarsest candidate is the v8 default, fall back to it
+        return self.v8_candidates[0] if chosen is None else chosen
+
+    def _overhead(self, cpu_seconds: float, wall_seconds: float) -> float:
+        if wall_seconds <= 0:
+            return 0.0
+        return cpu_seconds / (wall_seconds * self.cpu_count) * 100
+
+    # timestamps are the distinct report timestamps in microseconds, period the requested spacing
+    @staticmethod
+    def _dropped_fraction(timestamps: list, period: int) -> float:
+        if len(timestamps) < 2:
+            return 1.0
+        expected = (timestamps[-1] - timestamps[0]) / period + 1
+        return max(0.0, 1 - len(timestamps) / expected)
+
+    # Distinct report timestamps written by the sensor's csv output, one file per event group
+    @staticmethod
+    def _csv_timestamps(directory: str) -> list:
+        timestamps = set()
+        for path in glob.glob(os.path.join(directory, "*.csv")):
+            with open(path, newline="") as f:
+                for row in csv.DictReader(f):
+                    timestamps.add(int(row["timestamp"]))
+        return sorted(timestamps)
+
+    @staticmethod
+    def _cpu_seconds(proc: psutil.Process) -> float:
+        return ProfilerHandler._cpu_seconds(proc)
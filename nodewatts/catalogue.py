@@ -0,0 +1,89 @@
+from datetime import datetime
+import re
+from pymongo.collection import Collection
+
+# Summary of every saved report, in the nodewatts.catalogue collection. The engine adds an
+# entry when it saves a report, and the visualizer lists and searches reports from here
+# instead of reading the reports themselves. name_lower serves case-insensitive prefix
+# search from its index.
+INDEXES = [
+    [("name_lower", 1)],
+    [("date", -1)],
+    [("project", 1), ("date", -1)],
+    [("report_id", 1)]
+]
+
+SORT_FIELDS = {"date": "date", "name": "name_lower", "joules": "joules", "duration": "duration"}
+
+
+def ensure_indexes(catalogue: Collection) -> None:
+    for keys in INDEXES:
+        catalogue.create_index(keys, unique=keys == [("report_id", 1)])
+
+
+# report is the report document as saved, with its _id. duration is in seconds.
+def entry_for(report: dict, project: str = None, duration: float = None) -> dict:
+    stats = report.get("stats", {})
+    if duration is None and stats.get("runs"):
+        duration = sum(r["duration"] for r in stats["runs"]) / 1e6
+    try:
+        date = datetime.fromisoformat(report["engine_datetime"])
+    except (KeyError, TypeError, ValueError):
+        date = None
+    joules = stats.get("joules", 0)
+    return {
+        "report_id": report["_id"],
+        "name": report.get("name", ""),
+        "name_lower": report.get("name", "").lower(),
+        "date": date,
+        "project": project,
+        "session": report.get("session"),
+        "window": report.get("window"),
+        "joules": joules,
+        "duration": duration,
+        "avg_watts": joules / duration if duration else None
+    }
+
+
+def add(catalogue: Collection, entry: dict) -> None:
+    catalogue.replace_one({"report_id": entry["report_id"]}, entry, upsert=True)
+
+
+# Adds reports saved before the catalogue existed. Returns the number added.
+def backfill(reports: Collection, catalogue: Collection) -> int:
+    known = set(catalogue.distinct("report_id"))
+    added = 0
+    fields = {"name": 1, "engine_datetime": 1, "stats.joules": 1, "stats.runs.duration": 1,
+              "session": 1, "window": 1}
+    for report in reports.find({"_id": {"$nin": list(known)}}, fields):
+        add(catalogue, entry_for(report))
+        added += 1
+    return added
+
+
+# One page of the catalogue. query matches the start of report names, ignoring case.
+# since and until bound the report date.
+def search(catalogue: Collection, query: str = None, project: str = None, session: str = None,
+           since: datetime = None, until: datetime = None, sort: str = "date", descending=True,
+           offset: int = 0, limit: int = 50) -> dict:
+    criteria = {}
+    if query:
+        criteria["name_lower"] = {"$regex": "^" + re.escape(query.lower())}
+    if project is not None:
+        criteria["project"] = project
+    if session is not None:
+        criteria["session"] = session
+    if since is not None or until is not None:
+        criteria["date"] = {}
+        if since is not None:
+            criteria["date"]["$gte"] = since
+        if until is not None:
+            criteria["date"]["$lte"] = until
+    cursor = catalogue.find(criteria, {"_id": 0, "name_lower": 0}) \
+        .sort([(SORT_FIELDS[sort], -1 if descending else 1), ("report_id", -1)]) \
+        .skip(offset).limit(limit)
+    return {
+        "total": catalogue.count_documents(criteria),
+        "offset": offset,
+        "reports": list(cursor)
+    }
@@ -15,11 +15,14 @@ class CgroupInitError(NodewattsError):
 
 class CgroupInterface():
     # Performs the necessary verification and creates cgroup on initialization
-    cgroup_name = "node"
     cgroup_root = '/sys/fs/cgroup'
     perf_root = '/sys/fs/cgroup/perf_event'
-    def __init__(self, manager: SubprocessManager):
+    # name is unique per session so concurrent sessions get separate cgroups
+    def __init__(self, manager: SubprocessManager, name: str = "node"):
         self.proc_manager = manager
+        self.cgroup_name = name
+        # Every cgroup created by this instance, removed on cleanup
+        self.created = []
         if not os.path.exists(CgroupInterface.cgroup_root):
             logger.error("Could not locate cgroup directory.")
             raise CgroupInitError(None)
@@ -27,38 +30,53 @@ class CgroupInterface():
             logger.error("Failed to locate perf_event subsystem. NodeWatts requires cgroupv1 and a mounted perf_event subsystem.")
             raise CgroupInitError(None)
 
-    def create_cgroup(self):
-        if self.cgroup_exists():
-            print("trying to remove")
-            self.remove_cgroup()
+    def create_cgroup(self, name: str = None):
+        name = self.cgroup_name if name is None else name
+        if self.cgroup_exists(name):
+            self.remove_cgroup(name)
         try:
-            os.mkdir(os.path.join(CgroupInterface.perf_root, "node"))
+            os.mkdir(os.path.join(CgroupInterface.perf_root, name))
         except OSError as e:
             logger.error("Failed to create cgroup. Error: " + str(e))
             raise CgroupInitError(None) from None
         else:
-            logger.debug("cgroup created.")
+            self.created.append(name)
+            logger.debug("cgroup " + name + " created.")
 
-    def add_PID(self, PID: int) -> None:
-        path = os.path.join(CgroupInterface.perf_root, CgroupInterface.cgroup_name, "cgroup.procs")
+    def add_PID(self, PID: int, name: str = None) -> None:
+        name = self.cgroup_name if name is None else name
+        path = os.path.join(CgroupInterface.perf_root, name, "cgroup.procs")
         if not os.path.exists(path):
             logger.error("Could not locate cgroup.procs file.")
             logger.debug("Tried: " + path)
             raise CgroupException(None)
         with open(path, "a") as f:
             f.write(str(PID)+"\n")
-        logger.debug("PID added to cgroup.")
+        logger.debug("PID added to cgroup " + name + ".")
 
-    def remove_cgroup(self):
-        os.rmdir(os.path.join(CgroupInterface.perf_root, "node"))
+    # Cluster workers get a cgroup of their own so the formula estimates their power separately.
+    # The engine looks for them under the target "/<cgroup_name>-<pid>".
+    def add_process_cgroup(self, PID: int) -> None:
+        name = self.cgroup_name + "-" + str(PID)
+        self.create_cgroup(name)
+        try:
+            self.add_PID(PID, name)
+        except OSError as e:
+            # The worker may have exited since it reported its pid
+            logger.warning("Failed to move worker " + str(PID) + " to its cgroup. Error: " + str(e))
+
+    def remove_cgroup(self, name: str = None):
+        os.rmdir(os.path.join(CgroupInterface.perf_root, self.cgroup_name if name is None else name))
 
-    def cgroup_exists(self):
-        return os.path.exists(os.path.join(CgroupInterface.perf_root, "node"))
+    def cgroup_exists(self, name: str = None):
+        return os.path.exists(os.path.join(CgroupInterface.perf_root, self.cgroup_name if name is None else name))
     
     def cleanup(self):
-        if self.cgroup_exists():
-            logger.debug("Removing cgroup.")
-            try:
-                self.remove_cgroup()
-            except OSError as e:
-                logger.warning("Failed to remove cgroup from perf_event directory. Error: \n" + str(e))
\ No newline at end of file
+        for name in reversed(self.created):
+            if self.cgroup_exists(name):
+                logger.debug("Removing cgroup " + name + ".")
+                try:
+                    self.remove_cgroup(name)
+                except OSError as e:
+                    logger.warning("Failed to remove cgroup from perf_event directory. Error: \n" + str(e))
+        self.created = []
@@ -1,16 +1,20 @@
 from nodewatts.nwengine.config import Config
 from nodewatts.error import NodewattsError
+from nodewatts.snapshot import ProjectSnapshot
 
 from appdirs import AppDirs
 from datetime import datetime
 from pathlib import Path
+import fcntl
 import os
 import json
-import jsonschema as jschema
 import platform
 import logging
+import re
+import socket
 import sys
 import shutil
+import uuid
 logger = logging.getLogger("Main")
 
 
@@ -66,15 +70,34 @@ class NWConfig(Config):
         self.tmp_path = None
         self.smartwatts_config = None
         self.viz_port = 8080
-        self.profiler_port = 9999
+
+        ####
+        # Session
+        ###
+        # Everything a session leaves on the host (raw data collections, cgroups, ports, temporary
+        # directories and module configs) is namespaced by its id, so sessions can run side by side.
+        if "sessionId" in args:
+            if not isinstance(args["sessionId"], str) or not re.fullmatch(r"[A-Za-z0-9_-]{1,32}", args["sessionId"]):
+                raise InvalidConfig("sessionId: expected up to 32 letters, digits, - or _")
+            self.session_id = args["sessionId"]
+        else:
+            self.session_id = uuid.uuid4().hex[:8]
+        self.session_dir = os.path.join(NWConfig.dirs.site_data_dir, "sessions", self.session_id)
+        self.cgroup_name = "nodewatts-" + self.session_id
+        self.profiler_port = NWConfig.free_port()
+        # The sensor streams to the formula on this port when the embedded raw store is used
+        self.sensor_socket_port = NWConfig.free_port()
 
         ####
         # Config Paths
         ###
-        self.sensor_config_path = os.path.join(
+        # Shared module configs, copied into the session directory with the session's settings
+        self.sensor_base_config_path = os.path.join(
             NWConfig.package_root, "resources/config/hwpc_config.json")
-        self.sw_config_path = os.path.join(
+        self.sw_base_config_path = os.path.join(
             NWConfig.dirs.site_config_dir, "smartwatts_config.json")
+        self.sensor_config_path = os.path.join(self.session_dir, "hwpc_config.json")
+        self.sw_config_path = os.path.join(self.session_dir, "smartwatts_config.json")
 
         ####
         # Top-Level Config Options
@@ -141,12 +164,127 @@ class NWConfig(Config):
         # Nested Options
         ###
 
+        # Extra environment variables for the server and test commands
+        self.env = args.get("env", {})
+        if not isinstance(self.env, dict) or not all(isinstance(v, str) for v in self.env.values()):
+            raise InvalidConfig("env: expected object of string values")
+
         self.commands = args["commands"]
         if not isinstance(args["commands"]["serverStart"], str):
             raise InvalidConfig("serverStart: expected string")
-        if not isinstance(args["commands"]["runTests"], str):
+        if "runTests" in args["commands"] and not isinstance(args["commands"]["runTests"], str):
             raise InvalidConfig("runTests: expected string")
 
+        # Built-in load driver, replaces runTests when provided
+        if "workload" in args:
+            from nodewatts.workload import Scenario, WorkloadError
+            workload = args["workload"]
+            if not isinstance(workload, dict):
+                raise InvalidConfig("workload: expected object")
+            if "scenarioFile" not in workload or not isinstance(workload["scenarioFile"], str):
+                raise InvalidConfig("workload: scenarioFile: expected string")
+            try:
+                Scenario.load(workload["scenarioFile"])
+            except WorkloadError as e:
+                raise InvalidConfig("workload: " + str(e)) from None
+            self.workload = {
+                "scenario_file": os.path.abspath(workload["scenarioFile"]),
+                "concurrency": workload.get("concurrency", 10),
+                "rate": workload.get("rate", 0),
+                "requests": workload.get("requests"),
+                "duration": workload.get("duration")
+            }
+            if not isinstance(self.workload["concurrency"], int) or self.workload["concurrency"] < 1:
+                raise InvalidConfig("workload: concurrency: expected positive int")
+            if not isinstance(self.workload["rate"], (int, float)) or self.workload["rate"] < 0:
+                raise InvalidConfig("workload: rate: expected non-negative number")
+            if self.workload["requests"] is not None and not isinstance(self.workload["requests"], int):
+                raise InvalidConfig("workload: requests: expected int")
+            if self.workload["duration"] is not None and not isinstance(self.workload["duration"], (int, float)):
+                raise InvalidConfig("workload: duration: expected number")
+            if self.workload["requests"] is None and self.workload["duration"] is None:
+                self.workload["requests"] = 1000
+        else:
+            self.workload = None
+
+        # Windowed profiling of a long running server instead of a single test suite execution
+        if "continuous" in args:
+            continuous = args["continuous"]
+            if not isinstance(continuous, dict):
+                raise InvalidConfig("continuous: expected object")
+            self.continuous = {
+                "window_seconds": continuous.get("windowSeconds", 60),
+                "duration": continuous.get("duration")
+            }
+            if not isinstance(self.continuous["window_seconds"], int) or self.continuous["window_seconds"] < 1:
+                raise InvalidConfig("continuous: windowSeconds: expected positive int")
+            if self.continuous["duration"] is not None and not isinstance(self.continuous["duration"], int):
+                raise InvalidConfig("continuous: duration: expected int")
+        else:
+            self.continuous = None
+
+        # The server runs from a copy-on-write snapshot of the project, kept in tmpfs by default
+        snapshot = args.get("snapshot", False)
+        if isinstance(snapshot, bool):
+            snapshot = {} if snapshot else None
+        if snapshot is not None:
+            if not isinstance(snapshot, dict):
+                raise InvalidConfig("snapshot: expected bool or object")
+            default_dir = "/dev/shm/nodewatts" if os.path.isdir("/dev/shm") \
+                else os.path.join(NWConfig.dirs.site_data_dir, "snapshots")
+            self.snapshot = {"dir": snapshot.get("dir", default_dir),
+                             "max_age_days": snapshot.get("maxAgeDays", 7)}
+            if not isinstance(self.snapshot["dir"], str):
+                raise InvalidConfig("snapshot: dir: expected string")
+            if not isinstance(self.snapshot["max_age_days"], (int, float)) or self.snapshot["max_age_days"] <= 0:
+                raise InvalidConfig("snapshot: maxAgeDays: expected positive number")
+            self.snapshot_root = ProjectSnapshot.root_for(self.root_path, self.snapshot["dir"])
+        else:
+            self.snapshot = None
+            self.snapshot_root = None
+
+        # Sampling rates. Unset values fall back to the v8-profiler default and the
+        # frequency in the sensor config file. autoTune calibrates both before profiling.
+        sampling = args.get("sampling", {})
+        if not isinstance(sampling, dict):
+            raise InvalidConfig("sampling: expected object")
+        self.v8_sampling_interval = sampling.get("v8Interval")
+        if self.v8_sampling_interval is not None and (not isinstance(self.v8_sampling_interval, int)
+                                                      or self.v8_sampling_interval < 1):
+            raise InvalidConfig("sampling: v8Interval: expected positive int (microseconds)")
+        self.sensor_frequency = sampling.get("sensorFrequency")
+        if self.sensor_frequency is not None and (not isinstance(self.sensor_frequency, int)
+                                                  or self.sensor_frequency < 1):
+            raise InvalidConfig("sampling: sensorFrequency: expected positive int (milliseconds)")
+        self.sampling_autotune = sampling.get("autoTune", False)
+        if not isinstance(self.sampling_autotune, bool):
+            raise InvalidConfig("sampling: autoTune: expected bool")
+        self.sampling_overhead_budget = sampling.get("maxOverheadPercent", 5)
+        if not isinstance(self.sampling_overhead_budget, (int, float)) or self.sampling_overhead_budget <= 0:
+            raise InvalidConfig("sampling: maxOverheadPercent: expected positive number")
+        self.calibration_seconds = sampling.get("calibrationSeconds", 5)
+        if not isinstance(self.calibration_seconds, int) or self.calibration_seconds < 1:
+            raise InvalidConfig("sampling: calibrationSeconds: expected positive int")
+
+        # Raw session data is kept in MongoDB unless the embedded, file backed store is chosen
+        raw_store = args["database"].get("rawStore", "mongodb") if isinstance(args.get("database"), dict) else "mongodb"
+        if raw_store not in ("mongodb", "embedded"):
+            raise InvalidConfig("database: rawStore: expected \"mongodb\" or \"embedded\"")
+        self.raw_store_path = os.path.join(self.session_dir, "raw") if raw_store == "embedded" else None
+
+        # Settings of the shared MongoDB clients, see nodewatts/mongo.py
+        database = args["database"] if isinstance(args.get("database"), dict) else {}
+        self.db_options = {}
+        for key, option in [("serverSelectionTimeoutMS", "server_selection_timeout_ms"),
+                            ("connectTimeoutMS", "connect_timeout_ms"),
+                            ("socketTimeoutMS", "socket_timeout_ms"),
+                            ("maxPoolSize", "max_pool_size"),
+                            ("healthCheckInterval", "health_check_interval")]:
+            if key in database:
+                if not isinstance(database[key], int) or database[key] < 1:
+                    raise InvalidConfig("database: " + key + ": expected positive int")
+                self.db_options[option] = database[key]
+
         ####
         # Developer Options
         ###
@@ -189,19 +327,40 @@ class NWConfig(Config):
         else:
             self.sw_verbose = False
 
-        if self.visualize:
-            viz_args = {
-                "mongoUrl": self.engine_conf_args["internal_db_uri"],
-                "port": self.viz_port
-            }
-            with (open(os.path.join(NWConfig.dirs.site_config_dir, "viz_config.json"), "w+")) as f:
-                json.dump(viz_args, f)
-        
+        # Directory static html copies of the reports are written to
+        self.html_export = args.get("htmlExport")
+        if self.html_export is not None:
+            if not isinstance(self.html_export, str):
+                raise InvalidConfig("htmlExport: expected string")
+            self.html_export = os.path.abspath(self.html_export)
+
+        # Multi-worker serving of the visualizer, see --serve
+        viz_server = args.get("vizServer", {})
+        if not isinstance(viz_server, dict):
+            raise InvalidConfig("vizServer: expected object")
+        self.viz_server = {
+            "host": viz_server.get("host", "0.0.0.0"),
+            "workers": viz_server.get("workers", min(4, os.cpu_count() or 1)),
+            "threads": viz_server.get("threads", 8)
+        }
+        self.viz_port = viz_server.get("port", self.viz_port)
+        if not isinstance(self.viz_server["host"], str):
+            raise InvalidConfig("vizServer: host: expected string")
+        for key in ("port", "workers", "threads"):
+            value = self.viz_port if key == "port" else self.viz_server[key]
+            if not isinstance(value, int) or value < 1:
+                raise InvalidConfig("vizServer: " + key + ": expected positive int")
+
         ####
         # Data Engine Args
         ###
         self.engine_conf_args = self._to_engine_format(args)
 
+        if self.visualize:
+            viz_args = dict(self.viz_server, mongoUrl=self.engine_conf_args["internal_db_uri"], port=self.viz_port)
+            with (open(os.path.join(NWConfig.dirs.site_config_dir, "viz_config.json"), "w+")) as f:
+                json.dump(viz_args, f)
+
 
     # Validates and reports any missing required parameters
     @staticmethod
@@ -254,7 +413,7 @@ class NWConfig(Config):
                 missing["commands"] = {
                     "serverStart": "[CLI command to start server]"
                 }
-            if "runTests" not in args["commands"]:
+            if "runTests" not in args["commands"] and "workload" not in args and "continuous" not in args:
                 if "commands" not in missing:
                     missing["commands"] = {
                         "runTests": "[CLI command to run test suite]"
@@ -297,32 +456,90 @@ class NWConfig(Config):
         if not isinstance(parsed["out_db_name"], str):
             raise InvalidConfig("Database: exportDbName: expected string")
         parsed["report_name"] = self.report_name
+        parsed["raw_store_path"] = self.raw_store_path
+        parsed["session_id"] = self.session_id
+        parsed["cgroup_name"] = self.cgroup_name
+        parsed["snapshot_root"] = self.snapshot_root
+        parsed["db_options"] = self.db_options
+        parsed["project_root"] = os.path.abspath(self.root_path)
         parsed["outlier_limit"] = self.cpu_tdp
+        if self.html_export is not None:
+            parsed["html_export"] = self.html_export
         return parsed
 
     def _generate_engine_conf(self, args: dict) -> Config:
         return super().__init__(args)
 
+    # Ports are picked by the OS and reserved by holding a lock on a file named after the
+    # port until the session ends. The port is only bound later, by the profiled server or
+    # the formula, so without the reservation a second session could be handed the same one
+    # in between. The lock goes away with the process, so a crashed session holds nothing.
+    _reserved_ports = {}
+
+    @staticmethod
+    def free_port(attempts=100) -> int:
+        ports_dir = os.path.join(NWConfig.dirs.site_data_dir, "ports")
+        os.makedirs(ports_dir, exist_ok=True)
+        for _ in range(attempts):
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            fd = os.open(os.path.join(ports_dir, str(port)), os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            NWConfig._reserved_ports[port] = fd
+            return port
+        raise InvalidConfig("Could not reserve a free port for the session")
+
+    @staticmethod
+    def release_ports() -> None:
+        for fd in NWConfig._reserved_ports.values():
+            os.close(fd)
+        NWConfig._reserved_ports.clear()
+
+    # Raw data collections of this session
+    def collection(self, name: str) -> str:
+        return name + "_" + self.session_id
+
+    # Writes the session's copies of the module configs.
     # This will fail unless both module config files are validated beforehand
     def inject_config_vars(self):
-        with open(self.sensor_config_path, "r+") as f:
+        with open(self.sensor_base_config_path) as f:
             sensor = json.load(f)
             # Sensor verbose mode is not helpful in this context.
             sensor["verbose"] = False
-            sensor["output"]["uri"] = self.engine_conf_args["internal_db_uri"]
-            f.seek(0)
+            if self.raw_store_path is None:
+                sensor["output"]["type"] = "mongodb"
+                sensor["output"]["uri"] = self.engine_conf_args["internal_db_uri"]
+                sensor["output"]["collection"] = self.collection("sensor_raw")
+                sensor["output"].pop("port", None)
+            else:
+                # Reports go straight to the formula's socket puller, nothing is stored
+                sensor["output"]["type"] = "socket"
+                sensor["output"]["uri"] = "127.0.0.1"
+                sensor["output"]["port"] = self.sensor_socket_port
+        if self.sensor_frequency is not None:
+            sensor["frequency"] = self.sensor_frequency
+        with open(self.sensor_config_path, "w") as f:
             json.dump(sensor, f)
-            f.truncate()
 
-        with open(self.sw_config_path, "r+") as f:
+        with open(self.sw_base_config_path) as f:
             sw = json.load(f)
-            sw["cpu-tdp"] = self.cpu_tdp
-            f.seek(0)
+        sw["cpu-tdp"] = self.cpu_tdp
+        sw["input"]["puller"]["collection"] = self.collection("sensor_raw")
+        sw["output"]["pusher_power"]["collection"] = self.collection("cpu")
+        # The formula must know how often the sensor reports
+        if self.sensor_frequency is not None:
+            sw["sensor-report-sampling-interval"] = self.sensor_frequency
+        with open(self.sw_config_path, "w") as f:
             json.dump(sw, f)
-            f.truncate()
 
     @staticmethod
     def validate_sensor_config(args: dict) -> None:
+        import jsonschema as jschema
         sensor_schema = {
             "type": "object",
             "required": ["name", "verbose", "frequency", "output", "system", "container"],
@@ -386,6 +603,7 @@ class NWConfig(Config):
 
     @staticmethod
     def validate_smartwatts_config(args: dict) -> None:
+        import jsonschema as jschema
         sw_schema = {
             "type": "object",
             "required": ["verbose", "stream", "input", "output", "cpu-frequency-base", "cpu-frequency-min", "cpu-frequency-max", "cpu-error-threshold",
@@ -443,3 +661,8 @@ class NWConfig(Config):
             raise InvalidConfig(
                 "Smartwatts configuration file is invalid: \n Please ensure you \
                      have run the provided install.sh file. \n\n" + str(e)) from None
+        # The embedded store is written by the formula, it cannot feed it
+        if args["input"]["puller"]["type"] == "segment":
+            raise InvalidConfig("Smartwatts configuration file is invalid: input: the \"segment\" "
+                                + "type is only available as an output. Set database.rawStore to "
+                                + "\"embedded\" in the NodeWatts config to use the embedded store.")
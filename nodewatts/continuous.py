@@ -0,0 +1,132 @@
+from nodewatts.config import NWConfig
+from nodewatts.db import Database, DatabaseError
+from nodewatts.error import NodewattsError
+from nodewatts.nwengine.__main__ import run_engine, EngineError
+from nodewatts.nwengine.cpu_profile import function_key
+
+from collections import deque
+from datetime import datetime, timezone
+import logging
+import pymongo
+import time
+logger = logging.getLogger("Main")
+
+
+class WindowError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+class Window:
+    def __init__(self, index: int, title: str, start: int, end: int):
+        self.index = index
+        self.title = title
+        self.start = start
+        self.end = end
+
+    # Parses the line printed by window-runner.js when a window is saved
+    @staticmethod
+    def from_runner_line(line: str) -> "Window" or None:
+        if not line.startswith("Window: "):
+            return None
+        index, title, start, end = line[len("Window: "):].split(" ")
+        return Window(int(index), title, int(start), int(end))
+
+
+# Processes each window of a continuous profiling session as it is captured.
+# Waits for the agent to save the window's cpu profile and for the streaming formula to
+# catch up with the window's end, runs the engine over it, then prunes the window's raw
+# data. Keeps a rolling view of the last few windows and the session's hottest functions.
+class WindowProcessor:
+    # Matches the padding run_engine applies to the power sample range
+    padding = 2000
+
+    # live_functions: functions sent in each live update, the rest are summed up
+    def __init__(self, config: NWConfig, db: Database, rolling_windows=10, data_timeout=60, live_functions=50):
+        self.config = config
+        self.live_functions = live_functions
+        self.db = db
+        self.data_timeout = data_timeout
+        self.recent = deque(maxlen=rolling_windows)
+        self.function_joules = {}
+        self.session_joules = 0
+        self.processed = 0
+
+    def process(self, window: Window) -> None:
+        try:
+            self._wait_for_data(window)
+            args = dict(self.config.engine_conf_args)
+            args["profile_title"] = window.title
+            args["report_name"] = self.config.report_name + "-window-" + str(window.index)
+            args["sensor_start"] = window.start
+            args["sensor_end"] = window.end
+            args["session"] = self.config.report_name
+            args["window"] = window.index
+            report = run_engine(args)
+            self.db.prune_window(window.title, window.end - self.padding)
+        except (EngineError, DatabaseError) as e:
+            # A bad window should not end a soak test, skip it and keep going
+            logger.error("Failed to process window " + str(window.index) + ". " + ("" if e.args[0] is None else str(e)))
+            return
+        self._update_rolling_view(window, report)
+
+    def _wait_for_data(self, window: Window) -> None:
+        deadline = time.monotonic() + self.data_timeout
+        while not self.db.has_profile(window.title):
+            if time.monotonic() > deadline:
+                raise EngineError("Timed out waiting for cpu profile of window " + str(window.index))
+            time.sleep(0.5)
+        while True:
+            latest = self.db.latest_power_timestamp()
+            if latest is not None and latest >= window.end + self.padding:
+                return
+            if time.monotonic() > deadline:
+                raise EngineError("Timed out waiting for power estimates of window " + str(window.index))
+            time.sleep(0.5)
+
+    def _update_rolling_view(self, window: Window, report: dict) -> None:
+        joules = report["stats"]["joules"]
+        seconds = (window.end - window.start) / 1e6
+        self.recent.append((joules, seconds))
+        self.session_joules += joules
+        self.processed += 1
+        window_joules = {}
+        for node in report["node_map"].values():
+            if node["joules"] > 0:
+                key = function_key(node["call_frame"])
+                window_joules[key] = window_joules.get(key, 0) + node["joules"]
+        for key, value in window_joules.items():
+            self.function_joules[key] = self.function_joules.get(key, 0) + value
+        self._publish(window, report, window_joules)
+
+        rolling_joules = sum(j for j, _ in self.recent)
+        rolling_seconds = sum(s for _, s in self.recent)
+        logger.info("Window " + str(window.index) + ": " + "{:.2f}".format(joules) + " J over "
+                    + "{:.1f}".format(seconds) + " s. Last " + str(len(self.recent)) + " windows: "
+                    + "{:.2f}".format(rolling_joules / rolling_seconds if rolling_seconds else 0) + " W average. "
+                    + "Session total: " + "{:.2f}".format(self.session_joules) + " J.")
+        for key, value in self.top_functions(5):
+            logger.debug("    " + "{:.3f}".format(value) + " J  " + key)
+
+    # Sends the window's energy by function to anyone watching the session in the visualizer
+    def _publish(self, window: Window, report: dict, window_joules: dict) -> None:
+        ranked = sorted(window_joules.items(), key=lambda x: x[1], reverse=True)
+        update = {
+            "session": self.config.report_name,
+            "window": window.index,
+            "report_name": report["name"],
+            "time": datetime.now(timezone.utc),
+            "seconds": (window.end - window.start) / 1e6,
+            "joules": report["stats"]["joules"],
+            "session_joules": self.session_joules,
+            "functions": [{"function": k, "joules": v, "session_joules": self.function_joules[k]}
+                          for k, v in ranked[:self.live_functions]],
+            "other_joules": sum(v for _, v in ranked[self.live_functions:])
+        }
+        try:
+            self.db.publish_live_update(update)
+        except (DatabaseError, pymongo.errors.PyMongoError) as e:
+            logger.warning("Failed to publish live update of window " + str(window.index) + ". " + str(e))
+
+    def top_functions(self, n: int) -> list:
+        return sorted(self.function_joules.items(), key=lambda x: x[1], reverse=True)[:n]
@@ -1,7 +1,9 @@
 import pymongo
-from pymongo import MongoClient
 from nodewatts.error import NodewattsError
+from nodewatts.mongo import clients
+from nodewatts.raw_store import MongoRawStore, SegmentStore, RawStoreError
 import logging
+import os
 logger = logging.getLogger("Main")
 
 
@@ -11,64 +13,188 @@ class DatabaseError(NodewattsError):
 
 
 class DatabaseInterface:
-    def __init__(self, uri="mongodb://localhost:27017"):
+    # raw_store_path selects the embedded raw data store, see nodewatts/raw_store.py.
+    # MongoDB is then only used for reports, and is optional.
+    # session_id namespaces the raw data collections in MongoDB.
+    def __init__(self, uri="mongodb://localhost:27017", raw_store_path=None, session_id=None):
         self.internal_uri = uri
+        self.raw_store_path = raw_store_path
+        self.session_id = session_id
         self.export_client = None
         self.export_db = None
         self.internal_client = None
         self.internal_db = None
+        self.raw = None
 
+    # Clients come from the process wide registry in nodewatts/mongo.py and are shared
     def connect(self):
-        self.internal_client = MongoClient(
-            self.internal_uri, serverSelectionTimeoutMS=50)
         try:
-            self.internal_client.admin.command('ismaster')
-        except pymongo.errors.ServerSelectionTimeoutError as e:
-            raise DatabaseError("Failed to connect to internal database at uri: "
-                                + self.internal_uri + "Error: " + str(e))
+            self.internal_client = clients.get(self.internal_uri)
+        except pymongo.errors.PyMongoError as e:
+            if self.raw_store_path is None:
+                raise DatabaseError("Failed to connect to internal database at uri: "
+                                    + self.internal_uri + "Error: " + str(e))
+            logger.debug("No internal database at uri %s, using the embedded store only.", self.internal_uri)
+            self.internal_client = None
+        if self.raw_store_path is None:
+            self.raw = MongoRawStore(self.internal_client["nodewatts"], self.session_id)
         else:
-            logger.debug(
-                "Configured internal db mongo client at uri %s", self.internal_uri)
+            try:
+                self.raw = SegmentStore(self.raw_store_path)
+            except RawStoreError as e:
+                raise DatabaseError(str(e)) from None
 
     def connect_to_export_db(self, uri: str, name='nodewatts') -> None:
-        self.export_client = MongoClient(uri, serverSelectionTimeoutMS=50)
-
         try:
-            self.export_client.admin.command('ismaster')
-        except pymongo.errors.ServerSelectionTimeoutError as e:
+            self.export_client = clients.get(uri)
+        except pymongo.errors.PyMongoError as e:
             raise DatabaseError("Failed to connect to export database at uri: "
                                 + uri + "Error: " + str(e))
-        else:
-            logger.debug("Configured export db mongo client at uri %s", uri)
         self.external_db_name = name
 
+    # Shared clients stay open for the next user, only this instance's references are dropped
     def close_connections(self):
-        if self.internal_client is not None:
-            self.internal_client.close()
-        if self.export_client is not None:
-            self.export_client.close()
+        if self.raw is not None:
+            self.raw.close()
+            self.raw = None
+        self.internal_client = None
+        self.export_client = None
 
 
 class Database(DatabaseInterface):
-    def __init__(self, internal_uri):
-        super().__init__(internal_uri)
+    raw_collections = ["sensor_raw", "cpu", "profiles", "requests"]
+    profile_service_collections = ["nodes", "callframes"]
+
+    def __init__(self, internal_uri, raw_store_path=None, session_id=None):
+        super().__init__(internal_uri, raw_store_path, session_id)
 
     def has_sensor_data(self) -> bool:
         self.connect()
-        cnt = self.internal_client["nodewatts"]["sensor_raw"].count_documents({
-        }) == 0
+        cnt = self.raw.count("sensor_raw")
+        self.close_connections()
+        return cnt > 0
+
+    # Sensor reports not yet consumed by the streaming formula, which deletes them as it reads.
+    # With the embedded store the sensor streams straight to the formula and this is always 0.
+    def pending_sensor_reports(self) -> int:
+        self.connect()
+        cnt = self.raw.count("sensor_raw")
+        self.close_connections()
+        return cnt
+
+    def save_request_records(self, profile_title: str, records: list) -> None:
+        if not records:
+            return
+        self.connect()
+        self.raw.insert_many("requests", [dict(r, profile_title=profile_title) for r in records])
+        self.close_connections()
+
+    # Window mode helpers. Each window's data is pruned once its report is saved so
+    # long sessions run in bounded space.
+    def has_profile(self, title: str) -> bool:
+        self.connect()
+        found = self.raw.count("profiles", {"title": title}) > 0
+        self.close_connections()
+        return found
+
+    def latest_power_timestamp(self) -> int or None:
+        self.connect()
+        ts = self.raw.latest_timestamp("cpu")
+        self.close_connections()
+        return ts
+
+    def prune_window(self, title: str, before: int) -> None:
+        self.connect()
+        self.raw.delete("profiles", {"title": title})
+        self.raw.delete_before("cpu", before)
+        self.close_connections()
+
+    # Per window updates of a continuous session, streamed to the visualizer by
+    # viz_server/live.py. Skipped without MongoDB, there is no visualizer to stream to.
+    # Updates expire after a day, see ensure_indexes.
+    def publish_live_update(self, update: dict) -> None:
+        self.connect()
+        if self.internal_client is not None:
+            self.internal_client["nodewatts"]["live_updates"].insert_one(update)
+        self.close_connections()
+
+    # Calibration helpers
+    def sensor_timestamps(self) -> list:
+        self.connect()
+        res = sorted({d["timestamp"] for d in self.raw.find("sensor_raw", projection=["timestamp"])})
+        self.close_connections()
+        return res
+
+    def drop_sensor_data(self) -> None:
+        self.connect()
+        self.raw.drop("sensor_raw")
+        self._ensure_indexes(["sensor_raw"])
+        self.close_connections()
+
+    def get_profile_deltas(self, title: str) -> list or None:
+        self.connect()
+        doc = self.raw.find_one("profiles", {"title": title})
+        self.close_connections()
+        return None if doc is None else doc["timeDeltas"]
+
+    def delete_profile(self, title: str) -> None:
+        self.connect()
+        self.raw.delete("profiles", {"title": title})
         self.close_connections()
-        return cnt == 0
 
-    # Rather than having each component track and perform cleanup of
-    # its raw data in the case of a crash. NodeWatts will simply check
-    # the relevant collections and drop them at startup. They will also be dropped
-    # at the end. Reports and Exports will always be preserved.
+    # Drops the session's raw data. Run at session start, at the end and on cleanup when the
+    # session is not kept to be resumed. Data of sessions that crashed without cleaning up
+    # is dropped by drop_orphaned_raw_data. Reports and Exports will always be preserved.
     def drop_raw_data(self):
         self.connect()
-        self.internal_client["nodewatts"].drop_collection("sensor_raw")
-        self.internal_client["nodewatts"].drop_collection("cpu")
-        self.internal_client["nodewatts"].drop_collection("profiles")
-        self.internal_client["nodewatts"].drop_collection("nodes")
-        self.internal_client["nodewatts"].drop_collection("callframes")
+        for collection in self.raw_collections:
+            self.raw.drop(collection)
+        # Left behind by the profile db service's mongoose models, which are namespaced
+        # by session like the raw collections
+        if self.internal_client is not None:
+            for collection in self.profile_service_collections:
+                if self.session_id is not None:
+                    collection += "_" + self.session_id
+                self.internal_client["nodewatts"].drop_collection(collection)
+        self.close_connections()
+
+    # Raw data collections in MongoDB of sessions whose directory under sessions_dir no
+    # longer exists: sessions that crashed before cleaning up. Sessions that are running
+    # or kept to be resumed still have their directory.
+    def drop_orphaned_raw_data(self, sessions_dir: str) -> None:
+        self.connect()
+        if self.internal_client is not None:
+            db = self.internal_client["nodewatts"]
+            try:
+                for name in db.list_collection_names():
+                    for collection in self.raw_collections + self.profile_service_collections:
+                        session_id = name[len(collection) + 1:]
+                        if name.startswith(collection + "_") and session_id \
+                                and not os.path.exists(os.path.join(sessions_dir, session_id)):
+                            logger.debug("Dropping " + name + " left behind by session " + session_id + ".")
+                            db.drop_collection(name)
+                            break
+            except pymongo.errors.PyMongoError as e:
+                raise DatabaseError("Failed to drop raw data of previous sessions. " + str(e)) from None
+        self.close_connections()
+
+    # Run at session start, once the collections have been dropped. Dropping a collection
+    # drops its indexes too. The live update indexes are shared by all sessions and
+    # creating them again is a no-op.
+    def ensure_indexes(self) -> None:
+        self.connect()
+        self._ensure_indexes(self.raw_collections)
+        if self.internal_client is not None:
+            try:
+                live = self.internal_client["nodewatts"]["live_updates"]
+                live.create_index([("session", 1), ("_id", 1)])
+                live.create_index([("time", 1)], expireAfterSeconds=86400)
+            except pymongo.errors.PyMongoError as e:
+                raise DatabaseError("Failed to create live update indexes. " + str(e)) from None
         self.close_connections()
+
+    def _ensure_indexes(self, collections: list) -> None:
+        try:
+            self.raw.ensure_indexes(collections)
+        except (RawStoreError, pymongo.errors.PyMongoError) as e:
+            raise DatabaseError("Failed to create raw data indexes. " + str(e)) from None
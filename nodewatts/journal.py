@@ -0,0 +1,113 @@
+import fcntl
+import json
+import logging
+import os
+import time
+logger = logging.getLogger("Main")
+
+
+# Append-only record of the stages a session has completed and where their outputs live,
+# kept in the session directory. Each entry is one json line, flushed and fsynced before
+# the next stage starts, so the journal survives a crash at any point. A torn last line
+# from a crash mid-write is ignored, and cut off before the next entry is written.
+# The process running a session holds the lock of its directory, see lock.
+# The first entry, "session", names the config file the session was started from.
+# Stages of a profiling run, in order:
+#   collect: the workload ran, the cpu profile and request records are saved.
+#            Outputs: profile_title, sensor_start, sensor_end.
+#   formula: the power model has processed every sensor report.
+#   engine:  the report is saved. Outputs: report_name.
+class SessionJournal:
+    stages = ["collect", "formula", "engine"]
+    file_name = "journal.jsonl"
+    lock_name = "lock"
+
+    def __init__(self, session_dir: str):
+        self.dir = session_dir
+        self.path = os.path.join(session_dir, SessionJournal.file_name)
+        self._lock = None
+        self._read()
+
+    # Entries up to the first torn or unterminated line. _end is where that line starts.
+    def _read(self) -> None:
+        self.entries = {}
+        self._end = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    self.entries[entry["stage"]] = entry
+                    self._end += len(line)
+
+    def record(self, stage: str, **outputs) -> None:
+        entry = dict(outputs, stage=stage, time=time.time())
+        line = (json.dumps(entry) + "\n").encode()
+        with open(self.path, "ab") as f:
+            # Appended to a torn line, the entry would be unreadable too
+            if f.tell() > self._end:
+                f.truncate(self._end)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._end += len(line)
+        self.entries[stage] = entry
+        logger.debug("Session journal: " + stage + " complete.")
+
+    def done(self, stage: str) -> bool:
+        return stage in self.entries
+
+    def get(self, stage: str) -> dict:
+        return self.entries[stage]
+
+    # Held by the process running or resuming the session until it exits. False if another
+    # process holds it. The journal is read again once locked, the previous holder may
+    # have recorded more stages.
+    def lock(self) -> bool:
+        lock = None
+        try:
+            lock = open(os.path.join(self.dir, SessionJournal.lock_name), "a")
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if lock is not None:
+                lock.close()
+            return False
+        self._lock = lock
+        self._read()
+        return True
+
+    @staticmethod
+    def in_use(session_dir: str) -> bool:
+        try:
+            with open(os.path.join(session_dir, SessionJournal.lock_name), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    # First stage that has not completed, None once the session is finished
+    def next_stage(self) -> str or None:
+        return next((s for s in SessionJournal.stages if not self.done(s)), None)
+
+    # Most recently started session of the given config file that captured its workload
+    # but did not finish and is not running in another process, if any
+    @staticmethod
+    def find_resumable(sessions_dir: str, config_file: str) -> str or None:
+        candidates = []
+        if not os.path.isdir(sessions_dir):
+            return None
+        for session_id in os.listdir(sessions_dir):
+            journal = SessionJournal(os.path.join(sessions_dir, session_id))
+            if not journal.done("collect") or journal.next_stage() is None:
+                continue
+            if SessionJournal.in_use(journal.dir):
+                continue
+            if journal.get("session")["config_file"] == os.path.abspath(config_file):
+                candidates.append((journal.get("session")["time"], session_id))
+        return max(candidates)[1] if candidates else None
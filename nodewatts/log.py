@@ -23,6 +23,9 @@ class ColoredFormatter(logging.Formatter):
 
 def setup_logger(verbose, name):
     logger = logging.getLogger(name)
+    # The engine may be run many times in one process, avoid stacking handlers
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
     ch = logging.StreamHandler()
     if verbose:
         logger.setLevel(logging.DEBUG)
@@ -0,0 +1,76 @@
+import pymongo
+from pymongo import MongoClient
+import logging
+import os
+import threading
+import time
+logger = logging.getLogger("Main")
+
+
+# Process wide MongoClients keyed by uri. Every NodeWatts component asks the registry for
+# its client instead of opening its own, so connections are pooled and the handshake is
+# paid once per uri rather than once per call. A client is pinged when first handed out
+# and again once health_check_interval seconds have passed since its last good ping.
+# Clients do not survive a fork, a child process starts with an empty registry.
+class ClientRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._last_ok = {}
+        self._pid = os.getpid()
+        self.configure()
+
+    # Timeouts are in milliseconds. The short server selection timeout keeps start up
+    # fast when no MongoDB is running and the embedded store is used. Clients already
+    # opened with other options are closed, the next get opens them with the new ones.
+    def configure(self, server_selection_timeout_ms=50, connect_timeout_ms=2000, socket_timeout_ms=None,
+                  max_pool_size=50, health_check_interval=30) -> None:
+        options = {
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+            "connectTimeoutMS": connect_timeout_ms,
+            "socketTimeoutMS": socket_timeout_ms,
+            "maxPoolSize": max_pool_size
+        }
+        with self._lock:
+            if options != getattr(self, "options", options) and self._pid == os.getpid():
+                for client in self._clients.values():
+                    client.close()
+                self._clients = {}
+                self._last_ok = {}
+            self.options = options
+            self.health_check_interval = health_check_interval
+
+    # Returns the shared client for uri. Raises pymongo's ServerSelectionTimeoutError
+    # when the server cannot be reached.
+    def get(self, uri: str) -> MongoClient:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._last_ok = {}
+                self._pid = os.getpid()
+            client = self._clients.get(uri)
+            if client is None:
+                client = MongoClient(uri, **self.options)
+                self._clients[uri] = client
+                logger.debug("Opened pooled mongo client for uri %s", uri)
+        if time.monotonic() - self._last_ok.get(uri, float("-inf")) > self.health_check_interval:
+            self.check(uri, client)
+        return client
+
+    def check(self, uri: str, client: MongoClient) -> None:
+        try:
+            client.admin.command("ping")
+        except pymongo.errors.PyMongoError:
+            self._last_ok.pop(uri, None)
+            raise
+        self._last_ok[uri] = time.monotonic()
+
+    def close_all(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+            self._last_ok = {}
+
+
+clients = ClientRegistry()
@@ -1,13 +1,17 @@
 from . import __version__ as nwengine_version
 from .db import EngineDB, EngineDB
-from .cpu_profile import CpuProfile
+from .cpu_profile import CpuProfile, map_source_paths
 from .error import EngineError
 from .power_profile import PowerProfile
-from .report import Report
+from .workload_profile import WorkloadProfile
+from .report import Report, WorkerProfile
+from .export_html import export_html
 from .config import Config, InvalidConfig
 from nodewatts import log
 from nodewatts.db import DatabaseError
+from nodewatts.mongo import clients
 import argparse
+import logging
 import sys
 
 
@@ -27,11 +31,18 @@ def create_cli_parser():
     parser.add_argument('--sensor_start', type=int, required=True)
     parser.add_argument('--sensor_end', type=int, required=True)
     parser.add_argument('--outlier_limit', type=int, required=True)
+    parser.add_argument('--cgroup_name', type=str, required=False, default="node")
+    parser.add_argument('--raw_store_path', type=str, required=False, default=None)
+    parser.add_argument('--session_id', type=str, required=False, default=None)
+    parser.add_argument('--snapshot_root', type=str, required=False, default=None)
+    parser.add_argument('--project_root', type=str, required=False, default=None)
+    parser.add_argument('--html_export', type=str, required=False, default=None)
     parser.add_argument('--verbose', type=bool, required=False, default=False)
     return parser
 
 
-def run_engine(args: Config or dict) -> None:
+# Returns the report as saved to the internal database
+def run_engine(args: Config or dict) -> dict:
     if not isinstance(args, Config):
         try:
             config = Config(args)
@@ -42,7 +53,8 @@ def run_engine(args: Config or dict) -> None:
         config = args
         logger = log.setup_logger(config.verbose, "Engine")
 
-    db = EngineDB(config.internal_db_uri)
+    clients.configure(**getattr(config, "db_options", {}))
+    db = EngineDB(config.internal_db_uri, config.raw_store_path, config.session_id)
     try:
         db.connect()
         if config.export_raw:
@@ -57,6 +69,8 @@ def run_engine(args: Config or dict) -> None:
         logger.error("Could not locate cpu profile data.")
         raise EngineError(None)
 
+    if config.snapshot_root is not None:
+        map_source_paths(prof_raw, config.snapshot_root, config.project_root)
     cpu = CpuProfile(prof_raw)
 
     if config.sensor_start > cpu.start_time or config.sensor_end < cpu.end_time:
@@ -67,23 +81,72 @@ def run_engine(args: Config or dict) -> None:
     power_sample_start = config.sensor_start - 2000
     power_sample_end = config.sensor_end + 2000
 
+    main_target = "/" + config.cgroup_name
     power_raw = db.get_power_samples_by_range(
-        power_sample_start, power_sample_end)
+        power_sample_start, power_sample_end, main_target)
 
     if power_raw is None:
         logger.error("Could not locate power sensor data.")
         raise EngineError(None)
 
-    power = PowerProfile(power_raw, config.outlier_limit)
-    report = Report(config.report_name, cpu, power)
+    power = PowerProfile(power_raw, config.outlier_limit, main_target)
+    workers = _load_worker_profiles(db, config, prof_raw.get("pid"), power,
+                                    power_sample_start, power_sample_end)
+
+    requests_raw = db.get_request_records(config.profile_title)
+    workload = WorkloadProfile(requests_raw) if requests_raw else None
+
+    report = Report(config.report_name, cpu, power, workload,
+                    getattr(config, "session", None), getattr(config, "window", None), workers)
     formatted = report.to_json()
     db.save_report_to_internal(formatted)
+    # insert_one sets the id of the saved report on the dict it was given
+    db.save_timeline(formatted.get("_id"), report.timeline_chunks())
+    db.add_to_catalogue(formatted, getattr(config, "project_root", None), cpu.runtime / 1e6)
 
     if config.export_raw:
         db.export_report(formatted)
+    if config.html_export is not None:
+        # The report is already saved, a failed export should not fail the run
+        try:
+            export_html(formatted, config.html_export)
+        except (OSError, EngineError) as e:
+            logger.warning("Failed to export html report: " + str(e))
 
     db.close_connections()
     logger.info("Data processing complete.")
+    return formatted
+
+
+# Cluster workers each have their own cgroup named after their pid. Worker threads share
+# the cgroup of the process they run in.
+def _load_worker_profiles(db: EngineDB, config: Config, main_pid: int, main_power: PowerProfile,
+                          start: int, end: int) -> list:
+    logger = logging.getLogger("Engine")
+    workers = []
+    powers = {main_pid: main_power}
+    for raw in db.get_worker_profiles(config.profile_title):
+        pid = raw.get("pid")
+        try:
+            if pid not in powers:
+                target = "/" + config.cgroup_name + "-" + str(pid)
+                samples = db.get_power_samples_by_range(start, end, target)
+                if not samples:
+                    logger.warning("No power estimates for worker " + str(pid) + " in cgroup " + target
+                                   + ". It was not moved to its own cgroup, so its energy is counted in the "
+                                   + "main process's and its profile is skipped.")
+                powers[pid] = PowerProfile(samples, config.outlier_limit, target) if samples else None
+            if powers[pid] is None:
+                continue
+            if config.snapshot_root is not None:
+                map_source_paths(raw, config.snapshot_root, config.project_root)
+            workers.append(WorkerProfile(pid, raw.get("threadId", 0), CpuProfile(raw), powers[pid]))
+        except (EngineError, ValueError) as e:
+            # A worker that died early should not sink the report
+            logger.warning("Skipping profile " + raw["title"] + ": " + str(e))
+    if workers:
+        logger.info("Merging " + str(len(workers)) + " worker profiles.")
+    return workers
 
 
 if __name__ == "__main__":
@@ -45,6 +45,42 @@ class Config:
                 self.verbose = False
             else:
                 self.verbose = params["verbose"]
+            if "window" not in params:
+                self.window = None
+            else:
+                self.window = params["window"]
+            if "session" not in params:
+                self.session = None
+            else:
+                self.session = params["session"]
+            if "raw_store_path" not in params:
+                self.raw_store_path = None
+            else:
+                self.raw_store_path = params["raw_store_path"]
+            if "session_id" not in params:
+                self.session_id = None
+            else:
+                self.session_id = params["session_id"]
+            if "cgroup_name" not in params:
+                self.cgroup_name = "node"
+            else:
+                self.cgroup_name = params["cgroup_name"]
+            if "snapshot_root" not in params:
+                self.snapshot_root = None
+            else:
+                self.snapshot_root = params["snapshot_root"]
+            if "project_root" not in params:
+                self.project_root = None
+            else:
+                self.project_root = params["project_root"]
+            if "db_options" not in params:
+                self.db_options = {}
+            else:
+                self.db_options = params["db_options"]
+            if "html_export" not in params:
+                self.html_export = None
+            else:
+                self.html_export = params["html_export"]
             if "outlier_limit" not in params:
                 self.outlier_limit = 85
             else:
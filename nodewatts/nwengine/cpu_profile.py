@@ -1,16 +1,34 @@
 import statistics as stat
 import networkx as nx
 import logging
+from bisect import bisect_left, bisect_right
 logger = logging.getLogger("Engine")
 
 # Sample array from profiler includes only the node id integer. This class expands it to include additional timing data.
 # node_idx provides an index into the nodes list within the profile class. 
+# run is the index of the test suite iteration the sample fell within, or None if it fell between runs.
 class Sample:
-    def __init__(self, node_idx: int, delta_to_last: int,  cum_ts: int, elapsed_time: int):
+    def __init__(self, node_idx: int, delta_to_last: int,  cum_ts: int, elapsed_time: int, run=None):
         self.node_idx = node_idx
         self.delta_to_last = delta_to_last
         self.cum_ts = cum_ts
         self.elapsed_time = elapsed_time
+        self.run = run
+
+# Identifies a function independently of the profile it came from, used to match nodes across profiles.
+def function_key(call_frame: dict) -> str:
+    return "{}@{}:{}:{}".format(call_frame.get("functionName", ""), call_frame.get("url", ""),
+                                call_frame.get("lineNumber", -1), call_frame.get("columnNumber", -1))
+
+# Rewrites script urls under source to the same path under target. Used when the server ran
+# from a snapshot of the project, so reports point at the user's files.
+def map_source_paths(prof_raw: dict, source: str, target: str) -> None:
+    for node in prof_raw["nodes"]:
+        url = node["callFrame"].get("url", "")
+        for prefix in ("", "file://"):
+            if url.startswith(prefix + source + "/"):
+                node["callFrame"]["url"] = prefix + target + url[len(prefix + source):]
+                break
 
 # Holds Node data. A Node represents a function/stack frame in the profile. 
 class ProfileNode:
@@ -19,11 +37,16 @@ class ProfileNode:
         self.children = children
         self.power_measurements = []
         self.avg_watts = 0
+        self.joules = 0
+        # Joules of the node and everything it called, set once the report is built
+        self.inclusive_joules = 0
         self.call_frame= {x: call_frame[x] for x in call_frame if x not in ["_id"]}
     
-    def append_pwr_measurement(self, measurement):
+    # interval is the time in microseconds the sample accounts for
+    def append_pwr_measurement(self, measurement, interval=0):
         self.power_measurements.append(measurement)
         self.avg_watts = stat.mean(self.power_measurements)
+        self.joules += measurement * interval / 1e6
 
 # Holds all data structures related to a cpu profile. Generates addional analytic data upon construction given a profile dictonary pulled from the db
 class CpuProfile:
@@ -36,6 +59,10 @@ class CpuProfile:
         self.node_map  = None
         self.node_dir_graph = None
         self.cpu_deltas = prof_raw["timeDeltas"]
+        # Test run boundaries reported by the runner. Profiles saved by older agents have none.
+        self.runs = sorted([r for r in prof_raw.get("runs", []) if r.get("end") is not None],
+                           key=lambda r: r["start"])
+        self._run_starts = [r["start"] for r in self.runs]
         
         #Excludes very large first delta from when profiler initializes
         self.delta_stats = {
@@ -47,6 +74,7 @@ class CpuProfile:
         
         self._generate_timeline(prof_raw)
         self._build_maps(prof_raw)
+        self._sample_ts = None
         #self._build_directed_node_graph()
         logger.debug("CPU profile processed.")
 
@@ -61,11 +89,32 @@ class CpuProfile:
             cum_ts += raw["timeDeltas"][i]
             elapsed_time += raw["timeDeltas"][i]
             self.sample_timeline.append(
-                Sample(s, raw["timeDeltas"][i], int(cum_ts), elapsed_time)
+                Sample(s, raw["timeDeltas"][i], int(cum_ts), elapsed_time, self._run_at(cum_ts))
         )
 
         self.runtime_from_deltas = elapsed_time
 
+    def _run_at(self, ts: int):
+        pos = bisect_right(self._run_starts, ts) - 1
+        if pos < 0 or ts > self.runs[pos]["end"]:
+            return None
+        return self.runs[pos]["run"]
+
+    # Whether the thread was running JS (or GC, compiling etc.) rather than idling at ts.
+    # Used to split a cgroup's power between threads of the same process.
+    def busy_at(self, ts: int, tolerance=1000) -> bool:
+        if self._sample_ts is None:
+            idle = {i for i, n in self.node_map.items() if n.call_frame.get("functionName") == "(idle)"}
+            self._sample_ts = [s.cum_ts for s in self.sample_timeline]
+            self._sample_busy = [s.node_idx not in idle for s in self.sample_timeline]
+        pos = bisect_left(self._sample_ts, ts)
+        nearest = None
+        for i in (pos - 1, pos):
+            if 0 <= i < len(self._sample_ts) and abs(self._sample_ts[i] - ts) <= tolerance:
+                if nearest is None or abs(self._sample_ts[i] - ts) < abs(self._sample_ts[nearest] - ts):
+                    nearest = i
+        return nearest is not None and self._sample_busy[nearest]
+
     # Puts profile nodes into a dictionary indexed by profilerId.
     def _build_maps(self, raw: dict) -> None:
         node_map = {}
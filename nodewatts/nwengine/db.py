@@ -1,26 +1,58 @@
 from nodewatts.db import DatabaseInterface
+from nodewatts import catalogue
 import logging
 logger = logging.getLogger("Engine")
 
 
 class EngineDB(DatabaseInterface):
-    def __init__(self, internal_uri: str):
-        super().__init__(internal_uri)
+    def __init__(self, internal_uri: str, raw_store_path: str = None, session_id: str = None):
+        super().__init__(internal_uri, raw_store_path, session_id)
 
     # internal db name is not intended to be configurable
     def get_cpu_prof_by_title(self, title: str) -> dict:
-        res = self.internal_client["nodewatts"]["profiles"].find_one({
-                                                                     "title": title})
+        res = self.raw.find_one("profiles", {"title": title})
         return res
 
-    def get_power_samples_by_range(self, start: int, end: int) -> dict:
-        res = self.internal_client["nodewatts"]["cpu"].find(
-            {"timestamp": {"$gt": start, "$lt": end}}).sort("timestamp", 1)
-        return res
+    # Profiles of cluster workers and worker threads saved under the main profile
+    def get_worker_profiles(self, title: str) -> list:
+        return self.raw.find("profiles", {"parentTitle": title})
+
+    def get_power_samples_by_range(self, start: int, end: int, target: str = None) -> list:
+        query = None if target is None else {"target": target}
+        return self.raw.find("cpu", query, start, end)
+
+    def get_request_records(self, title: str) -> list:
+        return [{k: v for k, v in r.items() if k not in ("_id", "profile_title")}
+                for r in self.raw.find("requests", {"profile_title": title})]
 
     def save_report_to_internal(self, report: dict) -> None:
+        if self.internal_client is None:
+            # Embedded store without MongoDB, e.g. in CI. The report is kept with the raw data.
+            logger.warning("No internal database available. Report saved to the embedded store at "
+                           + self.raw_store_path + ".")
+            self.raw.insert_many("reports", [report])
+            return
         self.internal_client["nodewatts"]["reports"].insert_one(report)
 
+    # Power timeline pyramid of a saved report, see timeline.py. Kept in its own
+    # collection, a long profile's timeline does not fit in the report document.
+    def save_timeline(self, report_id, chunks: list) -> None:
+        if self.internal_client is None or report_id is None:
+            logger.debug("No internal database available. Power timeline not saved.")
+            return
+        timelines = self.internal_client["nodewatts"]["timelines"]
+        timelines.create_index([("report_id", 1), ("level", 1), ("start", 1)])
+        if chunks:
+            timelines.insert_many([dict(c, report_id=report_id) for c in chunks])
+
+    # Lists a saved report in the catalogue the visualizer searches
+    def add_to_catalogue(self, report: dict, project: str = None, duration: float = None) -> None:
+        if self.internal_client is None or "_id" not in report:
+            return
+        entries = self.internal_client["nodewatts"]["catalogue"]
+        catalogue.ensure_indexes(entries)
+        catalogue.add(entries, catalogue.entry_for(report, project, duration))
+
     def export_report(self, report: dict) -> None:
         self.export_client[self.external_db_name]["nodewatts_exports"].insert_one(
             report)
@@ -0,0 +1,66 @@
+from .error import EngineError
+from bson import json_util
+from bson import ObjectId
+import base64
+import gzip
+import json
+import logging
+import os
+import re
+logger = logging.getLogger("Engine")
+
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                         "resources")
+
+PAGE = """<!doctype html><html lang="en"><head><meta charset="utf-8"/>\
+<meta name="viewport" content="width=device-width,initial-scale=1"/>\
+<title>NodeWatts - {title}</title><style>{css}</style>\
+<script id="nodewatts-options" type="application/json">{options}</script>\
+<script id="nodewatts-report" type="application/octet-stream">{report}</script>\
+<script>{loader}</script></head><body><noscript>You need to enable JavaScript to view this report.</noscript>\
+<div id="root"></div><script>{bundle}</script></body></html>
+"""
+
+
+# Inline content must not close the element it is embedded in
+def _inline(text: str, tag: str) -> str:
+    return re.sub("</(" + tag + ")", r"<\\/\1", text, flags=re.IGNORECASE)
+
+
+def _bundle_file(manifest: dict, name: str) -> str:
+    with open(os.path.join(RESOURCES, "visualizer", manifest["files"][name].lstrip("/"))) as f:
+        return f.read()
+
+
+# Writes the report as a single html file that opens in a browser without a server: the
+# visualizer bundle, a loader standing in for the server and the gzip compressed report.
+# Returns the path written. directory holds one file per report, named after it.
+def export_html(report: dict, directory: str) -> str:
+    try:
+        with open(os.path.join(RESOURCES, "visualizer", "asset-manifest.json")) as f:
+            manifest = json.load(f)
+        css = _bundle_file(manifest, "main.css")
+        bundle = _bundle_file(manifest, "main.js")
+        with open(os.path.join(RESOURCES, "export", "loader.js")) as f:
+            loader = f.read()
+    except (OSError, KeyError, ValueError) as e:
+        raise EngineError("Visualizer bundle missing, cannot export html report: " + str(e)) from None
+
+    report_id = report.get("_id", ObjectId(b"\x00" * 12))
+    data = json_util.dumps(dict(report, _id=report_id)).encode()
+    options = json.dumps([json_util.dumps({"name": report["name"], "_id": report_id})])
+    page = PAGE.format(
+        title=report["name"].replace("&", "&amp;").replace("<", "&lt;"),
+        css=_inline(css, "style"),
+        options=_inline(options, "script"),
+        report=base64.b64encode(gzip.compress(data, compresslevel=9)).decode(),
+        loader=_inline(loader, "script"),
+        bundle=_inline(bundle, "script"))
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.=,-]", "_", report["name"]) + ".html")
+    with open(path, "w") as f:
+        f.write(page)
+    logger.info("Report exported to " + path + " (" + str(len(page) // 1024) + " KB, report data "
+                + str(len(data) // 1024) + " KB before compression).")
+    return path
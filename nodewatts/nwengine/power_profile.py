@@ -15,7 +15,9 @@ class PowerSample:
 
 
 class PowerProfile:
-    def __init__(self, power_raw: dict, outlier_limit=85):
+    # target is the cgroup the estimates are for, as reported by the formula
+    def __init__(self, power_raw: dict, outlier_limit=85, target="/node"):
+        self.target = target
         self.cgroup_timeline = None
         self.cgroup_delta_stats = {}
         self._build_timelines(power_raw)
@@ -27,11 +29,11 @@ class PowerProfile:
     def _build_timelines(self, power_raw: dict) -> None:
         cgroup = []
         for item in power_raw:
-            if item["target"] == "/node":
+            if item["target"] == self.target:
                 cgroup.append(PowerSample(item))
 
         if not cgroup:
-            raise EngineError("Power profile contains no data on Node PID.")
+            raise EngineError("Power profile contains no data on target " + self.target + ".")
 
         self.cgroup_timeline = cgroup
 
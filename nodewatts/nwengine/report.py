@@ -1,5 +1,7 @@
-from .cpu_profile import CpuProfile, Sample
+from .cpu_profile import CpuProfile, Sample, function_key
 from .power_profile import PowerProfile, PowerSample
+from .workload_profile import WorkloadProfile
+from .timeline import TimelinePyramid
 from networkx.readwrite import json_graph
 from datetime import datetime
 import statistics as stat
@@ -16,6 +18,22 @@ class ProfileTick:
         self.power_sample = vars(power_sample)
 
 
+# Profile of a cluster worker process or a worker thread, merged into the main report.
+# thread_id is 0 for the main thread of a process.
+class WorkerProfile:
+    def __init__(self, pid: int, thread_id: int, cpu: CpuProfile, power: PowerProfile):
+        self.pid = pid
+        self.thread_id = thread_id
+        self.cpu = cpu
+        self.power = power
+
+    @property
+    def label(self) -> str:
+        if self.thread_id:
+            return "(worker thread " + str(self.thread_id) + " of pid " + str(self.pid) + ")"
+        return "(worker pid " + str(self.pid) + ")"
+
+
 class CategorySummary:
     def __init__(self):
         self.node_js = {}
@@ -57,9 +75,13 @@ class PathParser:
 
 
 class Report:
-    def __init__(self, name,  cpu: CpuProfile, power: PowerProfile):
+    def __init__(self, name,  cpu: CpuProfile, power: PowerProfile, workload: WorkloadProfile = None,
+                 session=None, window=None, workers: list = None):
         logger.debug("Beginning report processing.")
         self.name = name
+        # Set for reports of a single window of a continuous profiling session
+        self.session = session
+        self.window = window
         self.engine_datetime = datetime.now().isoformat()
         self.node_map = cpu.node_map
         #self.node_graph_json = json.dumps(json_graph.tree_data(cpu.node_dir_graph, root=1))
@@ -70,7 +92,27 @@ class Report:
             "cpu_deltas": cpu.delta_stats
         }
 
-        self._build_reports(cpu, power)
+        self.endpoints = []
+        # Joules per fixed width time window, filled in as samples are attributed
+        self._window_width = Report._pick_window_width(cpu.runtime)
+        self._window_joules = {}
+        workers = workers or []
+        # Profiles whose power comes from the same cgroup, i.e. threads of one process
+        sharing = {}
+        for prof_cpu, prof_power in [(cpu, power)] + [(w.cpu, w.power) for w in workers]:
+            sharing.setdefault(prof_power.target, []).append(prof_cpu)
+
+        self._build_reports(cpu, power, sharing)
+        if workers:
+            self._merge_workers(cpu, workers, sharing)
+        if workload is not None:
+            self._build_endpoint_report(workload, power)
+        self.call_tree = self._index_call_tree(min(cpu.node_map))
+        self.rollups = self._build_rollups(cpu.start_time)
+        self.flame = self._build_flame_data(min(cpu.node_map))
+        self._timeline = TimelinePyramid([s.timestamp for s in power.cgroup_timeline],
+                                         [s.power_val_watts for s in power.cgroup_timeline], cpu.start_time)
+        self.timeline = self._timeline.summary()
         logger.debug("Report built.")
 
     def _assign_to_category(self, path: str, idx: int) -> None:
@@ -96,39 +138,249 @@ class Report:
 
     # Chronogical view of report is currently disable to save processing time as it is currently
     # unused in the frontend. Remains reserved for future features.
-    def _build_reports(self, cpu_prof: CpuProfile, power_prof: PowerProfile) -> None:
+    def _build_reports(self, cpu_prof: CpuProfile, power_prof: PowerProfile, sharing: dict) -> None:
         self.stats["cpu_samples"] = cpu_prof.sample_count
         self.stats["power_estimates_pre_clean_count"] = power_prof.estimate_count
         self.stats["cleaned_estimate_count"] = len(power_prof.cgroup_timeline)
 
         #report = []
+        run_watts = {r["run"]: [] for r in cpu_prof.runs}
+        diffs, reused_cnt, total_joules = self._attribute_samples(cpu_prof, power_prof, sharing, run_watts=run_watts)
+
+        self.stats["assignments"] = {
+            "max_diff": max(diffs),
+            "min_diff": min(diffs),
+            "avg_diff": stat.mean(diffs),
+            "reused_estimates": reused_cnt
+        }
+        #self.chronological_report = report
+        self.stats["joules"] = total_joules
+        self.stats["runs"] = self._summarize_runs(cpu_prof, run_watts)
+        self.stats["power_deltas_pre_clean"] = power_prof.power_deltas
+
+    # Charges each cpu sample the power estimate nearest to it. Node ids of profiles merged
+    # into this report are shifted by offset. Returns the correlation diffs, the count of
+    # reused estimates and the joules attributed.
+    def _attribute_samples(self, cpu_prof: CpuProfile, power_prof: PowerProfile, sharing: dict,
+                           offset=0, run_watts=None):
         diffs = []
         already_assigned = []
         reused_cnt = 0
+        # The first delta covers profiler start up, cap intervals so it is not charged in full
+        max_interval = 2 * cpu_prof.delta_stats["med"]
+        total_joules = 0
+        sharing = sharing.get(power_prof.target, [cpu_prof])
         for n in cpu_prof.sample_timeline:
             power_sample = power_prof.get_nearest(n.cum_ts)
             if abs(n.cum_ts - power_sample.timestamp) <= 1000:
                 diffs.append(abs(n.cum_ts - power_sample.timestamp))
+                if run_watts is not None and n.run is not None:
+                    run_watts[n.run].append(power_sample.power_val_watts)
                 if n.cum_ts in already_assigned:
                     reused_cnt += 1
                 else:
                     already_assigned.append(power_sample.timestamp)
                 #report.append(ProfileTick(n, power_sample))
-                self.node_map[n.node_idx].append_pwr_measurement(
-                    power_sample.power_val_watts)
+                watts = power_sample.power_val_watts
+                if len(sharing) > 1:
+                    watts *= self._share(cpu_prof, sharing, n.cum_ts)
+                interval = min(n.delta_to_last, max_interval)
+                self.node_map[n.node_idx + offset].append_pwr_measurement(watts, interval)
+                total_joules += watts * interval / 1e6
+                window = n.cum_ts // self._window_width
+                self._window_joules[window] = self._window_joules.get(window, 0) + watts * interval / 1e6
                 self._assign_to_category(
-                    self.node_map[n.node_idx].call_frame["url"], n.node_idx)
+                    self.node_map[n.node_idx + offset].call_frame["url"], n.node_idx + offset)
+        return diffs, reused_cnt, total_joules
 
-        self.stats["assignments"] = {
-            "max_diff": max(diffs),
-            "min_diff": min(diffs),
-            "avg_diff": stat.mean(diffs),
-            "reused_estimates": reused_cnt
+    # Fraction of a shared cgroup's power charged to one of its threads at ts. Busy threads
+    # split it evenly, idle threads get nothing unless every thread is idle.
+    @staticmethod
+    def _share(cpu_prof: CpuProfile, sharing: list, ts: int) -> float:
+        busy = [p for p in sharing if p.busy_at(ts)]
+        if not busy:
+            return 1 / len(sharing)
+        return 1 / len(busy) if cpu_prof in busy else 0
+
+    # Adds each worker's call tree under the main root, with node ids shifted past the
+    # existing ones, and charges it with the power of the worker's own cgroup
+    def _merge_workers(self, cpu_prof: CpuProfile, workers: list, sharing: dict) -> None:
+        root = min(cpu_prof.node_map)
+        self.stats["workers"] = []
+        for w in workers:
+            offset = max(self.node_map)
+            for idx, node in w.cpu.node_map.items():
+                node.children = [c + offset for c in node.children]
+                self.node_map[idx + offset] = node
+            worker_root = min(w.cpu.node_map) + offset
+            self.node_map[worker_root].call_frame["functionName"] = w.label
+            self.node_map[root].children.append(worker_root)
+            diffs, _, joules = self._attribute_samples(w.cpu, w.power, sharing, offset)
+            self.stats["joules"] += joules
+            self.stats["workers"].append({
+                "pid": w.pid,
+                "thread_id": w.thread_id,
+                "target": w.power.target,
+                "root": worker_root,
+                "cpu_samples": w.cpu.sample_count,
+                "assigned_samples": len(diffs),
+                "joules": joules
+            })
+            logger.debug("Merged profile of " + w.label + ".")
+
+    # Indexes saved with the report so the visualizer can page through the call tree
+    # without loading the whole node map: inclusive joules on every node, each node's
+    # children ordered by them, and every node ordered by its own joules.
+    def _index_call_tree(self, root: int) -> dict:
+        order = []
+        stack = [root]
+        while stack:
+            idx = stack.pop()
+            order.append(idx)
+            stack.extend(self.node_map[idx].children)
+        for idx in reversed(order):
+            node = self.node_map[idx]
+            node.inclusive_joules = node.joules + sum(self.node_map[c].inclusive_joules for c in node.children)
+            node.children = sorted(node.children, key=lambda c: self.node_map[c].inclusive_joules, reverse=True)
+        return {
+            "root": root,
+            "by_joules": sorted((i for i in self.node_map if self.node_map[i].joules > 0),
+                                key=lambda i: self.node_map[i].joules, reverse=True)
         }
-        #self.chronological_report = report
-        self.stats["power_deltas_pre_clean"] = power_prof.power_deltas
+
+    # Flame graph data laid out by the engine, so the visualizer draws it without walking
+    # the tree. Frames are stored once in a table and referenced by index.
+    #   icicle: one row per node that used energy, in depth first order with the heaviest
+    #           children first. Columns: node id, depth, frame, x offset and width in joules
+    #           (the node's inclusive joules), and its own joules. Zero width nodes are left out.
+    #   stacks: collapsed stacks, the frames from the root to every node that used energy
+    #           itself, merged when they repeat, with their own and inclusive joules.
+    #   functions: own and inclusive joules of each frame, summed over its nodes. A node
+    #           called by the same function further up is not counted again as inclusive.
+    # Both are column oriented to keep the saved report small. Calls must already be indexed.
+    def _build_flame_data(self, root: int) -> dict:
+        frames = {}
+        icicle = {"id": [], "depth": [], "frame": [], "x": [], "width": [], "self": []}
+        stacks = {}
+        functions = {"self": [], "inclusive": []}
+        # node, depth, x offset, stack of frame indexes
+        todo = [(root, 0, 0, ())]
+        while todo:
+            idx, depth, x, parent_stack = todo.pop()
+            node = self.node_map[idx]
+            frame = frames.setdefault(function_key(node.call_frame), len(frames))
+            if frame == len(functions["self"]):
+                functions["self"].append(0)
+                functions["inclusive"].append(0)
+            functions["self"][frame] += node.joules
+            if frame not in parent_stack:
+                functions["inclusive"][frame] += node.inclusive_joules
+            stack = parent_stack + (frame,)
+            icicle["id"].append(idx)
+            icicle["depth"].append(depth)
+            icicle["frame"].append(frame)
+            icicle["x"].append(x)
+            icicle["width"].append(node.inclusive_joules)
+            icicle["self"].append(node.joules)
+            if node.joules > 0:
+                totals = stacks.setdefault(stack, [0, 0])
+                totals[0] += node.joules
+                totals[1] += node.inclusive_joules
+            # Children are ordered heaviest first, they are pushed in reverse to pop in order.
+            # The node's own joules are the space left to the right of its children.
+            child_x = x
+            placed = []
+            for c in node.children:
+                if self.node_map[c].inclusive_joules > 0:
+                    placed.append((c, depth + 1, child_x, stack))
+                    child_x += self.node_map[c].inclusive_joules
+            todo.extend(reversed(placed))
+        return {
+            "frames": list(frames),
+            "icicle": icicle,
+            "stacks": {
+                "frames": [list(stack) for stack in stacks],
+                "self": [t[0] for t in stacks.values()],
+                "inclusive": [t[1] for t in stacks.values()]
+            },
+            "functions": functions
+        }
+
+    # Narrowest multiple of 100ms that splits the profile into at most max_windows windows
+    @staticmethod
+    def _pick_window_width(runtime: int, max_windows=2000) -> int:
+        base = 100000
+        return base * max(1, -(-runtime // (base * max_windows)))
+
+    # Energy totals saved with the report so the visualizer's breakdowns do not need the
+    # node map: joules by npm package, by Node core module, by user file and by time window.
+    # Nodes without a script url (the runtime's own work, GC, idle) are counted as system.
+    def _build_rollups(self, start_time: int) -> dict:
+        rollups = {"packages": {}, "core_modules": {}, "files": {}, "system": {}}
+        for idx, node in self.node_map.items():
+            if node.joules == 0 and node.hit_count == 0:
+                continue
+            path = node.call_frame.get("url", "")
+            split = PathParser.split_path(path)
+            if path == "":
+                group, key = rollups["system"], node.call_frame.get("functionName", "")
+            elif PathParser.is_node_prefixed(split[0]):
+                group, key = rollups["core_modules"], split[0]
+            elif PathParser.is_npm_package(path):
+                group, key = rollups["packages"], PathParser.get_package_name(path)
+            else:
+                group, key = rollups["files"], path
+            total = group.setdefault(key, {"joules": 0, "hit_count": 0, "nodes": 0})
+            total["joules"] += node.joules
+            total["hit_count"] += node.hit_count
+            total["nodes"] += 1
+        first = min(self._window_joules, default=start_time // self._window_width)
+        last = max(self._window_joules, default=first)
+        rollups["time_windows"] = {
+            "start": first * self._window_width,
+            "origin": start_time,
+            "width": self._window_width,
+            "joules": [self._window_joules.get(w, 0) for w in range(first, last + 1)]
+        }
+        return rollups
+
+    # Energy per endpoint under the built-in load driver
+    def _build_endpoint_report(self, workload: WorkloadProfile, power_prof: PowerProfile) -> None:
+        workload.attribute(power_prof)
+        self.endpoints = workload.summarize()
+        self.stats["workload"] = {
+            "requests": len(workload.requests),
+            "attributed_joules": workload.attributed_joules,
+            "idle_joules": workload.idle_joules
+        }
+
+    # Per test run breakdown, used to judge how consistent the workload was between iterations
+    @staticmethod
+    def _summarize_runs(cpu_prof: CpuProfile, run_watts: dict) -> list:
+        sample_counts = {}
+        for n in cpu_prof.sample_timeline:
+            if n.run is not None:
+                sample_counts[n.run] = sample_counts.get(n.run, 0) + 1
+        summary = []
+        for r in cpu_prof.runs:
+            watts = run_watts[r["run"]]
+            summary.append({
+                "run": r["run"],
+                "start": r["start"],
+                "end": r["end"],
+                "duration": r["end"] - r["start"],
+                "samples": sample_counts.get(r["run"], 0),
+                "assigned_samples": len(watts),
+                "avg_watts": stat.mean(watts) if watts else 0
+            })
+        return summary
+
+    # Power timeline documents, saved apart from the report
+    def timeline_chunks(self) -> list:
+        return self._timeline.chunks()
 
     # Convert entire report to JSON and return for db class to save
 
     def to_json(self):
-        return json.loads(json.dumps(self, default=lambda x: x.__dict__))
+        return json.loads(json.dumps(self, default=lambda x: {k: v for k, v in x.__dict__.items()
+                                                              if not k.startswith("_")}))
@@ -0,0 +1,80 @@
+import logging
+logger = logging.getLogger("Engine")
+
+
+# Largest-Triangle-Three-Buckets downsampling of a series to threshold points. The first
+# and last points are kept, and from each bucket in between the point forming the largest
+# triangle with the point kept before it and the average of the next bucket.
+def lttb(ts: list, values: list, threshold: int) -> (list, list):
+    n = len(ts)
+    if threshold >= n or threshold < 3:
+        return list(ts), list(values)
+    out_ts = [ts[0]]
+    out_values = [values[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        if next_start >= next_end:
+            avg_t, avg_v = ts[n - 1], values[n - 1]
+        else:
+            count = next_end - next_start
+            avg_t = sum(ts[next_start:next_end]) / count
+            avg_v = sum(values[next_start:next_end]) / count
+        at, av = ts[a], values[a]
+        best, best_area = start, -1
+        for j in range(start, end):
+            area = abs((at - avg_t) * (values[j] - av) - (at - ts[j]) * (avg_v - av))
+            if area > best_area:
+                best, best_area = j, area
+        out_ts.append(ts[best])
+        out_values.append(values[best])
+        a = best
+    out_ts.append(ts[n - 1])
+    out_values.append(values[n - 1])
+    return out_ts, out_values
+
+
+# Power timeline of a report at several resolutions. Level 0 is every estimate, and each
+# level above holds 1/factor of the points of the one below, down to min_points. A query
+# for any window reads the coarsest level that still has enough points in it, so the
+# work per query does not grow with the length of the profile.
+# Levels are cut into chunks of chunk_size points, saved as separate documents so long
+# profiles stay under MongoDB's document size limit. Times are microseconds since origin.
+class TimelinePyramid:
+    def __init__(self, ts: list, watts: list, origin: int, factor=4, min_points=1000, chunk_size=20000):
+        self.origin = origin
+        self.factor = factor
+        self.chunk_size = chunk_size
+        rel = [t - origin for t in ts]
+        self.levels = [(rel, list(watts))]
+        while len(self.levels[-1][0]) > min_points:
+            prev_ts, prev_watts = self.levels[-1]
+            self.levels.append(lttb(prev_ts, prev_watts, max(min_points, len(prev_ts) // factor)))
+        logger.debug("Power timeline pyramid built with " + str(len(self.levels)) + " levels.")
+
+    # Summary saved with the report
+    def summary(self) -> dict:
+        return {
+            "origin": self.origin,
+            "factor": self.factor,
+            "levels": [{"level": i, "points": len(ts), "start": ts[0] if ts else 0, "end": ts[-1] if ts else 0}
+                       for i, (ts, _) in enumerate(self.levels)]
+        }
+
+    # Documents of the timelines collection
+    def chunks(self) -> list:
+        docs = []
+        for level, (ts, watts) in enumerate(self.levels):
+            for i in range(0, len(ts), self.chunk_size):
+                docs.append({
+                    "level": level,
+                    "start": ts[i],
+                    "end": ts[min(i + self.chunk_size, len(ts)) - 1],
+                    "t": ts[i:i + self.chunk_size],
+                    "watts": watts[i:i + self.chunk_size]
+                })
+        return docs
@@ -0,0 +1,70 @@
+from .power_profile import PowerProfile
+import statistics as stat
+import logging
+logger = logging.getLogger("Engine")
+
+
+class RequestSample:
+    def __init__(self, record_raw: dict):
+        self.endpoint = record_raw["endpoint"]
+        self.start = record_raw["start"]
+        self.end = record_raw["end"]
+        self.status = record_raw["status"]
+        self.error = record_raw.get("error")
+        self.joules = 0.0
+
+
+# Request timings recorded by the built-in load driver. Attributes the energy of each
+# power estimate interval to the requests in flight during it, split by how much of the
+# interval each request overlapped, then aggregates per endpoint.
+class WorkloadProfile:
+    def __init__(self, records_raw: list):
+        self.requests = sorted([RequestSample(r) for r in records_raw], key=lambda r: r.start)
+        self.attributed_joules = 0.0
+        self.idle_joules = 0.0
+        logger.debug("Workload profile processed.")
+
+    def attribute(self, power: PowerProfile) -> None:
+        timeline = power.cgroup_timeline
+        # Gaps left by dropped outliers or missed sensor ticks are not charged to anyone
+        max_interval = 2 * power.cgroup_delta_stats["med"]
+        active = []
+        nxt = 0
+        for prev, cur in zip(timeline, timeline[1:]):
+            lo, hi = prev.timestamp, cur.timestamp
+            if hi - lo <= 0 or hi - lo > max_interval:
+                continue
+            while nxt < len(self.requests) and self.requests[nxt].start < hi:
+                active.append(self.requests[nxt])
+                nxt += 1
+            active = [r for r in active if r.end > lo]
+            joules = cur.power_val_watts * (hi - lo) / 1e6
+            overlaps = [(r, min(r.end, hi) - max(r.start, lo)) for r in active]
+            overlaps = [(r, o) for r, o in overlaps if o > 0]
+            total = sum(o for _, o in overlaps)
+            if total == 0:
+                self.idle_joules += joules
+                continue
+            for r, o in overlaps:
+                r.joules += joules * o / total
+            self.attributed_joules += joules
+
+    def summarize(self) -> list:
+        by_endpoint = {}
+        for r in self.requests:
+            by_endpoint.setdefault(r.endpoint, []).append(r)
+        summary = []
+        for name, reqs in by_endpoint.items():
+            latencies = sorted([(r.end - r.start) / 1000 for r in reqs])
+            joules = sum(r.joules for r in reqs)
+            summary.append({
+                "endpoint": name,
+                "requests": len(reqs),
+                "errors": len([r for r in reqs if r.error is not None or r.status >= 500]),
+                "joules": joules,
+                "joules_per_request": joules / len(reqs),
+                "avg_latency_ms": stat.mean(latencies),
+                "p95_latency_ms": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            })
+        summary.sort(key=lambda e: e["joules"], reverse=True)
+        return summary
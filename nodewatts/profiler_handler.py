@@ -1,10 +1,14 @@
 
 from nodewatts.config import NWConfig
-from nodewatts.subprocess_manager import NWSubprocessError, NWSubprocessTimeout, SubprocessManager
+from nodewatts.subprocess_manager import NWSubprocessError, NWSubprocessTimeout, AsyncSubprocessManager
 from nodewatts.error import NodewattsError
+from nodewatts.workload import load_records
+from nodewatts.continuous import Window
+from nodewatts.snapshot import ProjectSnapshot, SnapshotError
 
 import os
 import shutil
+import shlex
 import json
 import logging
 from datetime import datetime
@@ -12,6 +16,10 @@ from typing import Tuple
 import time
 import subprocess
 import pwd
+import asyncio
+import psutil
+import signal
+import sys
 logger = logging.getLogger("Main")
 
 # Note:
@@ -29,24 +37,43 @@ class ProfilerInitError(NodewattsError):
 
 
 class ProfilerHandler():
-    def __init__(self, conf: NWConfig, manager: SubprocessManager):
+    def __init__(self, conf: NWConfig, manager: AsyncSubprocessManager):
         self.root = conf.root_path
+        self.entry_file = conf.entry_file
         self.entry_full_path = os.path.join(conf.root_path, conf.entry_file)
         self.entry_basepath, self.entry_filename = self._parse_entry_filepath(
                                         self.entry_full_path
                                     )
         self.commands = conf.commands
+        self.workload = conf.workload
+        self.request_records_path = None
         self.profile_title = datetime.now().isoformat()
         self.tmp_path = None
+        self.session_id = conf.session_id
         self.socket_port = conf.profiler_port
         self.proc_manager = manager
         self.profiler_env_vars = {}
         self.es6 = conf.es6
         self.test_runs = conf.test_runs
         self.server_process = None
+        self.server_pid = None
+        # Called with the pid of each cluster worker, see follow_workers
+        self._on_worker = None
+        self._workers_read = 0
         self.test_runner_timeout = conf.test_runner_timeout
         self.deps_installed = False
+        # Batch mode shares the database service between entries, and keeps the project's
+        # aliased dependencies installed when the next entry profiles the same project
+        self.db_service_dir = None
+        self.reuse_deps = False
+        self.keep_deps = False
         self.code_injected = False
+        # With a snapshot the server runs from a copy-on-write view of the project, which
+        # takes every change in place of the project itself
+        self.snapshot = None
+        if conf.snapshot is not None:
+            self.snapshot = ProjectSnapshot(conf.root_path, conf.snapshot["dir"], conf.entry_file,
+                                            conf.snapshot["max_age_days"])
         self.fail_code = None
         self.user = conf.user
         self.aliased_npm_requirements = [
@@ -59,18 +86,26 @@ class ProfilerHandler():
         self.aliased_npm_requirements = [
             "nw-zeromq@npm:zeromq@6.0.0-beta.6", "nw-prof@npm:v8-profiler-next"]
 
+        self.profiler_env_vars.update(conf.env)
         self.profiler_env_vars["PATH_TO_DB_SERVICE"] = None
         self.profiler_env_vars["PROFILE_TITLE"] = self.profile_title
         self.profiler_env_vars["TEST_SOCKET_PORT"] = str(self.socket_port)
-        self.profiler_env_vars["TESTCMD"] = self.commands["runTests"]
-        self.profiler_env_vars["ZMQ_INSTALLED_PATH"] = os.path.join(
-            self.root, "node_modules/nw-zeromq")
+        self.profiler_env_vars["TESTCMD"] = self.commands.get("runTests")
+        self.profiler_env_vars["TEST_RUNS"] = str(self.test_runs)
+        if conf.v8_sampling_interval is not None:
+            self.profiler_env_vars["V8_SAMPLING_INTERVAL"] = str(conf.v8_sampling_interval)
+        self._use_project_root(self.root)
+        self.profiler_env_vars["NODEWATTS_THREAD_AGENT"] = os.path.join(
+            self._profiler_scripts_root, "thread-agent.js")
         if conf.engine_conf_args["internal_db_uri"][-1] == "/":
             self.profiler_env_vars["NODEWATTS_DB_URI"] = conf.engine_conf_args["internal_db_uri"] + "nodewatts"
         else:
             self.profiler_env_vars["NODEWATTS_DB_URI"] = conf.engine_conf_args["internal_db_uri"] + "/nodewatts"
         
         self.profiler_env_vars["NODEWATTS_TMP_PATH"] = None
+        self.profiler_env_vars["NODEWATTS_SESSION_ID"] = self.session_id
+        if conf.raw_store_path is not None:
+            self.profiler_env_vars["NODEWATTS_RAW_STORE"] = conf.raw_store_path
 
         if conf.use_nvm:
             if not conf.override_nvm_path:
@@ -88,10 +123,10 @@ class ProfilerHandler():
         # Replicate what appdir does to get user writable data file location
         pw_record = pwd.getpwnam(self.user)
         homedir = pw_record.pw_dir
-        self.tmp_path = os.path.join(homedir,'.local','share','nodewatts')
+        self.tmp_path = os.path.join(homedir,'.local','share','nodewatts', self.session_id)
         if not os.path.exists(self.tmp_path):
             try:
-                os.mkdir(self.tmp_path)
+                os.makedirs(self.tmp_path)
                 os.chmod(self.tmp_path, 0o777)
             except OSError as e:
                 logger.error("Failed to create temporary data directory in user space. Message: " +str(e))
@@ -105,15 +140,44 @@ class ProfilerHandler():
                 logger.error("Failed to create temporary data directory in user space. Message: " +str(e))
                 raise ProfilerInitError(None)
         self.profiler_env_vars["NODEWATTS_TMP_PATH"] = self.tmp_path
-        self._setup_db_service()
-        self._save_copy_of_entry_file()
+        if self.workload is not None:
+            # Paths may hold spaces, the runner reads the arguments from TESTCMD_ARGS
+            cmd = self._workload_command()
+            self.profiler_env_vars["TESTCMD"] = shlex.join(cmd)
+            self.profiler_env_vars["TESTCMD_ARGS"] = json.dumps(cmd)
+        if self.snapshot is not None:
+            try:
+                self._use_project_root(self.snapshot.prepare())
+            except SnapshotError:
+                raise ProfilerInitError(None) from None
+        else:
+            self._save_copy_of_entry_file()
         self._inject_profiler_script()
-        self._install_npm_dependencies()
+        asyncio.run(self._install_all_dependencies())
+
+    # Points every project path at root, which is either the project or its snapshot
+    def _use_project_root(self, root: str) -> None:
+        self.root = root
+        self.entry_full_path = os.path.join(root, self.entry_file)
+        self.entry_basepath, self.entry_filename = self._parse_entry_filepath(self.entry_full_path)
+        self.proc_manager.project_root = root
+        self.proc_manager.entry_path = self.entry_full_path
+        self.profiler_env_vars["ZMQ_INSTALLED_PATH"] = os.path.join(root, "node_modules/nw-zeromq")
+        # Worker threads load the thread agent from outside the project, so resolve the profiler for it
+        self.profiler_env_vars["PROFILER_INSTALLED_PATH"] = os.path.join(root, "node_modules/nw-prof")
+
+    # The db service and project installs touch unrelated directories, so run them concurrently.
+    async def _install_all_dependencies(self) -> None:
+        await asyncio.gather(self._setup_db_service(), self._install_npm_dependencies())
 
     # Starts the web server process. Performs necessary cleanup and exits pacakge in case of 
     # failure. Safe to call directly. Return the PID of the server if successful
     def start_server(self) -> int:
         logger.debug("Starting cpu profiler.")
+        # Left by the previous entry of a batch, which shares the session directory
+        workers_file = os.path.join(self.tmp_path, "workers.txt")
+        if os.path.exists(workers_file):
+            os.remove(workers_file)
         self.server_process = self.proc_manager.project_process_async(
                 "echo \"Running server with node version: $(which node)\" && "
                 + self.commands["serverStart"], custom_env=self.profiler_env_vars, 
@@ -151,36 +215,210 @@ class ProfilerHandler():
         logger.debug("Server started successfully")
         with open(os.path.join(self.tmp_path, "PID.txt")) as f:
             pid = f.read()
+        self.server_pid = int(pid)
         return pid
 
-    # Runs provided test suite three times or cleans up and exits in case of failure
+    # Hands on_worker the pid of each cluster worker forked by the server, as reported by
+    # the agent. Workers are usually forked right after start up, so give them a moment to
+    # come online. Workers forked later, e.g. to replace one that died, are handed over as
+    # they are reported while the test suite or the window runner runs.
+    def follow_workers(self, on_worker, settle=1.0) -> None:
+        time.sleep(settle)
+        pids = self._new_worker_pids()
+        if pids:
+            logger.info("Server runs " + str(len(pids)) + " cluster workers. Profiling each separately.")
+        for pid in pids:
+            on_worker(pid)
+        self._on_worker = on_worker
+
+    def _poll_workers(self) -> None:
+        if self._on_worker is None:
+            return
+        for pid in self._new_worker_pids():
+            logger.info("Server forked cluster worker " + str(pid) + ". Profiling it separately.")
+            self._on_worker(pid)
+
+    # Pids appended to the workers file since it was last read. A line still being written
+    # is read on the next call.
+    def _new_worker_pids(self) -> list:
+        try:
+            with open(os.path.join(self.tmp_path, "workers.txt"), "rb") as f:
+                f.seek(self._workers_read)
+                data = f.read()
+        except OSError:
+            return []
+        data = data[:data.rfind(b"\n") + 1]
+        self._workers_read += len(data)
+        return [int(pid) for pid in data.split()]
+
+    def set_sampling_interval(self, interval: int) -> None:
+        self.profiler_env_vars["V8_SAMPLING_INTERVAL"] = str(interval)
+
+    # Profiles a single run of the test suite under the given title and V8 sampling interval.
+    # Returns the wall time and the CPU time the server consumed over the run, in seconds.
+    def calibration_run(self, title: str, interval: int) -> Tuple[float, float]:
+        env = dict(self.profiler_env_vars)
+        env.update({"RUN_TITLE": title, "V8_SAMPLING_INTERVAL": str(interval), "TEST_RUNS": "1"})
+        cmd = "node " + os.path.join(self._profiler_scripts_root, "test-runner.js")
+        server = psutil.Process(self.server_pid)
+        cpu_before, wall_before = self._cpu_seconds(server), time.monotonic()
+        try:
+            asyncio.run(self._supervise(self.proc_manager.project_process(
+                cmd, custom_env=env, timeout=self.test_runner_timeout, inject_to_path=self.nvm_path,
+                on_stdout=logger.debug, on_stderr=logger.debug)))
+        except (NWSubprocessError, NWSubprocessTimeout) as e:
+            logger.error("Calibration run failed. Error: \n" + str(e))
+            raise ProfilerException(None)
+        return (time.monotonic() - wall_before, self._cpu_seconds(server) - cpu_before)
+
+    @staticmethod
+    def _cpu_seconds(proc: psutil.Process) -> float:
+        total = 0.0
+        for p in [proc] + proc.children(recursive=True):
+            try:
+                times = p.cpu_times()
+                total += times.user + times.system
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    # Runs provided test suite the configured number of times or cleans up and exits in case of failure.
+    # A single runner process executes every iteration over one profiler connection and reports
+    # the boundaries of each run to the agent, which saves them with the profile.
     def run_test_suite(self) -> None:
         logger.info("Running tests. This may take a moment.")
-        for i in range(0,self.test_runs):
-            logger.debug("Test Run " + str(i+1))
-            cmd = "node " + \
-                os.path.join(self._profiler_scripts_root, "test-runner.js")
-            if self.server_process.poll() is None:
-                if i == self.test_runs - 1:
-                    self.profiler_env_vars["FINAL_RUN"] = "true"
-                try:
-                    stdout, stderr = self.proc_manager.project_process_blocking(
-                        cmd, custom_env=self.profiler_env_vars, timeout=self.test_runner_timeout, inject_to_path=self.nvm_path)
-                    logger.debug("Test Suite run successfully: \n" +
-                                "stdout: \n" + stdout + "stderr: \n" + stderr)
-                except NWSubprocessError as e:
-                    logger.error("Failed to run test suite. Error: \n" + str(e))
-                    raise ProfilerException(None)
-                except NWSubprocessTimeout as e:
-                    logger.error("Test suite process timeout out in " + str(self.test_runner_timeout) +
-                                " seconds." + "If you believe the provided test suite requires longer than this" +
-                                " to sucessfully complete, please configure the \"dev-testRunnerTimeout\" " +
-                                "setting in the config file as necessary. \n" + "Test runner output before timeout: \n" + str(e))
-                    raise ProfilerException(None)
+        asyncio.run(self._run_test_suite())
+
+    async def _run_test_suite(self) -> None:
+        cmd = "node " + \
+            os.path.join(self._profiler_scripts_root, "test-runner.js")
+        # dev-testRunnerTimeout applies to each iteration of the suite
+        timeout = self.test_runner_timeout * self.test_runs
+        if self.server_process.poll() is not None:
+            logger.error("Web server encounted an error. Exited with return code: " +
+                            str(self.server_process.returncode))
+            raise ProfilerException(None)
+        try:
+            stdout, stderr = await self._supervise(self.proc_manager.project_process(
+                cmd, custom_env=self.profiler_env_vars, timeout=timeout, inject_to_path=self.nvm_path,
+                on_stdout=self._log_runner_output, on_stderr=logger.debug))
+            logger.debug("Test Suite run successfully.")
+        except NWSubprocessError as e:
+            logger.error("Failed to run test suite. Error: \n" + str(e))
+            raise ProfilerException(None)
+        except NWSubprocessTimeout as e:
+            logger.error("Test suite process timeout out in " + str(timeout) +
+                        " seconds." + "If you believe the provided test suite requires longer than " +
+                        str(self.test_runner_timeout) + " seconds per run to sucessfully complete, please " +
+                        "configure the \"dev-testRunnerTimeout\" setting in the config file as necessary. \n" +
+                        "Test runner output before timeout: \n" + str(e))
+            raise ProfilerException(None)
+
+    # Continuous mode. The window runner rotates the cpu profile every window_seconds and
+    # reports each saved window, which is handed to on_window in a worker thread while the
+    # next window is captured. Runs for duration seconds, or until SIGINT/SIGTERM, after
+    # which the window in progress is closed and every captured window is processed.
+    def run_windows(self, window_seconds: int, duration, on_window) -> None:
+        logger.info("Profiling in windows of " + str(window_seconds) + " seconds. "
+                    + ("Press Ctrl+C to stop." if duration is None else "Running for " + str(duration) + " seconds."))
+        asyncio.run(self._run_windows(window_seconds, duration, on_window))
+
+    async def _run_windows(self, window_seconds: int, duration, on_window) -> None:
+        loop = asyncio.get_running_loop()
+        windows = asyncio.Queue()
+        env = dict(self.profiler_env_vars)
+        env["WINDOW_SECONDS"] = str(window_seconds)
+        if duration is not None:
+            env["WINDOW_DURATION"] = str(duration)
+        cmd = "node " + os.path.join(self._profiler_scripts_root, "window-runner.js")
+
+        def on_stdout(line: str) -> None:
+            window = Window.from_runner_line(line)
+            if window is not None:
+                windows.put_nowait(window)
             else:
+                logger.debug(line)
+
+        async def consume() -> None:
+            while True:
+                window = await windows.get()
+                if window is None:
+                    return
+                await loop.run_in_executor(None, on_window, window)
+
+        if self.server_process.poll() is not None:
+            logger.error("Web server encounted an error. Exited with return code: " +
+                            str(self.server_process.returncode))
+            raise ProfilerException(None)
+        runner = await self.proc_manager.spawn_project_process(
+            cmd, custom_env=env, inject_to_path=self.nvm_path)
+
+        def request_stop(_, __) -> None:
+            logger.info("Stop requested. Finishing current window.")
+            loop.call_soon_threadsafe(self.proc_manager.signal_process_group, runner, signal.SIGTERM)
+
+        previous = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+        consumer = asyncio.ensure_future(consume())
+        try:
+            await self._supervise(self.proc_manager.communicate(
+                runner, cmd, on_stdout=on_stdout, on_stderr=logger.debug))
+        except NWSubprocessError as e:
+            consumer.cancel()
+            logger.error("Window runner failed. Error: \n" + str(e))
+            raise ProfilerException(None)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+        windows.put_nowait(None)
+        await consumer
+
+    # Progress lines from the runner are surfaced to the user, everything else is debug output
+    @staticmethod
+    def _log_runner_output(line: str) -> None:
+        if line.startswith("Runner: Run "):
+            logger.info(line[len("Runner: "):])
+        else:
+            logger.debug(line)
+
+    # Awaits the given job while polling the web server. If the server dies first the job
+    # is cancelled, which tears down its process tree, instead of waiting out its timeout.
+    # Cluster workers forked in the meantime are handed over, see follow_workers.
+    async def _supervise(self, job, poll_interval=0.5):
+        task = asyncio.ensure_future(job)
+        while not task.done():
+            self._poll_workers()
+            if self.server_process.poll() is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
                 logger.error("Web server encounted an error. Exited with return code: " +
                                 str(self.server_process.returncode))
                 raise ProfilerException(None)
+            await asyncio.wait({task}, timeout=poll_interval)
+        return task.result()
+
+    # The runner executes the built-in load driver as its test command, once per run.
+    # Each run appends its request records to the same file in the temp directory.
+    def _workload_command(self) -> list:
+        self.request_records_path = os.path.join(self.tmp_path, "requests.jsonl")
+        cmd = [sys.executable, "-m", "nodewatts.workload",
+               "--scenario", self.workload["scenario_file"],
+               "--out", self.request_records_path,
+               "--concurrency", str(self.workload["concurrency"]),
+               "--rate", str(self.workload["rate"])]
+        if self.workload["requests"] is not None:
+            cmd.extend(["--requests", str(self.workload["requests"])])
+        if self.workload["duration"] is not None:
+            cmd.extend(["--duration", str(self.workload["duration"])])
+        return cmd
+
+    # Request timings recorded by the built-in load driver, empty if it was not used
+    def load_request_records(self) -> list:
+        if self.request_records_path is None:
+            return []
+        return load_records(self.request_records_path)
 
     def _inject_profiler_script(self, ES6=False) -> None:
         logger.debug("Injecting profiler code to entry file.")
@@ -203,9 +441,13 @@ class ProfilerHandler():
             f.write(script)
         self.code_injected = True
 
-    def _setup_db_service(self):
+    async def _setup_db_service(self):
         logger.info("Setting up NodeWatts Database Service...")
-        dest_path = os.path.join(self.tmp_path, 'nodewatts_cpu_profile_db')
+        dest_path = self.db_service_dir or os.path.join(self.tmp_path, 'nodewatts_cpu_profile_db')
+        if self.db_service_dir is not None and os.path.exists(os.path.join(dest_path, "node_modules")):
+            logger.debug("Reusing database service installed at " + dest_path)
+            self.profiler_env_vars["PATH_TO_DB_SERVICE"] = os.path.join(dest_path, 'src/main/index.js')
+            return
         if not os.path.exists(dest_path):
             try:
                 shutil.copytree(self._db_service_root, dest_path)
@@ -214,7 +456,7 @@ class ProfilerHandler():
                 raise ProfilerException(None)
         os.chmod(dest_path, 0o777)
         try:
-            stdout, stderr = self.proc_manager.generic_user_process_blocking("npm install", cwd=dest_path, inject_to_path=self.nvm_path)
+            stdout, stderr = await self.proc_manager.generic_user_process("npm install", cwd=dest_path, inject_to_path=self.nvm_path)
         except NWSubprocessError as e:
                     logger.error("Failed to install database service dependencies. Error: \n" + str(e))
                     raise ProfilerException(None)
@@ -245,12 +487,17 @@ class ProfilerHandler():
 
     # Installs required package versions that are aliased to avoid collisions if
     # user is already making use of the packages in the project
-    def _install_npm_dependencies(self) -> None:
+    async def _install_npm_dependencies(self) -> None:
+        if self.reuse_deps and all(os.path.exists(os.path.join(self.root, "node_modules", alias))
+                                   for alias in ["nw-zeromq", "nw-prof"]):
+            logger.debug("Reusing npm dependencies installed by the previous batch entry.")
+            self.deps_installed = True
+            return
         logger.info("Installing npm dependencies. This may take a moment.")
         cmd = "npm i -D " + \
             " ".join(self.aliased_npm_requirements)
         try:
-            stdout, stderr = self.proc_manager.project_process_blocking(cmd, inject_to_path=self.nvm_path)
+            stdout, stderr = await self.proc_manager.project_process(cmd, inject_to_path=self.nvm_path)
         except NWSubprocessError as e:
             logger.error("Failed to install npm dependencies. Error:" + str(e))
             raise ProfilerInitError(None)
@@ -305,9 +552,10 @@ class ProfilerHandler():
 
     def cleanup(self) -> None:
         logger.debug("Cleaning up project directory.")
-        if self.code_injected:
+        # A snapshot is reset from the project on its next use, and keeps the installed packages
+        if self.code_injected and self.snapshot is None:
             self._restore_entry_file()
-        if self.deps_installed:
+        if self.deps_installed and not self.keep_deps and self.snapshot is None:
             self._uninstall_npm_dependencies()
         if self.server_process is not None:
             if self.server_process.poll() is None:
@@ -315,4 +563,9 @@ class ProfilerHandler():
             else:
                 logger.debug("Unexpected server exit with return code: " + str(self.server_process.poll()))
                 self._log_server_output()
-                self.fail_code = self.server_process.poll()
\ No newline at end of file
+                self.fail_code = self.server_process.poll()
+        if self.snapshot is not None:
+            self.snapshot.release()
+        # The entry file backup has been restored by now, the rest of the session's files can go
+        if self.tmp_path is not None and os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
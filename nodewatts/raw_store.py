@@ -0,0 +1,499 @@
+from nodewatts.error import NodewattsError
+
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+logger = logging.getLogger("Main")
+
+
+class RawStoreError(NodewattsError):
+    def __init__(self, msg, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+# Field each raw collection is ordered by. Documents of other collections are indexed at 0.
+TIMESTAMP_FIELDS = {
+    "sensor_raw": "timestamp",
+    "cpu": "timestamp",
+    "profiles": "startTime",
+    "requests": "start",
+}
+
+# Indexes of the raw MongoDB collections. Power and sensor data are loaded by target over a
+# time range, and the formula and window pruning go by time alone.
+MONGO_INDEXES = {
+    "sensor_raw": [[("target", 1), ("timestamp", 1)], [("timestamp", 1)]],
+    "cpu": [[("target", 1), ("timestamp", 1)], [("timestamp", 1)]],
+    "profiles": [[("title", 1)], [("parentTitle", 1)]],
+    "requests": [[("profile_title", 1), ("start", 1)]],
+}
+
+
+# Storage for the raw data of a session: sensor reports, power estimates, cpu profiles and
+# request records. Queries are limited to what NodeWatts needs, equality on fields plus an
+# exclusive range on the collection's timestamp field.
+class RawStore:
+    def insert_many(self, collection: str, docs: list) -> None:
+        raise NotImplementedError()
+
+    # Sorted by timestamp
+    def find(self, collection: str, query: dict = None, start: int = None, end: int = None,
+             projection: list = None) -> list:
+        raise NotImplementedError()
+
+    def find_one(self, collection: str, query: dict) -> dict or None:
+        raise NotImplementedError()
+
+    def count(self, collection: str, query: dict = None) -> int:
+        raise NotImplementedError()
+
+    def latest_timestamp(self, collection: str) -> int or None:
+        raise NotImplementedError()
+
+    def delete(self, collection: str, query: dict) -> None:
+        raise NotImplementedError()
+
+    def delete_before(self, collection: str, timestamp: int) -> None:
+        raise NotImplementedError()
+
+    def drop(self, collection: str) -> None:
+        raise NotImplementedError()
+
+    # Creates any missing indexes of the given collections and verifies they exist
+    def ensure_indexes(self, collections: list) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+# Collections of a session are suffixed with its id, e.g. "cpu_<session_id>"
+class MongoRawStore(RawStore):
+    def __init__(self, db, session_id: str = None):
+        self.db = db
+        self.session_id = session_id
+
+    def _c(self, collection: str):
+        return self.db[collection if self.session_id is None else collection + "_" + self.session_id]
+
+    def insert_many(self, collection: str, docs: list) -> None:
+        if docs:
+            self._c(collection).insert_many(docs)
+
+    def find(self, collection: str, query: dict = None, start: int = None, end: int = None,
+             projection: list = None) -> list:
+        field = TIMESTAMP_FIELDS.get(collection, "_id")
+        query = dict(query or {})
+        if start is not None or end is not None:
+            bounds = {}
+            if start is not None:
+                bounds["$gt"] = start
+            if end is not None:
+                bounds["$lt"] = end
+            query[field] = bounds
+        proj = None if projection is None else dict({"_id": 0}, **{k: 1 for k in projection})
+        return list(self._c(collection).find(query, proj).sort(field, 1))
+
+    def find_one(self, collection: str, query: dict) -> dict or None:
+        return self._c(collection).find_one(query)
+
+    def count(self, collection: str, query: dict = None) -> int:
+        if not query:
+            return self._c(collection).estimated_document_count()
+        return self._c(collection).count_documents(query)
+
+    def latest_timestamp(self, collection: str) -> int or None:
+        field = TIMESTAMP_FIELDS[collection]
+        doc = self._c(collection).find_one({}, {field: 1}, sort=[(field, -1)])
+        return None if doc is None else doc[field]
+
+    def delete(self, collection: str, query: dict) -> None:
+        self._c(collection).delete_many(query)
+
+    def delete_before(self, collection: str, timestamp: int) -> None:
+        self._c(collection).delete_many({TIMESTAMP_FIELDS[collection]: {"$lt": timestamp}})
+
+    def drop(self, collection: str) -> None:
+        self._c(collection).drop()
+
+    def ensure_indexes(self, collections: list) -> None:
+        for collection in collections:
+            coll = self._c(collection)
+            for keys in MONGO_INDEXES.get(collection, []):
+                coll.create_index(keys)
+            present = {tuple(tuple(k) for k in info["key"]) for info in coll.index_information().values()}
+            for keys in MONGO_INDEXES.get(collection, []):
+                if tuple(keys) not in present:
+                    raise RawStoreError("Index " + str(keys) + " missing on collection " + coll.name)
+        logger.debug("Verified raw data indexes of " + ", ".join(collections) + ".")
+
+
+# Payload length, timestamp, crc32 of the payload
+RECORD_HEADER = struct.Struct("<IqI")
+# Timestamp, segment number, offset of the record in the segment
+INDEX_ENTRY = struct.Struct("<qIQ")
+
+
+# One collection of the embedded store: a directory of append-only segments. Every writer
+# process (or thread) appends to segments of its own, "<writer>-<n>.seg", so writers never
+# contend. Records are framed JSON with a checksum, a torn record at the end of a segment
+# is either still being written or was cut off by a crash and is not read.
+# The timestamp index is built by scanning the segments and is saved next to them so a
+# reopened store only scans what was appended since.
+class SegmentCollection:
+    segment_bytes = 64 * 1024 * 1024
+
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+        self.field = TIMESTAMP_FIELDS.get(name)
+        self.segments = []
+        self.scanned = {}
+        self.seg_max = {}
+        self.timestamps = []
+        self.entries = []
+        self.watermark = None
+        self.deleted = set()
+        self._readers = {}
+        # Open segment of each writer, by writer name
+        self._writers = {}
+        self._dirty = False
+        os.makedirs(path, exist_ok=True)
+        # The agent appends profiles as the project's user
+        os.chmod(path, 0o777)
+        self._load()
+
+    # Writing
+    def append(self, docs: list) -> None:
+        writer = None
+        for doc in docs:
+            payload = json.dumps(doc, default=str).encode()
+            ts = int(doc.get(self.field, 0)) if self.field else 0
+            writer = self._writer_file(RECORD_HEADER.size + len(payload))
+            writer.write(RECORD_HEADER.pack(len(payload), ts, zlib.crc32(payload)) + payload)
+        if writer is not None:
+            writer.flush()
+
+    # Named like the agent's segments (segment-store.js): the pid, plus the thread for
+    # threads other than the main one
+    @staticmethod
+    def _writer_name() -> str:
+        if threading.current_thread() is threading.main_thread():
+            return str(os.getpid())
+        return str(os.getpid()) + "." + str(threading.get_native_id())
+
+    # A writer opening the collection appends to its latest segment, never to a name that
+    # was removed by delete_before, whose records would be taken as already removed
+    def _first_segment(self, writer: str) -> int:
+        def numbers(names):
+            return [int(n[:-4].rsplit("-", 1)[1]) for n in names
+                    if n.endswith(".seg") and n[:-4].rsplit("-", 1)[0] == writer]
+        present = numbers(os.listdir(self.path))
+        removed = numbers(n for n, offset in self.scanned.items() if offset is None)
+        if present and max(present) > max(removed, default=-1):
+            return max(present)
+        return max(removed, default=-1) + 1
+
+    def _writer_file(self, size: int):
+        name = self._writer_name()
+        seg, f = self._writers.get(name, (None, None))
+        if f is not None and f.tell() + size <= self.segment_bytes:
+            return f
+        if f is not None:
+            f.close()
+        n = self._first_segment(name) if seg is None else int(seg[:-4].rsplit("-", 1)[1]) + 1
+        seg = name + "-" + str(n) + ".seg"
+        f = open(os.path.join(self.path, seg), "ab")
+        self._writers[name] = (seg, f)
+        return f
+
+    # Reading
+    def refresh(self) -> None:
+        names = sorted(n for n in os.listdir(self.path) if n.endswith(".seg"))
+        self._forget_removed(set(names))
+        for name in names:
+            if name not in self.scanned:
+                self.segments.append(name)
+                self.scanned[name] = 0
+            if self.scanned[name] is not None:
+                self._scan(name)
+
+    def _scan(self, name: str) -> None:
+        seg_no = self.segments.index(name)
+        path = os.path.join(self.path, name)
+        offset = self.scanned[name]
+        if os.path.getsize(path) <= offset:
+            return
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, ts, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                self._add_entry(ts, seg_no, offset)
+                self.seg_max[name] = max(self.seg_max.get(name, ts), ts)
+                offset += RECORD_HEADER.size + length
+        self.scanned[name] = offset
+        self._dirty = True
+
+    def _add_entry(self, ts: int, seg_no: int, offset: int) -> None:
+        if not self.timestamps or ts >= self.timestamps[-1]:
+            self.timestamps.append(ts)
+            self.entries.append((ts, seg_no, offset))
+        else:
+            pos = bisect_right(self.timestamps, ts)
+            self.timestamps.insert(pos, ts)
+            self.entries.insert(pos, (ts, seg_no, offset))
+
+    def _read(self, seg_no: int, offset: int) -> dict:
+        name = self.segments[seg_no]
+        f = self._readers.get(name)
+        if f is None:
+            f = self._readers[name] = open(os.path.join(self.path, name), "rb")
+        f.seek(offset)
+        length, _, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        return json.loads(f.read(length))
+
+    def find(self, query: dict = None, start: int = None, end: int = None) -> list:
+        self.refresh()
+        lo = 0 if start is None else bisect_right(self.timestamps, start)
+        hi = len(self.entries) if end is None else bisect_left(self.timestamps, end)
+        if self.watermark is not None:
+            lo = max(lo, bisect_left(self.timestamps, self.watermark))
+        res = []
+        for ts, seg_no, offset in self.entries[lo:hi]:
+            if (self.segments[seg_no], offset) in self.deleted:
+                continue
+            doc = self._read(seg_no, offset)
+            if query and any(doc.get(k) != v for k, v in query.items()):
+                continue
+            res.append(doc)
+        return res
+
+    def count(self, query: dict = None) -> int:
+        if query:
+            return len(self.find(query))
+        self.refresh()
+        lo = 0 if self.watermark is None else bisect_left(self.timestamps, self.watermark)
+        count = len(self.entries) - lo
+        if self.deleted:
+            # Deleted records below the watermark are already left out
+            count -= sum((self.segments[seg_no], offset) in self.deleted for _, seg_no, offset in self.entries[lo:])
+        return count
+
+    def locate(self, query: dict) -> list:
+        self.refresh()
+        found = []
+        for _, seg_no, offset in self.entries:
+            if (self.segments[seg_no], offset) in self.deleted:
+                continue
+            doc = self._read(seg_no, offset)
+            if all(doc.get(k) == v for k, v in query.items()):
+                found.append((self.segments[seg_no], offset))
+        return found
+
+    def latest_timestamp(self) -> int or None:
+        self.refresh()
+        if not self.timestamps or (self.watermark is not None and self.timestamps[-1] < self.watermark):
+            return None
+        return self.timestamps[-1]
+
+    # Deleting. Records are never rewritten, deletions are kept in the collection's state
+    # and whole segments are removed once everything in them is below the watermark.
+    def delete(self, query: dict) -> None:
+        self.deleted.update(self.locate(query))
+        self._dirty = True
+        self.save()
+
+    def delete_before(self, timestamp: int) -> None:
+        self.refresh()
+        self.watermark = timestamp if self.watermark is None else max(self.watermark, timestamp)
+        latest = {}
+        for name in self.segments:
+            writer, n = name[:-4].rsplit("-", 1)
+            latest[writer] = max(latest.get(writer, -1), int(n))
+        for name in list(self.segments):
+            writer, n = name[:-4].rsplit("-", 1)
+            # A writer's latest segment may still be appended to
+            if int(n) == latest[writer] or self.seg_max.get(name, timestamp) >= timestamp:
+                continue
+            self._remove_segment(name)
+        self._dirty = True
+        self.save()
+
+    def _remove_segment(self, name: str) -> None:
+        os.remove(os.path.join(self.path, name))
+        self._forget_segment(name)
+
+    # Segments removed by another process sharing the store
+    def _forget_removed(self, present: set) -> None:
+        for name in self.segments:
+            if self.scanned[name] is not None and name not in present:
+                self._forget_segment(name)
+                self._dirty = True
+
+    def _forget_segment(self, name: str) -> None:
+        seg_no = self.segments.index(name)
+        if name in self._readers:
+            self._readers.pop(name).close()
+        # Segment numbers in the index refer to positions in self.segments, keep them stable
+        # by leaving the slot in place with no entries pointing at it
+        keep = [i for i, e in enumerate(self.entries) if e[1] != seg_no]
+        self.entries = [self.entries[i] for i in keep]
+        self.timestamps = [self.timestamps[i] for i in keep]
+        self.deleted = {d for d in self.deleted if d[0] != name}
+        self.scanned[name] = None
+
+    # Persistence of the index. Every process using the store saves the state of the
+    # collection, under a lock on the directory. Deletions and the watermark of other
+    # processes are merged in first, and segments they removed are forgotten.
+    @contextmanager
+    def _locked(self, mode: int):
+        with open(os.path.join(self.path, "state.lock"), "a") as lock:
+            fcntl.flock(lock, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        with self._locked(fcntl.LOCK_EX):
+            saved = self._read_state()
+            if saved is not None:
+                state, _ = saved
+                if state["watermark"] is not None:
+                    self.watermark = state["watermark"] if self.watermark is None \
+                        else max(self.watermark, state["watermark"])
+                self.deleted.update(tuple(d) for d in state["deleted"]
+                                    if os.path.exists(os.path.join(self.path, d[0])))
+            self._forget_removed({n for n in os.listdir(self.path) if n.endswith(".seg")})
+            state = {
+                "segments": self.segments,
+                "scanned": self.scanned,
+                "seg_max": self.seg_max,
+                "watermark": self.watermark,
+                "deleted": sorted(self.deleted)
+            }
+            self._write_atomic("index.bin", b"".join(INDEX_ENTRY.pack(*e) for e in self.entries))
+            self._write_atomic("state.json", json.dumps(state).encode())
+        self._dirty = False
+
+    # Temporary files are unique to the writer so concurrent saves never share one
+    def _write_atomic(self, name: str, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(self.path, name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _read_state(self) -> (dict, bytes) or None:
+        state_path = os.path.join(self.path, "state.json")
+        index_path = os.path.join(self.path, "index.bin")
+        if not os.path.exists(state_path) or not os.path.exists(index_path):
+            return None
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            with open(index_path, "rb") as f:
+                raw = f.read()
+        except (OSError, ValueError) as e:
+            # The index is only a cache of the segments, rebuild it
+            logger.debug("Rebuilding index of raw collection " + self.name + ": " + str(e))
+            return None
+        return state, raw
+
+    def _load(self) -> None:
+        with self._locked(fcntl.LOCK_SH):
+            saved = self._read_state()
+        if saved is None:
+            return
+        state, raw = saved
+        self.segments = state["segments"]
+        self.scanned = state["scanned"]
+        self.seg_max = state["seg_max"]
+        self.watermark = state["watermark"]
+        self.deleted = {tuple(d) for d in state["deleted"]}
+        self.entries = list(INDEX_ENTRY.iter_unpack(raw))
+        self.timestamps = [e[0] for e in self.entries]
+
+    def close(self) -> None:
+        for _, f in self._writers.values():
+            f.close()
+        self._writers = {}
+        for f in self._readers.values():
+            f.close()
+        self._readers = {}
+        self.save()
+
+
+# Embedded, file backed store used instead of MongoDB for raw data. Each collection is a
+# subdirectory of path.
+class SegmentStore(RawStore):
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            os.makedirs(path, exist_ok=True)
+            os.chmod(path, 0o777)
+        except OSError as e:
+            raise RawStoreError("Failed to create raw data store at " + path + ": " + str(e)) from None
+        self.collections = {}
+
+    def _collection(self, name: str) -> SegmentCollection:
+        if name not in self.collections:
+            self.collections[name] = SegmentCollection(os.path.join(self.path, name), name)
+        return self.collections[name]
+
+    def insert_many(self, collection: str, docs: list) -> None:
+        self._collection(collection).append(docs)
+
+    def find(self, collection: str, query: dict = None, start: int = None, end: int = None,
+             projection: list = None) -> list:
+        docs = self._collection(collection).find(query, start, end)
+        if projection is not None:
+            docs = [{k: d[k] for k in projection if k in d} for d in docs]
+        return docs
+
+    def find_one(self, collection: str, query: dict) -> dict or None:
+        docs = self._collection(collection).find(query)
+        return docs[0] if docs else None
+
+    def count(self, collection: str, query: dict = None) -> int:
+        return self._collection(collection).count(query)
+
+    def latest_timestamp(self, collection: str) -> int or None:
+        return self._collection(collection).latest_timestamp()
+
+    def delete(self, collection: str, query: dict) -> None:
+        self._collection(collection).delete(query)
+
+    def delete_before(self, collection: str, timestamp: int) -> None:
+        self._collection(collection).delete_before(timestamp)
+
+    def drop(self, collection: str) -> None:
+        coll = self.collections.pop(collection, None)
+        if coll is not None:
+            coll.close()
+        shutil.rmtree(os.path.join(self.path, collection), ignore_errors=True)
+
+    def close(self) -> None:
+        for coll in self.collections.values():
+            coll.close()
+        self.collections = {}
@@ -22,10 +22,12 @@ class SensorHandler():
         self.end_time = None
         self.nodewatts_root = conf.package_root
         
-    def start_sensor(self) -> None:
+    # config_path overrides the session's sensor config, used for calibration runs
+    def start_sensor(self, config_path=None) -> None:
         logger.debug("Starting hardware sensor.")
         self.start_time = round(time.monotonic_ns()/1000)
-        cmd = "resources/bin/nodewatts-hwpc-sensor --config-file "+ self.config_path
+        if config_path is None: config_path = self.config_path
+        cmd = "resources/bin/nodewatts-hwpc-sensor --config-file "+ config_path
         self.sensor_process = self.proc_manager.nodewatts_process_async(cmd)
         time.sleep(2.0)
         for i in range(0,3):
@@ -54,6 +56,17 @@ class SensorHandler():
         self.proc_manager.terminate_process_tree(self.sensor_process.pid)
         self._log_sensor_output()
 
+    # Stops a healthy sensor so it can be started again, e.g. between calibration runs
+    def stop_sensor(self) -> None:
+        if self.sensor_process is None:
+            return
+        if self.sensor_process.poll() is not None:
+            logger.error("Unexpected sensor exit with return code: " + str(self.sensor_process.poll()))
+            self._log_sensor_output()
+            raise SensorException(None)
+        self._shutdown_sensor()
+        self.sensor_process = None
+
     def cleanup(self):
         if self.sensor_process is not None:
             if self.sensor_process.poll() is None:
@@ -1,21 +1,81 @@
 from nodewatts.db import DatabaseError
+from nodewatts.raw_store import SegmentStore
 from smartwatts.__main__ import run_smartwatts, SmartwattsRuntimeException
+from powerapi.database.base_db import BaseDB, DBError
 from nodewatts.error import NodewattsError
 from nodewatts.config import NWConfig
 from nodewatts.db import Database
+import copy
 import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
 logger = logging.getLogger("Main")
 
 class SmartwattsError(NodewattsError):
     def __init__(self, msg, *args, **kwargs):
         super().__init__(msg, *args, **kwargs)   
 
+
+# Output database of the formula for the embedded raw data store. It cannot be read by
+# a puller, validate_smartwatts_config rejects it as an input.
+class SegmentDB(BaseDB):
+    def __init__(self, report_type, directory: str, collection: str):
+        BaseDB.__init__(self, report_type)
+        self.directory = directory
+        self.collection = collection
+        self.store = None
+
+    def connect(self):
+        self.store = SegmentStore(self.directory)
+
+    def iter(self, stream_mode: bool):
+        raise DBError("The embedded raw data store (\"segment\") can only be a formula output, not an input")
+
+    def save(self, report):
+        self.store.insert_many(self.collection, [self.report_type.to_mongodb(report)])
+
+    def save_many(self, reports: list):
+        self.store.insert_many(self.collection, [self.report_type.to_mongodb(r) for r in reports])
+
+
+def _segment_db_factory(db_config: dict) -> SegmentDB:
+    return SegmentDB(db_config["model"], db_config["directory"], db_config["collection"])
+
+
+# Entry point of the streaming formula process. Terminating it must only stop the
+# actors, the NodeWatts term handler belongs to the parent process.
+def _run_stream_formula(config: dict) -> None:
+    def on_terminate(_, __):
+        sys.exit(0)
+    try:
+        run_smartwatts(config, direct_call=True, on_terminate=on_terminate,
+                       db_factories={"segment": _segment_db_factory})
+    except SmartwattsRuntimeException as e:
+        logger.error("An error occured while running smartwatts formula. Message: " + str(e))
+        sys.exit(1)
+
+
 class SmartwattsHandler():
     def __init__(self, config: NWConfig, db: Database):
         self.config = config.smartwatts_config
         if config.sw_verbose:
             self.config["verbose"] = True
         self.db = db
+        self.stream_process = None
+        self.socket_port = None
+        # With the embedded raw store the sensor streams to the formula over a socket and
+        # estimates are appended to the store. The config file itself is left untouched.
+        if config.raw_store_path is not None:
+            self.socket_port = config.sensor_socket_port
+            self.config["input"] = {"puller": {"model": "HWPCReport", "type": "socket",
+                                               "port": self.socket_port}}
+            self.config["output"] = {"pusher_power": {"model": "PowerReport", "type": "segment",
+                                                      "directory": config.raw_store_path,
+                                                      "collection": "cpu"}}
     
     def run_formula(self):
         logger.info("Computing process power model. This may take several minutes...")
@@ -27,7 +87,7 @@ class SmartwattsHandler():
             logger.error(str(e))
             raise SmartwattsError(None) from None
         try:
-            run_smartwatts(self.config, direct_call=True)
+            run_smartwatts(self.config, direct_call=True, db_factories={"segment": _segment_db_factory})
         except SmartwattsRuntimeException as e:
             #Expected when sigint or sigterm while smartwatts is running
             if e is None:
@@ -36,8 +96,72 @@ class SmartwattsHandler():
                 logger.error("An error occured while running smartwatts formula. Message: " + str(e))
                 raise SmartwattsError(None)
         logger.info("Power modelling complete.")
-        
-        
 
-        
+    # Runs the formula in stream mode in a child process. The puller consumes sensor reports
+    # as they are written, so power estimates are produced while data is still being collected.
+    def start_stream(self) -> None:
+        logger.debug("Starting streaming power model.")
+        # run_smartwatts normalises the config in place, so each run gets its own copy
+        conf = copy.deepcopy(self.config)
+        conf["stream"] = True
+        self.stream_process = multiprocessing.Process(target=_run_stream_formula, args=(conf,))
+        self.stream_process.start()
+        if self.socket_port is not None:
+            self._wait_for_socket()
+
+    # The sensor only retries its connection every few seconds, so have the puller listening first
+    def _wait_for_socket(self, timeout=30) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.stream_alive():
+                break
+            try:
+                socket.create_connection(("127.0.0.1", self.socket_port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        logger.error("Streaming power model did not start listening for sensor reports.")
+        raise SmartwattsError(None)
+
+    # Once the sensor has stopped, waits for the streaming formula to consume the reports
+    # still in sensor_raw and for its estimates to stop advancing, then shuts it down.
+    def finish_stream(self, timeout=300, settle=1.0) -> None:
+        logger.info("Waiting for power model to process remaining sensor data.")
+        deadline = time.monotonic() + timeout
+        last = None
+        try:
+            while True:
+                if not self.stream_alive():
+                    logger.error("Streaming power model exited unexpectedly. Run again with "
+                                 + "\"dev-enableSmartWattsLogs\" to inspect the error.")
+                    raise SmartwattsError(None)
+                latest = self.db.latest_power_timestamp()
+                if self.db.pending_sensor_reports() == 0 and latest is not None and latest == last:
+                    break
+                if time.monotonic() > deadline:
+                    logger.error("Power model did not catch up with the sensor in " + str(timeout) + " seconds.")
+                    raise SmartwattsError(None)
+                last = latest
+                time.sleep(settle)
+        except DatabaseError as e:
+            logger.error(str(e))
+            raise SmartwattsError(None) from None
+        self.stop_stream()
+        logger.info("Power modelling complete.")
+
+    def stream_alive(self) -> bool:
+        return self.stream_process is not None and self.stream_process.is_alive()
+
+    def stop_stream(self, timeout=10) -> None:
+        if not self.stream_alive():
+            return
+        logger.debug("Stopping streaming power model.")
+        os.kill(self.stream_process.pid, signal.SIGTERM)
+        self.stream_process.join(timeout)
+        if self.stream_process.is_alive():
+            logger.warning("Streaming power model did not shut down in time. Killing process.")
+            self.stream_process.kill()
+            self.stream_process.join()
 
+    def cleanup(self) -> None:
+        self.stop_stream()
@@ -0,0 +1,232 @@
+from nodewatts.error import NodewattsError
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+logger = logging.getLogger("Main")
+
+
+class SnapshotError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+# Copy-on-write view of the user's project that the server is run from, so profiling never
+# writes to the project itself. An overlay mount is used when possible: the project is the
+# read-only lower layer and every write (the injected entry file, installed packages) lands
+# in an upper layer in tmpfs. Otherwise the project is copied into tmpfs.
+# Snapshots are kept between sessions. On each prepare the project is scanned, and only
+# files whose mtime or size changed since the last session, plus the files NodeWatts
+# edits, are refreshed. Packages installed by the previous session stay in place.
+# Snapshots not used for max_age_days are removed when any snapshot is prepared.
+class ProjectSnapshot:
+    manifest_name = "manifest.json"
+    # Edited by NodeWatts during a session, always reset to the project's copy
+    edited_files = ["package.json", "package-lock.json"]
+
+    def __init__(self, source: str, base_dir: str, entry_file: str, max_age_days: float = 7):
+        self.source = os.path.abspath(source)
+        self.base_dir = base_dir
+        self.max_age_days = max_age_days
+        self.dir = ProjectSnapshot.snapshot_dir(source, base_dir)
+        self.root = os.path.join(self.dir, "tree")
+        self.upper = os.path.join(self.dir, "upper")
+        self.work = os.path.join(self.dir, "work")
+        self.edited = set(ProjectSnapshot.edited_files + [os.path.normpath(entry_file)])
+        self.mounted = False
+        self._lock = None
+
+    # Snapshots are keyed by project path, so the server always runs from the same directory
+    @staticmethod
+    def snapshot_dir(source: str, base_dir: str) -> str:
+        key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:12]
+        return os.path.join(base_dir, key)
+
+    @staticmethod
+    def root_for(source: str, base_dir: str) -> str:
+        return os.path.join(ProjectSnapshot.snapshot_dir(source, base_dir), "tree")
+
+    # Brings the snapshot up to date with the project and returns its root
+    def prepare(self) -> str:
+        os.makedirs(self.dir, exist_ok=True)
+        os.chmod(os.path.dirname(self.dir), 0o755)
+        self._acquire_lock()
+        ProjectSnapshot.evict(self.base_dir, self.max_age_days)
+        # Left mounted by a session that crashed
+        if os.path.ismount(self.root):
+            subprocess.run(["umount", "-l", self.root], capture_output=True)
+        manifest = self._load_manifest()
+        current = self._scan(self.source)
+        previous = manifest.get("files", {})
+        changed = {rel for rel in current.keys() | previous.keys() if current.get(rel) != previous.get(rel)}
+        changed |= self.edited
+        mode = manifest.get("mode")
+        # Once overlays have failed for a snapshot it stays a copy
+        if mode != "copy":
+            try:
+                if mode != "overlay":
+                    self._reset()
+                self._refresh_upper(changed)
+                self._mount()
+                mode = "overlay"
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.debug("Overlay snapshot unavailable, copying the project instead. " + str(e))
+                self._reset()
+                mode = None
+        if mode != "overlay":
+            try:
+                self._sync_copy(current, previous if mode == "copy" else {}, changed)
+            except OSError as e:
+                self.release()
+                logger.error("Failed to snapshot project. Error: " + str(e))
+                raise SnapshotError(None) from None
+            mode = "copy"
+        logger.debug("Project snapshot ready at " + self.root + " (" + mode + ", "
+                     + str(len(changed - self.edited)) + " changed files).")
+        with open(os.path.join(self.dir, ProjectSnapshot.manifest_name), "w") as f:
+            json.dump({"mode": mode, "files": current}, f)
+        return self.root
+
+    def release(self) -> None:
+        if self.mounted:
+            try:
+                subprocess.run(["umount", self.root], check=True, capture_output=True)
+            except subprocess.CalledProcessError:
+                # The server may still hold files open, detach it instead
+                subprocess.run(["umount", "-l", self.root], capture_output=True)
+            self.mounted = False
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    # Removes the snapshots under base_dir whose last session is older than max_age_days.
+    # Snapshots in use hold their lock and are skipped. The manifest is rewritten by every
+    # session, its mtime is the last use.
+    @staticmethod
+    def evict(base_dir: str, max_age_days: float) -> None:
+        cutoff = time.time() - max_age_days * 86400
+        try:
+            names = os.listdir(base_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(base_dir, name)
+            manifest = os.path.join(path, ProjectSnapshot.manifest_name)
+            try:
+                last_used = os.path.getmtime(manifest if os.path.exists(manifest) else path)
+                if last_used >= cutoff or not os.path.isdir(path):
+                    continue
+                with open(os.path.join(path, "lock"), "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    root = os.path.join(path, "tree")
+                    if os.path.ismount(root):
+                        subprocess.run(["umount", "-l", root], capture_output=True)
+                    # Never delete through a mount, that would reach the project
+                    if os.path.ismount(root):
+                        continue
+                    shutil.rmtree(path)
+            except OSError:
+                continue
+            logger.debug("Removed snapshot " + path + ", unused for more than "
+                         + str(max_age_days) + " days.")
+
+    # Two sessions profiling the same project at once cannot share a snapshot
+    def _acquire_lock(self) -> None:
+        self._lock = open(os.path.join(self.dir, "lock"), "w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock.close()
+            self._lock = None
+            logger.error("The snapshot of " + self.source + " is in use by another NodeWatts session.")
+            raise SnapshotError(None) from None
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.dir, ProjectSnapshot.manifest_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _reset(self) -> None:
+        for path in (self.root, self.upper, self.work):
+            if os.path.ismount(path):
+                subprocess.run(["umount", "-l", path], capture_output=True)
+            shutil.rmtree(path, ignore_errors=True)
+        manifest = os.path.join(self.dir, ProjectSnapshot.manifest_name)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+
+    # Files and symlinks of the project by relative path, with their mtime and size
+    @staticmethod
+    def _scan(source: str) -> dict:
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(source):
+            rel_dir = os.path.relpath(dirpath, source)
+            # Symlinked directories are not followed, they are snapshotted as links
+            for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                st = os.lstat(os.path.join(dirpath, name))
+                files[os.path.normpath(os.path.join(rel_dir, name))] = [st.st_mtime_ns, st.st_size]
+        return files
+
+    # Upper layer entries shadowing changed project files are dropped so the new
+    # version shows through. Whiteouts of changed files are dropped the same way.
+    # The merged root takes its owner and mode from the upper directory, which is given
+    # the project's so the project user can write at the root (npm, the server).
+    def _refresh_upper(self, changed: set) -> None:
+        for path in (self.upper, self.work, self.root):
+            os.makedirs(path, exist_ok=True)
+        st = os.stat(self.source)
+        os.chown(self.upper, st.st_uid, st.st_gid)
+        os.chmod(self.upper, st.st_mode & 0o7777)
+        for rel in changed:
+            path = os.path.join(self.upper, rel)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def _mount(self) -> None:
+        options = "lowerdir=" + self.source + ",upperdir=" + self.upper + ",workdir=" + self.work
+        subprocess.run(["mount", "-t", "overlay", "overlay", "-o", options, self.root],
+                       check=True, capture_output=True)
+        self.mounted = True
+
+    # Files written in the copy (the injected entry file, package.json) get a new mtime,
+    # which is how they are found and reset. Files that only exist in the copy, such as
+    # installed packages, are left alone.
+    def _sync_copy(self, current: dict, previous: dict, changed: set) -> None:
+        for dirpath, dirnames, _ in os.walk(self.source):
+            dest = os.path.join(self.root, os.path.relpath(dirpath, self.source))
+            if not os.path.isdir(dest) or os.path.islink(dest):
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.makedirs(dest)
+                shutil.copystat(dirpath, dest)
+                st = os.stat(dirpath)
+                os.chown(dest, st.st_uid, st.st_gid)
+        for rel in previous.keys() - current.keys():
+            path = os.path.join(self.root, rel)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.remove(path)
+        for rel, (mtime, _) in current.items():
+            src = os.path.join(self.source, rel)
+            dest = os.path.join(self.root, rel)
+            if rel not in changed and os.path.lexists(dest) and os.lstat(dest).st_mtime_ns == mtime:
+                continue
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                shutil.rmtree(dest)
+            elif os.path.lexists(dest):
+                os.remove(dest)
+            st = os.lstat(src)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dest)
+                os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+            else:
+                shutil.copy2(src, dest)
+            os.chown(dest, st.st_uid, st.st_gid, follow_symlinks=False)
@@ -2,10 +2,12 @@ import os
 import subprocess
 import logging
 import pwd
+import signal
+import asyncio
 from typing import Tuple
 from psutil import Process
 import psutil
-from typing import Dict
+from typing import Callable, Dict, List
 
 from nodewatts.error import NodewattsError
 from nodewatts.config import NWConfig
@@ -28,7 +30,10 @@ class SubprocessManager():
         self.nodewatts_root = NWConfig.package_root
         self.entry_path = os.path.join(conf.root_path, conf.entry_file)
         self.shell = conf.subprocess_shell_path
-        
+        # Keyed by username. The passwd lookup and copy of the root environment
+        # only need to happen once per session rather than once per command.
+        self._user_env_cache = {}
+
     @staticmethod
     def demote_child(user_uid, user_gid):
         def result():
@@ -48,17 +53,25 @@ class SubprocessManager():
             env.update(env_vars)
         return (env, user_uid, user_gid)
 
+    # Cached equivalent of prep_user_process. Returns a fresh copy of the
+    # demoted user's environment so callers are free to mutate it.
+    def user_env(self, username: str, cwd: str, env_vars=None, inject_to_path=None) -> Tuple[Dict[str, str], int, int]:
+        if username not in self._user_env_cache:
+            self._user_env_cache[username] = self.prep_user_process(username, cwd)
+        base, uid, gid = self._user_env_cache[username]
+        env = dict(base)
+        env['PWD'] = cwd
+        if env_vars:
+            env.update(env_vars)
+        if inject_to_path:
+            env["PATH"] += os.pathsep + inject_to_path
+        return (env, uid, gid)
+
     # Execute a blocking commmand in the target Node project's root directory as the provided non-root user.
     # Raises SubprocessError if non zero return code, otherwise returns output of process
     # Used mainly for handling npm dependecies required by the tool
     def project_process_blocking(self, cmd: str, custom_env=None, timeout=None, inject_to_path=None) -> Tuple[str, str]:
-        if custom_env:
-            env, uid, gid = self.prep_user_process(self.project_user, self.project_root, custom_env)
-        else:
-            env, uid, gid = self.prep_user_process(self.project_user, self.project_root)
-
-        if inject_to_path:
-            env["PATH"] += os.pathsep + inject_to_path
+        env, uid, gid = self.user_env(self.project_user, self.project_root, custom_env, inject_to_path)
         try:
             proc = subprocess.run(cmd, shell=True, capture_output=True, check=True, preexec_fn=self.demote_child(uid,gid), 
             start_new_session=True, cwd=self.project_root, text=True, executable=self.shell, env=env, timeout=timeout)
@@ -83,12 +96,7 @@ class SubprocessManager():
     # running others jobs that depend on it.
 
     def project_process_async(self, cmd: str, custom_env=None, inject_to_path=None) -> subprocess.Popen:
-        if custom_env:
-            env, uid, gid = self.prep_user_process(self.project_user, self.project_root, custom_env)
-        else:
-            env, uid, gid = self.prep_user_process(self.project_user, self.project_root)
-        if inject_to_path:
-            env["PATH"] += os.pathsep + inject_to_path
+        env, uid, gid = self.user_env(self.project_user, self.project_root, custom_env, inject_to_path)
         return subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT, env=env, preexec_fn=self.demote_child(uid,gid), 
                                 cwd=self.project_root, text=True, executable=self.shell, start_new_session=True)
@@ -112,9 +120,7 @@ class SubprocessManager():
             return (proc.stdout, proc.stderr)    
 
     def generic_user_process_blocking(self, cmd:str, cwd, inject_to_path=None) -> Tuple[str, str]:
-        env, uid, gid = self.prep_user_process(self.project_user, cwd)
-        if inject_to_path:
-            env["PATH"] += os.pathsep + inject_to_path
+        env, uid, gid = self.user_env(self.project_user, cwd, inject_to_path=inject_to_path)
         try:
             proc = subprocess.run(cmd, shell=True, capture_output=True, check=True, preexec_fn=self.demote_child(uid,gid), 
                         start_new_session=True, cwd=cwd, text=True, executable=self.shell, env=env, timeout=20)
@@ -143,4 +149,120 @@ class SubprocessManager():
         parent = Process(pid)
         for child in parent.children(recursive=True):
             child.kill()
-        parent.kill()
\ No newline at end of file
+        parent.kill()
+
+# Asyncio backend. Mirrors the blocking helpers above but streams stdout and stderr
+# concurrently as they are produced, so long running commands (test runner, npm)
+# can be logged live and supervised alongside the web server from a single event loop.
+# Every child is started in its own session, so on timeout or cancellation the whole
+# process group is torn down and reaped rather than leaving orphans or zombies behind.
+class AsyncSubprocessManager(SubprocessManager):
+    def __init__(self, conf: NWConfig, kill_grace_period=5.0):
+        super().__init__(conf)
+        self.kill_grace_period = kill_grace_period
+
+    async def spawn_project_process(self, cmd: str, custom_env=None, inject_to_path=None) -> asyncio.subprocess.Process:
+        env, uid, gid = self.user_env(self.project_user, self.project_root, custom_env, inject_to_path)
+        return await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
+                                stderr=asyncio.subprocess.PIPE, env=env, preexec_fn=self.demote_child(uid,gid),
+                                cwd=self.project_root, executable=self.shell, start_new_session=True)
+
+    async def spawn_user_process(self, cmd: str, cwd: str, inject_to_path=None) -> asyncio.subprocess.Process:
+        env, uid, gid = self.user_env(self.project_user, cwd, inject_to_path=inject_to_path)
+        return await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
+                                stderr=asyncio.subprocess.PIPE, env=env, preexec_fn=self.demote_child(uid,gid),
+                                cwd=cwd, executable=self.shell, start_new_session=True)
+
+    async def spawn_nodewatts_process(self, cmd: str, cwd=None) -> asyncio.subprocess.Process:
+        if cwd is None: cwd = self.nodewatts_root
+        return await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
+                                stderr=asyncio.subprocess.PIPE, cwd=cwd, executable=self.shell,
+                                start_new_session=True)
+
+    # Coroutine equivalents of the *_process_blocking methods. Same error semantics:
+    # NWSubprocessError on non-zero exit and NWSubprocessTimeout when the timeout expires.
+    # on_stdout/on_stderr are called with each decoded line as soon as it is read.
+    async def project_process(self, cmd: str, custom_env=None, timeout=None, inject_to_path=None,
+                              on_stdout=None, on_stderr=None) -> Tuple[str, str]:
+        proc = await self.spawn_project_process(cmd, custom_env, inject_to_path)
+        return await self.communicate(proc, cmd, timeout, on_stdout, on_stderr)
+
+    async def generic_user_process(self, cmd: str, cwd, inject_to_path=None, timeout=20,
+                                   on_stdout=None, on_stderr=None) -> Tuple[str, str]:
+        proc = await self.spawn_user_process(cmd, cwd, inject_to_path)
+        return await self.communicate(proc, cmd, timeout, on_stdout, on_stderr)
+
+    async def nodewatts_process(self, cmd: str, cwd=None, timeout=None,
+                                on_stdout=None, on_stderr=None) -> Tuple[str, str]:
+        proc = await self.spawn_nodewatts_process(cmd, cwd)
+        return await self.communicate(proc, cmd, timeout, on_stdout, on_stderr)
+
+    async def communicate(self, proc: asyncio.subprocess.Process, cmd: str, timeout=None,
+                          on_stdout: Callable[[str], None] = None,
+                          on_stderr: Callable[[str], None] = None) -> Tuple[str, str]:
+        out, err = [], []
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                self._drain(proc.stdout, out, on_stdout),
+                self._drain(proc.stderr, err, on_stderr),
+                proc.wait()), timeout=timeout)
+        except asyncio.TimeoutError:
+            await self.stop_process_group(proc, self.kill_grace_period)
+            raise NWSubprocessTimeout(
+                "stdout dump: \n" + "".join(out) + " \n stderr dump: \n" + "".join(err)) from None
+        except asyncio.CancelledError:
+            await asyncio.shield(self.stop_process_group(proc, self.kill_grace_period))
+            raise
+        if proc.returncode != 0:
+            raise NWSubprocessError("Command: " + cmd + " failed with exit code " + str(proc.returncode)
+                                    + " \nstdout dump: \n" + "".join(out) + " \n stderr dump: \n" + "".join(err))
+        return ("".join(out), "".join(err))
+
+    @staticmethod
+    async def _drain(stream: asyncio.StreamReader, sink: List[str], callback=None) -> None:
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            decoded = line.decode('utf-8', errors='replace')
+            sink.append(decoded)
+            if callback is not None:
+                callback(decoded.rstrip('\n'))
+
+    @staticmethod
+    def signal_process_group(proc: asyncio.subprocess.Process, sig: int) -> None:
+        if proc.returncode is not None:
+            return
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    # SIGTERM to the process group, escalating to SIGKILL after the grace period.
+    # Descendants are collected up front so those that left the group are not missed.
+    # Always waits on the child so it is reaped.
+    @staticmethod
+    async def stop_process_group(proc: asyncio.subprocess.Process, grace_period=5.0) -> None:
+        if proc.returncode is not None:
+            return
+        try:
+            descendants = Process(proc.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            descendants = []
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=grace_period)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        for child in descendants:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
@@ -0,0 +1,98 @@
+from nodewatts.error import NodewattsError
+from bson import ObjectId
+from pymongo.collection import Collection
+
+
+class BreakdownError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+GROUPS = ["packages", "core_modules", "files", "system"]
+
+# Groups each node of a report the way the engine's rollups do, for reports saved before
+# rollups existed: [group, name] for every node that was sampled.
+_CLASSIFY_PIPELINE = [
+    {"$project": {"nodes": {"$objectToArray": "$node_map"}}},
+    {"$unwind": "$nodes"},
+    {"$project": {
+        "url": {"$ifNull": ["$nodes.v.call_frame.url", ""]},
+        "function_name": "$nodes.v.call_frame.functionName",
+        "joules": "$nodes.v.joules",
+        "hit_count": "$nodes.v.hit_count"
+    }},
+    {"$match": {"$or": [{"joules": {"$gt": 0}}, {"hit_count": {"$gt": 0}}]}},
+    {"$project": {
+        "joules": 1,
+        "hit_count": 1,
+        "key": {"$let": {
+            "vars": {
+                "core": {"$regexFind": {"input": "$url", "regex": "^(node:[^/]*)"}},
+                "pkg": {"$regexFind": {"input": "$url", "regex": "(?:^|/)node_modules/([^/]*)"}}
+            },
+            "in": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$url", ""]}, "then": ["system", "$function_name"]},
+                    {"case": {"$ne": ["$$core", None]},
+                     "then": ["core_modules", {"$arrayElemAt": ["$$core.captures", 0]}]},
+                    {"case": {"$ne": ["$$pkg", None]},
+                     "then": ["packages", {"$arrayElemAt": ["$$pkg.captures", 0]}]}
+                ],
+                "default": ["files", "$url"]
+            }}
+        }}
+    }},
+    {"$group": {"_id": "$key", "joules": {"$sum": "$joules"}, "hit_count": {"$sum": "$hit_count"},
+                "nodes": {"$sum": 1}}}
+]
+
+
+def _load_rollup(reports: Collection, report_id: ObjectId, field: str) -> dict:
+    doc = reports.find_one(report_id, {"_id": 0, "stats.joules": 1, "rollups." + field: 1})
+    if doc is None:
+        raise BreakdownError("Profile not found")
+    return doc
+
+
+# Joules of a report by package, core module, user file or system function, largest first
+def energy_by(reports: Collection, report_id: ObjectId, group: str, offset: int, limit: int) -> dict:
+    doc = _load_rollup(reports, report_id, group)
+    totals = doc.get("rollups", {}).get(group)
+    if totals is None:
+        totals = {}
+        pipeline = [{"$match": {"_id": report_id}}] + _CLASSIFY_PIPELINE + [{"$match": {"_id.0": group}}]
+        for row in reports.aggregate(pipeline):
+            totals[row["_id"][1]] = {k: row[k] for k in ("joules", "hit_count", "nodes")}
+    report_joules = doc.get("stats", {}).get("joules", 0)
+    ranked = sorted(totals.items(), key=lambda x: x[1]["joules"], reverse=True)
+    return {
+        "group": group,
+        "total": len(ranked),
+        "offset": offset,
+        "joules": sum(t["joules"] for t in totals.values()),
+        "entries": [dict(t, name=name, share=t["joules"] / report_joules if report_joules else 0)
+                    for name, t in ranked[offset:offset + limit]]
+    }
+
+
+# Joules per time window of the given width, which is rounded up to a multiple of the
+# windows saved with the report. Window starts are in ms since the profile started.
+def energy_by_time(reports: Collection, report_id: ObjectId, width_ms: int or None) -> dict:
+    doc = _load_rollup(reports, report_id, "time_windows")
+    windows = doc.get("rollups", {}).get("time_windows")
+    if windows is None:
+        raise BreakdownError("Profile was generated by an older NodeWatts version without time windows")
+    base = windows["width"]
+    factor = max(1, -(-(width_ms or 0) * 1000 // base))
+    width = base * factor
+    joules = windows["joules"]
+    res = []
+    for i in range(0, len(joules), factor):
+        start = windows["start"] + i * base
+        window_joules = sum(joules[i:i + factor])
+        res.append({
+            "start": (start - windows["origin"]) / 1000,
+            "joules": window_joules,
+            "avg_watts": window_joules / (width / 1e6)
+        })
+    return {"width": width / 1000, "windows": res}
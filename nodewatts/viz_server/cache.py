@@ -0,0 +1,105 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import threading
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# One encoded response: the body, its etag and the compressed variants, which are built
+# the first time a client accepts them
+class EncodedResponse:
+    def __init__(self, body: bytes, mimetype="application/json"):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.variants = {"identity": body}
+
+    @property
+    def size(self) -> int:
+        return sum(len(v) for v in self.variants.values())
+
+    # Each variant is a different representation and gets an etag of its own
+    def etag_for(self, encoding: str) -> str:
+        return self.etag if encoding == "identity" else self.etag + "-" + encoding
+
+    def compress(self, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(self.body, quality=5)
+        if encoding == "gzip":
+            return gzip.compress(self.body, compresslevel=6)
+        raise ValueError("Unsupported encoding " + encoding)
+
+
+# Least recently used encoded responses, keyed by report ObjectId (or any hashable key),
+# evicted once their total size exceeds max_bytes. NodeWatts never updates or deletes a
+# saved report, entries are not invalidated: a report removed from the database by other
+# means is served until its entry is evicted.
+class ResponseCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> EncodedResponse or None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry: EncodedResponse) -> EncodedResponse:
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).size
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+        return entry
+
+    # Compressed variants grow an entry after it was added. Compression runs outside the
+    # lock so other requests are not held up by a large body, two threads compressing the
+    # same variant at once keep the first result.
+    def encode(self, key, entry: EncodedResponse, encoding: str) -> bytes:
+        data = entry.variants.get(encoding)
+        if data is not None:
+            return data
+        data = entry.compress(encoding)
+        with self._lock:
+            if encoding in entry.variants:
+                return entry.variants[encoding]
+            entry.variants[encoding] = data
+            if self._entries.get(key) is entry:
+                self._size += len(data)
+                self._evict()
+        return data
+
+    # The newest entry is kept even when it alone exceeds the budget
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self._size -= old.size
+
+
+# Preferred supported content coding of an Accept-Encoding header
+def negotiate_encoding(accept_encoding: str) -> str:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        fields = part.strip().split(";")
+        coding = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in (["br"] if brotli is not None else []) + ["gzip"]:
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return "identity"
@@ -0,0 +1,90 @@
+from nodewatts.error import NodewattsError
+from bson import ObjectId
+from pymongo.collection import Collection
+
+
+class CallTreeError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+# Fields of a node read from the database. Power measurements are left out, they are the
+# bulk of a node.
+NODE_FIELDS = ["call_frame", "hit_count", "avg_watts", "joules", "inclusive_joules", "children"]
+
+
+def summarize_node(idx, node: dict) -> dict:
+    frame = node["call_frame"]
+    return {
+        "id": int(idx),
+        "function_name": frame.get("functionName", ""),
+        "url": frame.get("url", ""),
+        "line": frame.get("lineNumber", -1),
+        "column": frame.get("columnNumber", -1),
+        "hit_count": node["hit_count"],
+        "avg_watts": node["avg_watts"],
+        "joules": node["joules"],
+        "inclusive_joules": node.get("inclusive_joules", node["joules"]),
+        "child_count": len(node["children"])
+    }
+
+
+# Reads only the listed nodes of a report, keyed by id, without their power measurements
+def _load_nodes(reports: Collection, report_id: ObjectId, ids: list) -> dict:
+    if not ids:
+        return {}
+    projection = {"_id": 0}
+    for idx in ids:
+        for field in NODE_FIELDS:
+            projection["node_map." + str(idx) + "." + field] = 1
+    doc = reports.find_one(report_id, projection)
+    if doc is None:
+        raise CallTreeError("Profile not found")
+    nodes = doc.get("node_map", {})
+    return {int(idx): node for idx, node in nodes.items()}
+
+
+def _load_index(reports: Collection, report_id: ObjectId, projection: dict) -> dict:
+    doc = reports.find_one(report_id, dict(projection, _id=0, name=1))
+    if doc is None:
+        raise CallTreeError("Profile not found")
+    if "call_tree" not in doc:
+        raise CallTreeError("Profile was generated by an older NodeWatts version without call "
+                                  + "tree indexes")
+    return doc
+
+
+# The root and its first page of children
+def tree_root(reports: Collection, report_id: ObjectId, limit: int) -> dict:
+    doc = _load_index(reports, report_id, {"call_tree.root": 1, "stats.joules": 1})
+    root = doc["call_tree"]["root"]
+    res = {"name": doc["name"], "joules": doc.get("stats", {}).get("joules", 0),
+           "root": summarize_node(root, _load_nodes(reports, report_id, [root])[root])}
+    res.update(node_children(reports, report_id, root, 0, limit))
+    return res
+
+
+# One page of a node's children, which are saved in order of inclusive joules
+def node_children(reports: Collection, report_id: ObjectId, node: int, offset: int, limit: int) -> dict:
+    parent = _load_nodes(reports, report_id, [node]).get(node)
+    if parent is None:
+        raise CallTreeError("Node " + str(node) + " not found")
+    page = parent["children"][offset:offset + limit]
+    nodes = _load_nodes(reports, report_id, page)
+    return {
+        "node": node,
+        "total": len(parent["children"]),
+        "offset": offset,
+        "children": [summarize_node(c, nodes[c]) for c in page]
+    }
+
+
+# Nodes ranked by the joules they used themselves
+def top_nodes(reports: Collection, report_id: ObjectId, offset: int, limit: int) -> dict:
+    doc = _load_index(reports, report_id, {"call_tree.by_joules": {"$slice": [offset, limit]}})
+    page = doc["call_tree"]["by_joules"]
+    nodes = _load_nodes(reports, report_id, page)
+    return {
+        "offset": offset,
+        "nodes": [summarize_node(i, nodes[i]) for i in page]
+    }
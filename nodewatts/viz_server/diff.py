@@ -0,0 +1,155 @@
+from nodewatts.error import NodewattsError
+from nodewatts.nwengine.cpu_profile import function_key
+from bson import ObjectId
+from pymongo.collection import Collection
+
+
+class DiffError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+SORTS = ["impact", "regressions", "improvements"]
+
+# Own joules by function for reports saved before flame data existed, computed by the
+# database: one [function_name, url, line, column, joules] per function that used energy
+_BY_FUNCTION_PIPELINE = [
+    {"$project": {"nodes": {"$objectToArray": "$node_map"}}},
+    {"$unwind": "$nodes"},
+    {"$match": {"nodes.v.joules": {"$gt": 0}}},
+    {"$group": {
+        "_id": {
+            "function_name": {"$ifNull": ["$nodes.v.call_frame.functionName", ""]},
+            "url": {"$ifNull": ["$nodes.v.call_frame.url", ""]},
+            "line": {"$ifNull": ["$nodes.v.call_frame.lineNumber", -1]},
+            "column": {"$ifNull": ["$nodes.v.call_frame.columnNumber", -1]}
+        },
+        "joules": {"$sum": "$nodes.v.joules"}
+    }}
+]
+
+
+# Joules by function key of a report: its own and inclusive joules, as summed by the engine
+# with the flame data. Reports saved before the sums existed are summed from the collapsed
+# stacks, where a function counts once per stack for its inclusive joules so recursion is
+# not counted twice. Older reports only have own joules.
+def function_energy(reports: Collection, report_id: ObjectId) -> dict:
+    doc = reports.find_one(report_id, {"_id": 0, "name": 1, "stats.joules": 1, "flame.frames": 1,
+                                       "flame.functions": 1})
+    if doc is None:
+        raise DiffError("Profile " + str(report_id) + " not found")
+    res = {"name": doc.get("name", ""), "joules": doc.get("stats", {}).get("joules", 0)}
+    if "functions" in doc.get("flame", {}):
+        frames, totals = doc["flame"]["frames"], doc["flame"]["functions"]
+        res["functions"] = {key: (totals["self"][i], totals["inclusive"][i]) for i, key in enumerate(frames)}
+    elif "flame" in doc:
+        stacks = reports.find_one(report_id, {"_id": 0, "flame.stacks.frames": 1, "flame.stacks.self": 1})
+        stacks = stacks["flame"]["stacks"]
+        frames = doc["flame"]["frames"]
+        own = [0] * len(frames)
+        inclusive = [0] * len(frames)
+        for stack, joules in zip(stacks["frames"], stacks["self"]):
+            own[stack[-1]] += joules
+            for frame in set(stack):
+                inclusive[frame] += joules
+        res["functions"] = {key: (own[i], inclusive[i]) for i, key in enumerate(frames)}
+    else:
+        res["functions"] = {}
+        for group in reports.aggregate([{"$match": {"_id": report_id}}] + _BY_FUNCTION_PIPELINE):
+            frame = group["_id"]
+            key = function_key({"functionName": frame["function_name"], "url": frame["url"],
+                                "lineNumber": frame["line"], "columnNumber": frame["column"]})
+            res["functions"][key] = (group["joules"], None)
+    return res
+
+
+# Functions whose energy changed between two reports, matched by function key, and their
+# rankings. base and head are the results of function_energy. Rows are built for the page
+# asked for only, and each ranking is sorted once, so large diffs page quickly once cached.
+class FunctionDiff:
+    def __init__(self, base: dict, head: dict, base_id: ObjectId, head_id: ObjectId):
+        self.summary = {
+            "base": {"id": str(base_id), "name": base["name"], "joules": base["joules"]},
+            "head": {"id": str(head_id), "name": head["name"], "joules": head["joules"]},
+            "delta_joules": head["joules"] - base["joules"],
+            "unchanged": 0,
+            "added": 0,
+            "removed": 0
+        }
+        # key, base and head (own joules, inclusive joules) of each changed function
+        self.functions = []
+        for key in base["functions"].keys() | head["functions"].keys():
+            before = base["functions"].get(key)
+            after = head["functions"].get(key)
+            if before == after:
+                self.summary["unchanged"] += 1
+                continue
+            if before is None:
+                self.summary["added"] += 1
+            elif after is None:
+                self.summary["removed"] += 1
+            self.functions.append((key, before, after))
+        self.has_inclusive = all(b is None or b[1] is not None for _, b, a in self.functions) \
+            and all(a is None or a[1] is not None for _, b, a in self.functions)
+        self._rankings = {}
+
+    # Rough memory use, for the cache budget
+    @property
+    def size(self) -> int:
+        return 200 * len(self.functions) + 1024
+
+    @staticmethod
+    def _delta(before, after, field: int) -> float:
+        return (after[field] if after is not None else 0) - (before[field] if before is not None else 0)
+
+    # Indexes of the functions in ranking order: impact ranks every changed function by the
+    # size of the change, regressions only the ones that use more energy, by increase, and
+    # improvements only the ones that use less, by decrease
+    def ranking(self, sort: str, inclusive: bool) -> list:
+        if (sort, inclusive) not in self._rankings:
+            field = 1 if inclusive else 0
+            deltas = [self._delta(before, after, field) for _, before, after in self.functions]
+            if sort == "impact":
+                deltas = [abs(d) for d in deltas]
+            elif sort == "improvements":
+                deltas = [-d for d in deltas]
+            indexes = range(len(deltas)) if sort == "impact" else [i for i, d in enumerate(deltas) if d > 0]
+            self._rankings[(sort, inclusive)] = sorted(indexes, key=lambda i: (deltas[i], self.functions[i][0]),
+                                                       reverse=True)
+        return self._rankings[(sort, inclusive)]
+
+    def row(self, i: int) -> dict:
+        key, before, after = self.functions[i]
+        name, _, location = key.partition("@")
+        url, line, column = location.rsplit(":", 2)
+        base_own, base_incl = before if before is not None else (0, 0)
+        head_own, head_incl = after if after is not None else (0, 0)
+        return {
+            "function": key,
+            "function_name": name,
+            "url": url,
+            "line": int(line),
+            "column": int(column),
+            "status": "added" if before is None else "removed" if after is None else "changed",
+            "base_joules": base_own,
+            "head_joules": head_own,
+            "delta_joules": head_own - base_own,
+            "change": (head_own - base_own) / base_own if base_own else None,
+            "base_inclusive_joules": base_incl,
+            "head_inclusive_joules": head_incl,
+            "delta_inclusive_joules": head_incl - base_incl if self.has_inclusive else None
+        }
+
+    def page(self, sort: str, inclusive: bool, offset: int, limit: int) -> dict:
+        if sort not in SORTS:
+            raise DiffError("sort: expected one of " + ", ".join(SORTS))
+        if inclusive and not self.has_inclusive:
+            raise DiffError("Inclusive energy is unavailable for profiles generated by older NodeWatts versions")
+        ranking = self.ranking(sort, inclusive)
+        res = dict(self.summary)
+        res.update({
+            "total": len(ranking),
+            "offset": offset,
+            "functions": [self.row(i) for i in ranking[offset:offset + limit]]
+        })
+        return res
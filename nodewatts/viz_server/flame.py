@@ -0,0 +1,43 @@
+from nodewatts.error import NodewattsError
+from bson import ObjectId
+from pymongo.collection import Collection
+
+
+class FlameGraphError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+def _load_flame(reports: Collection, report_id: ObjectId, fields: list) -> dict:
+    doc = reports.find_one(report_id, dict({"_id": 0, "name": 1}, **{"flame." + f: 1 for f in fields}))
+    if doc is None:
+        raise FlameGraphError("Profile not found")
+    if "flame" not in doc:
+        raise FlameGraphError("Profile was generated by an older NodeWatts version without flame graph data")
+    return doc
+
+
+# The report's icicle rows, optionally without rows deeper than max_depth or narrower
+# than min_share of the root. Rows stay in depth first order, so a dropped row's
+# descendants are dropped with it.
+def icicle(reports: Collection, report_id: ObjectId, max_depth=None, min_share=0) -> dict:
+    doc = _load_flame(reports, report_id, ["frames", "icicle"])
+    rows = doc["flame"]["icicle"]
+    total = rows["width"][0] if rows["width"] else 0
+    keep = [i for i in range(len(rows["id"]))
+            if (max_depth is None or rows["depth"][i] <= max_depth) and rows["width"][i] >= min_share * total]
+    if len(keep) < len(rows["id"]):
+        rows = {column: [values[i] for i in keep] for column, values in rows.items()}
+    return {"name": doc["name"], "frames": doc["flame"]["frames"], "icicle": rows}
+
+
+# Collapsed stacks in the text format of flamegraph.pl and speedscope, one
+# "frame;frame;frame value" line per stack. Values are the stack's own microjoules.
+def collapsed_stacks(reports: Collection, report_id: ObjectId) -> str:
+    doc = _load_flame(reports, report_id, ["frames", "stacks"])
+    frames = [f.replace(";", ",") for f in doc["flame"]["frames"]]
+    stacks = doc["flame"]["stacks"]
+    lines = []
+    for stack, joules in zip(stacks["frames"], stacks["self"]):
+        lines.append(";".join(frames[f] for f in stack) + " " + str(round(joules * 1e6)))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,63 @@
+from bson import json_util
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+import time
+
+
+# Server-sent event for one live update, identified by its ObjectId so a reconnecting
+# browser resumes after the last update it saw (Last-Event-ID)
+def _event(doc: dict) -> str:
+    data = {k: v for k, v in doc.items() if k not in ("_id", "session")}
+    return ("id: " + str(doc["_id"]) + "\nevent: window\ndata: "
+            + json_util.dumps(data, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n\n")
+
+
+# Change stream of the session's new updates. Change streams need a replica set, on a
+# standalone server there is none and the collection is polled instead.
+def _watch(live: Collection, session: str):
+    try:
+        return live.watch([{"$match": {"operationType": "insert", "fullDocument.session": session}}],
+                          max_await_time_ms=1000)
+    except OperationFailure:
+        return None
+
+
+def _after(session: str, last_id: ObjectId or None) -> dict:
+    query = {"session": session}
+    if last_id is not None:
+        query["_id"] = {"$gt": last_id}
+    return query
+
+
+# Server-sent events of the per window energy updates of a continuous session, as the
+# engine saves them: every update after last_id first, then new ones as they arrive.
+# A comment is sent when nothing happened for heartbeat seconds so proxies keep the
+# connection open. Runs until the client goes away.
+def stream_updates(live: Collection, session: str, last_id: ObjectId = None, poll_interval=1.0, heartbeat=15):
+    # Opened before the backlog is read so nothing saved in between is missed. Updates
+    # seen twice are skipped by id.
+    changes = _watch(live, session)
+    try:
+        yield "retry: 3000\n\n"
+        pending = list(live.find(_after(session, last_id)).sort("_id", 1))
+        last_sent = time.monotonic()
+        while True:
+            for doc in pending:
+                if last_id is None or doc["_id"] > last_id:
+                    last_id = doc["_id"]
+                    last_sent = time.monotonic()
+                    yield _event(doc)
+            if changes is not None:
+                # Waits up to max_await_time_ms for a change
+                change = changes.try_next()
+                pending = [] if change is None else [change["fullDocument"]]
+            else:
+                time.sleep(poll_interval)
+                pending = list(live.find(_after(session, last_id)).sort("_id", 1))
+            if not pending and time.monotonic() - last_sent > heartbeat:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+    finally:
+        if changes is not None:
+            changes.close()
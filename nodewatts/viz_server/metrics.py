@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+# Request counts and latency histograms per route, method and status, rendered in the
+# Prometheus text format. When the server runs several worker processes each worker
+# writes its counts to shared_dir, at most flush_interval seconds after a request, and any
+# worker asked for the metrics adds up the files of all of them.
+class LatencyMetrics:
+    def __init__(self, shared_dir=None, flush_interval=1.0):
+        self.shared_dir = shared_dir
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._series = {}
+        self._flush_timer = None
+        self._pid = os.getpid()
+
+    def observe(self, route: str, method: str, status: int, seconds: float) -> None:
+        key = (route, method, str(status))
+        with self._lock:
+            self._check_fork()
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"count": 0, "sum": 0.0, "buckets": [0] * len(BUCKETS)}
+            series["count"] += 1
+            series["sum"] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    series["buckets"][i] += 1
+                    break
+            if self.shared_dir is not None and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    # Counts of the process this worker was forked from are not its own
+    def _check_fork(self) -> None:
+        if self._pid != os.getpid():
+            self._series = {}
+            self._flush_timer = None
+            self._pid = os.getpid()
+
+    def _timed_flush(self) -> None:
+        with self._lock:
+            self._flush_timer = None
+            self._flush()
+
+    def _flush(self) -> None:
+        path = os.path.join(self.shared_dir, str(self._pid) + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump([[list(k), v] for k, v in self._series.items()], f)
+        os.replace(path + ".tmp", path)
+
+    # Series of every worker, or of this process only when nothing is shared
+    def _collect(self) -> dict:
+        with self._lock:
+            self._check_fork()
+            if self.shared_dir is None:
+                return {k: dict(v, buckets=list(v["buckets"])) for k, v in self._series.items()}
+            self._flush()
+        merged = {}
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name)) as f:
+                    rows = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, series in rows:
+                total = merged.setdefault(tuple(key), {"count": 0, "sum": 0.0, "buckets": [0] * len(BUCKETS)})
+                total["count"] += series["count"]
+                total["sum"] += series["sum"]
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], series["buckets"])]
+        return merged
+
+    def render(self) -> str:
+        lines = [
+            "# HELP nodewatts_viz_request_duration_seconds Time taken to answer requests.",
+            "# TYPE nodewatts_viz_request_duration_seconds histogram"
+        ]
+        for (route, method, status), series in sorted(self._collect().items()):
+            labels = 'route="' + route + '",method="' + method + '",status="' + status + '"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, series["buckets"]):
+                cumulative += count
+                lines.append("nodewatts_viz_request_duration_seconds_bucket{" + labels + ',le="'
+                             + str(bound) + '"} ' + str(cumulative))
+            lines.append("nodewatts_viz_request_duration_seconds_bucket{" + labels + ',le="+Inf"} '
+                         + str(series["count"]))
+            lines.append("nodewatts_viz_request_duration_seconds_sum{" + labels + "} " + repr(series["sum"]))
+            lines.append("nodewatts_viz_request_duration_seconds_count{" + labels + "} " + str(series["count"]))
+        return "\n".join(lines) + "\n"
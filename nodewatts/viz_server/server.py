@@ -1,27 +1,166 @@
 import flask
 import os
 import json
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
 import webbrowser
 from threading import Timer
 from bson import json_util
 from bson import ObjectId
-from nodewatts.db import Database, DatabaseError
+from bson.errors import InvalidId
+from nodewatts.mongo import clients
+from pymongo.errors import PyMongoError
 from nodewatts.error import NodewattsError
 from nodewatts.config import NWConfig
-from flask import render_template, request
+from nodewatts import catalogue
+from nodewatts.viz_server import breakdowns, call_tree, diff, flame, live, timeline
+from nodewatts.viz_server.cache import EncodedResponse, ResponseCache, negotiate_encoding
+from nodewatts.viz_server.metrics import LatencyMetrics
+from flask import request
 
 class VizServerError(NodewattsError):
     def __init__(self, msg: str, *args, **kwargs):
         super().__init__(msg, *args, **kwargs)
 
-def run(port=8080, mongo_url="mongodb://localhost:27017"):
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                         "resources")
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+# Largest page of nodes a single request may ask for
+MAX_PAGE = 500
+# Most points a timeline request may ask for
+MAX_TIMELINE_POINTS = 10000
+
+
+# Sends a cached response, compressed if the client accepts it. A client that already
+# holds the same version gets an empty 304.
+def send_encoded(cache: ResponseCache, key, entry: EncodedResponse) -> flask.Response:
+    encoding = "identity"
+    if len(entry.body) >= MIN_COMPRESS_BYTES:
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    etag = entry.etag_for(encoding)
+    if etag in request.if_none_match:
+        res = flask.Response(status=304)
+    else:
+        res = flask.Response(cache.encode(key, entry, encoding), mimetype=entry.mimetype)
+        if encoding != "identity":
+            res.headers["Content-Encoding"] = encoding
+    res.set_etag(etag)
+    res.headers["Vary"] = "Accept-Encoding"
+    # Browsers revalidate on every use, answered with an empty 304 while the entry is cached
+    res.headers["Cache-Control"] = "no-cache"
+    return res
+
+
+# The app is built once and shared by every thread of a worker. Each worker process
+# keeps its own caches and its own pooled MongoClient. metrics_dir is where workers of a
+# multi-worker server share their request metrics. max_live_streams caps the /live
+# streams open at once in a worker, None for no cap.
+def create_app(mongo_url="mongodb://localhost:27017", cache_bytes=256 * 1024 * 1024, metrics_dir=None,
+               max_live_streams=None) -> flask.Flask:
     app = flask.Flask(__name__, static_folder="../../resources/visualizer", template_folder="../../resources/visualizer", static_url_path="")
     app.config['CORS_HEADERS'] = 'Content-Type'
+    metrics = LatencyMetrics(metrics_dir)
+    live_streams = {"open": 0}
+    live_lock = threading.Lock()
+
+    @app.before_request
+    def start_timer():
+        flask.g.start = time.perf_counter()
+
+    @app.after_request
+    def finish_request(res):
+        # Bundled assets have content hashes in their names, so they never change
+        if request.path.startswith("/static/") and res.status_code in (200, 304):
+            res.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        elif "Cache-Control" not in res.headers:
+            res.headers["Cache-Control"] = "no-cache"
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe(route, request.method, res.status_code, time.perf_counter() - flask.g.start)
+        return res
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+    # Encoded reports by ObjectId, so reopening a profile skips the database and the encoding
+    reports = ResponseCache(cache_bytes)
+    # Encoded results of the smaller report queries, by request path and arguments
+    queries = ResponseCache(cache_bytes // 8)
+
+    # Diffs of report pairs by (base id, head id). Only their size is used by the cache.
+    diffs = ResponseCache(cache_bytes // 8)
+
+    # Runs query(reports collection) and sends its result, cached by request. Queries
+    # return a dict, sent as json with the fail flag, or plain text.
+    def send_result(query) -> flask.Response:
+        res = {
+            "fail": False,
+            "reason": "",
+        }
+        key = (request.path, request.query_string)
+        entry = queries.get(key)
+        if entry is None:
+            try:
+                result = query(clients.get(mongo_url)["nodewatts"]["reports"])
+            except InvalidId:
+                res["fail"] = True
+                res["reason"] = "Invalid profile id"
+                return json.dumps(res)
+            except PyMongoError:
+                res["fail"] = True
+                res["reason"] = "Database error"
+                return json.dumps(res)
+            except NodewattsError as e:
+                res["fail"] = True
+                res["reason"] = str(e)
+                return json.dumps(res)
+            if isinstance(result, str):
+                entry = queries.put(key, EncodedResponse(result.encode(), "text/plain"))
+            else:
+                res.update(result)
+                entry = queries.put(key, EncodedResponse(json.dumps(res).encode()))
+        return send_encoded(queries, key, entry)
+
+    # Runs query(reports collection, report id) and sends its result, cached by request
+    def send_query(report_id: str, query) -> flask.Response:
+        return send_result(lambda coll: query(coll, ObjectId(report_id)))
+
+    catalogue_lock = threading.Lock()
+    catalogue_ready = []
+
+    # The catalogue collection, indexed and holding reports saved before it existed.
+    # Done once per process.
+    def get_catalogue():
+        db = clients.get(mongo_url)["nodewatts"]
+        with catalogue_lock:
+            if not catalogue_ready:
+                catalogue.ensure_indexes(db["catalogue"])
+                added = catalogue.backfill(db["reports"], db["catalogue"])
+                if added:
+                    app.logger.info("Added " + str(added) + " existing reports to the catalogue.")
+                catalogue_ready.append(True)
+        return db["catalogue"]
+
+    def page_args(default_limit: int) -> (int, int):
+        offset = max(request.args.get("offset", 0, type=int), 0)
+        # An empty page is never asked for, and limit 0 means no limit to MongoDB
+        limit = min(max(request.args.get("limit", default_limit, type=int), 1), MAX_PAGE)
+        return offset, limit
+
+    # The visualizer page, with the script making the bundle's requests relative to it
+    with open(os.path.join(app.root_path, app.template_folder, "index.html")) as f:
+        index = f.read()
+    with open(os.path.join(RESOURCES, "server", "relative-urls.js")) as f:
+        index = index.replace("<script", "<script>" + f.read() + "</script><script", 1)
 
     @app.route("/")
     def start():
-        return render_template('index.html')
+        return flask.Response(index, mimetype="text/html")
 
     @app.route('/options', methods=['GET'])
     def options():
@@ -31,13 +170,9 @@ def run(port=8080, mongo_url="mongodb://localhost:27017"):
             "options": [],
         }
         try:
-            db = Database(mongo_url)
-            db.connect()
-            cursor = db.internal_client["nodewatts"]["reports"].find({},{"name":1, "_id":1})
-            for doc in cursor:
-                res["options"].append(json_util.dumps(doc))
-            db.close_connections()
-        except DatabaseError:
+            cursor = get_catalogue().find({}, {"_id": 0, "name": 1, "report_id": 1}).sort("date", 1)
+            res["options"] = [json_util.dumps({"name": e["name"], "_id": e["report_id"]}) for e in cursor]
+        except PyMongoError:
             res["fail"] = True
             res["reason"] = "Server database error"
             return json.dumps(res)
@@ -49,36 +184,218 @@ def run(port=8080, mongo_url="mongodb://localhost:27017"):
         res = {
             "fail": False,
             "reason": "",
-            "profile": {},
         }
-        arg = request.args.get('profile')
         try:
-            db = Database(mongo_url)
-            db.connect()
-            req = json.loads(arg)
+            req = json.loads(request.args.get('profile'))
             id = ObjectId(req["$oid"])
-            doc = db.internal_client["nodewatts"]["reports"].find_one(id)
-            res["profile"] = json_util.dumps(doc)
-            db.close_connections()
-        except DatabaseError:
+        except (TypeError, ValueError, KeyError, InvalidId):
+            res["fail"] = True
+            res["reason"] = "Invalid profile id"
+            return json.dumps(res)
+        entry = reports.get(id)
+        if entry is None:
+            try:
+                doc = clients.get(mongo_url)["nodewatts"]["reports"].find_one(id)
+            except PyMongoError:
                 res["fail"] = True
                 res["reason"] = "Database error"
                 return json.dumps(res)
-        else:
-            return json.dumps(res)
+            if doc is None:
+                res["fail"] = True
+                res["reason"] = "Profile not found"
+                return json.dumps(res)
+            # The visualizer reads the report as a json string. Escaping it is paid once,
+            # the encoded response is cached.
+            res["profile"] = json_util.dumps(doc)
+            body = json.dumps(res)
+            entry = reports.put(id, EncodedResponse(body.encode()))
+        return send_encoded(reports, id, entry)
     
+    # Call tree of a report, a page at a time. Children come in order of inclusive joules.
+    @app.route('/profiles/<report_id>/tree', methods=['GET'])
+    def get_tree(report_id):
+        _, limit = page_args(50)
+        return send_query(report_id, lambda coll, id: call_tree.tree_root(coll, id, limit))
+
+    @app.route('/profiles/<report_id>/nodes/<int:node>/children', methods=['GET'])
+    def get_children(report_id, node):
+        offset, limit = page_args(50)
+        return send_query(report_id, lambda coll, id: call_tree.node_children(coll, id, node, offset, limit))
+
+    # Nodes ranked by the joules they used themselves
+    @app.route('/profiles/<report_id>/top', methods=['GET'])
+    def get_top(report_id):
+        offset, limit = page_args(20)
+        return send_query(report_id, lambda coll, id: call_tree.top_nodes(coll, id, offset, limit))
+
+    # Energy by package, core module, user file or system function
+    @app.route('/profiles/<report_id>/energy/<group>', methods=['GET'])
+    def get_energy_by(report_id, group):
+        group = group.replace("-", "_")
+        if group not in breakdowns.GROUPS:
+            flask.abort(404)
+        offset, limit = page_args(100)
+        return send_query(report_id, lambda coll, id: breakdowns.energy_by(coll, id, group, offset, limit))
+
+    @app.route('/profiles/<report_id>/energy/time', methods=['GET'])
+    def get_energy_by_time(report_id):
+        width = request.args.get("window_ms", None, type=int)
+        return send_query(report_id, lambda coll, id: breakdowns.energy_by_time(coll, id, width))
+
+    # Paged search of the report catalogue. q matches the start of report names, since and
+    # until are ISO dates, sort is one of date, name, joules or duration.
+    @app.route('/catalogue', methods=['GET'])
+    def search_catalogue():
+        res = {
+            "fail": False,
+            "reason": "",
+        }
+        offset, limit = page_args(50)
+        try:
+            since = request.args.get("since", None, type=datetime.fromisoformat)
+            until = request.args.get("until", None, type=datetime.fromisoformat)
+            sort = request.args.get("sort", "date")
+            if sort not in catalogue.SORT_FIELDS:
+                raise ValueError("sort: expected one of " + ", ".join(catalogue.SORT_FIELDS))
+            res.update(catalogue.search(get_catalogue(), request.args.get("q"), request.args.get("project"),
+                                        request.args.get("session"), since, until, sort,
+                                        request.args.get("order", "desc") != "asc", offset, limit))
+        except ValueError as e:
+            res["fail"] = True
+            res["reason"] = str(e)
+        except PyMongoError:
+            res["fail"] = True
+            res["reason"] = "Database error"
+        return flask.Response(json_util.dumps(res), mimetype="application/json")
+
+    def release_live_stream():
+        with live_lock:
+            live_streams["open"] -= 1
+
+    # Server-sent events with the energy by function of each window of a continuous
+    # session as it is processed. session is the session's report name. A stream holds
+    # its server thread until the client goes away, past max_live_streams the server
+    # answers 503 so the other routes keep threads to run on.
+    @app.route('/live/<session>', methods=['GET'])
+    def live_updates(session):
+        last_id = request.headers.get("Last-Event-ID", request.args.get("since"))
+        try:
+            last_id = None if last_id is None else ObjectId(last_id)
+            collection = clients.get(mongo_url)["nodewatts"]["live_updates"]
+        except InvalidId:
+            return flask.Response("Invalid event id", status=400)
+        except PyMongoError:
+            return flask.Response("Database error", status=503)
+        with live_lock:
+            if max_live_streams is not None and live_streams["open"] >= max_live_streams:
+                res = flask.Response("Too many live streams", status=503)
+                res.headers["Retry-After"] = "30"
+                return res
+            live_streams["open"] += 1
+        res = flask.Response(live.stream_updates(collection, session, last_id), mimetype="text/event-stream")
+        res.call_on_close(release_live_stream)
+        res.headers["Cache-Control"] = "no-cache"
+        # Stops nginx and similar proxies from holding events back
+        res.headers["X-Accel-Buffering"] = "no"
+        return res
+
+    # Power timeline of a zoom window, in ms since the profile started
+    @app.route('/profiles/<report_id>/timeline', methods=['GET'])
+    def get_timeline(report_id):
+        start = request.args.get("start", None, type=float)
+        end = request.args.get("end", None, type=float)
+        points = min(max(request.args.get("points", 1000, type=int), 3), MAX_TIMELINE_POINTS)
+        return send_query(report_id, lambda coll, id: timeline.power_timeline(coll, id, start, end, points))
+
+    # Flame graph rows laid out by the engine. Narrow rows can be dropped with min_share,
+    # a fraction of the total width.
+    @app.route('/profiles/<report_id>/flame', methods=['GET'])
+    def get_flame(report_id):
+        max_depth = request.args.get("max_depth", None, type=int)
+        min_share = request.args.get("min_share", 0, type=float)
+        return send_query(report_id, lambda coll, id: flame.icicle(coll, id, max_depth, min_share))
+
+    @app.route('/profiles/<report_id>/flame/collapsed', methods=['GET'])
+    def get_collapsed_stacks(report_id):
+        return send_query(report_id, flame.collapsed_stacks)
+
+    # Functions of two reports matched by function key, ranked by how much their energy
+    # changed from base to head. The diff is computed once per pair, pages and rankings
+    # are cut from it.
+    def load_diff(reports, base: ObjectId, head: ObjectId) -> diff.FunctionDiff:
+        result = diffs.get((base, head))
+        if result is None:
+            result = diffs.put((base, head), diff.FunctionDiff(diff.function_energy(reports, base),
+                                                               diff.function_energy(reports, head), base, head))
+        return result
+
+    @app.route('/diff', methods=['GET'])
+    def get_diff():
+        offset, limit = page_args(50)
+        sort = request.args.get("sort", "impact")
+        inclusive = request.args.get("by", "self") == "inclusive"
+        return send_result(lambda coll: load_diff(
+            coll, ObjectId(request.args.get("base", "")), ObjectId(request.args.get("head", ""))
+        ).page(sort, inclusive, offset, limit))
+
+    return app
+
+
+# Local viewing: Flask's own server and a browser window
+def run(port=8080, mongo_url="mongodb://localhost:27017", cache_bytes=256 * 1024 * 1024):
+    app = create_app(mongo_url, cache_bytes)
+
     def open_browser():
-        webbrowser.open("http://localhost:8080")
+        webbrowser.open("http://localhost:" + str(port))
     
     Timer(1.0, open_browser).start()
     app.run(port=port)
 
 
+# Shared dashboards: a pre-forking gunicorn server with workers processes of threads threads.
+# gthread workers run a request per thread, so /live streams may hold at most half of them,
+# and at least one.
+def serve(host="0.0.0.0", port=8080, mongo_url="mongodb://localhost:27017", workers=4, threads=8,
+          cache_bytes=256 * 1024 * 1024):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise VizServerError("Serving the visualizer requires gunicorn. Install it with "
+                             + "pip install nodewatts[serve]") from None
+
+    class VizApplication(BaseApplication):
+        def __init__(self, app: flask.Flask, options: dict):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    metrics_dir = tempfile.mkdtemp(prefix="nodewatts-viz-metrics-")
+    try:
+        VizApplication(create_app(mongo_url, cache_bytes, metrics_dir, max(1, threads // 2)), {
+            "bind": host + ":" + str(port),
+            "workers": workers,
+            "threads": threads,
+            "worker_class": "gthread"
+        }).run()
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
 if __name__ == '__main__':
     try: 
         with open(os.path.join(NWConfig.dirs.site_config_dir, "viz_config.json")) as f:
             conf = json.load(f)
     except OSError as e:
         raise VizServerError("Failed to load configuration file. Please run nodewatts with visualize set to true to generate the neccessary configuration to run the server as a module.")
-    run(conf["port"], conf["mongo_url"])
+    if "--serve" in sys.argv:
+        serve(conf["host"], conf["port"], conf["mongoUrl"], conf["workers"], conf["threads"])
+    else:
+        run(conf["port"], conf["mongoUrl"])
     sys.exit(0)
@@ -0,0 +1,54 @@
+from nodewatts.error import NodewattsError
+from nodewatts.nwengine.timeline import lttb
+from bson import ObjectId
+from pymongo.collection import Collection
+
+
+class TimelineError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+# Coarsest level of the pyramid expected to hold at least points points between start and
+# end, or the full resolution level when none does
+def _pick_level(levels: list, start: int, end: int, points: int) -> int:
+    for level in reversed(levels):
+        span = level["end"] - level["start"]
+        if span <= 0:
+            continue
+        if level["points"] * min(end - start, span) / span >= points:
+            return level["level"]
+    return 0
+
+
+# The report's power timeline between start_ms and end_ms (ms since the profile started,
+# the whole profile by default), downsampled to at most points points with LTTB
+def power_timeline(reports: Collection, report_id: ObjectId, start_ms=None, end_ms=None, points=1000) -> dict:
+    doc = reports.find_one(report_id, {"_id": 0, "timeline": 1})
+    if doc is None:
+        raise TimelineError("Profile not found")
+    if "timeline" not in doc:
+        raise TimelineError("Profile was generated by an older NodeWatts version without a power timeline")
+    levels = doc["timeline"]["levels"]
+    start = levels[0]["start"] if start_ms is None else int(start_ms * 1000)
+    end = levels[0]["end"] if end_ms is None else int(end_ms * 1000)
+    if end < start:
+        raise TimelineError("Timeline window ends before it starts")
+    level = _pick_level(levels, start, end, points)
+    ts, watts = [], []
+    chunks = reports.database["timelines"].find(
+        {"report_id": report_id, "level": level, "start": {"$lte": end}, "end": {"$gte": start}},
+        {"_id": 0, "t": 1, "watts": 1}).sort("start", 1)
+    for chunk in chunks:
+        for t, w in zip(chunk["t"], chunk["watts"]):
+            if start <= t <= end:
+                ts.append(t)
+                watts.append(w)
+    ts, watts = lttb(ts, watts, points)
+    return {
+        "level": level,
+        "start": start / 1000,
+        "end": end / 1000,
+        "t": [t / 1000 for t in ts],
+        "watts": watts
+    }
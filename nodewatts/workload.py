@@ -0,0 +1,261 @@
+from nodewatts.error import NodewattsError
+
+from typing import List, Tuple
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+logger = logging.getLogger("Main")
+
+# Built-in HTTP load driver. Used in place of the user's runTests command when a
+# "workload" section is configured. The runner executes this module as its test
+# command, so each iteration of the suite is one run of the generator.
+# Every request's start and end is recorded in monotonic microseconds, the same clock
+# used by the sensor and the V8 profiler, so the engine can attribute power to endpoints.
+
+
+class WorkloadError(NodewattsError):
+    def __init__(self, msg: str, *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+class Endpoint:
+    def __init__(self, raw: dict, default_headers: dict):
+        if "path" not in raw or not isinstance(raw["path"], str):
+            raise WorkloadError("Scenario endpoint: path must be provided as a string")
+        self.method = raw.get("method", "GET").upper()
+        self.path = raw["path"]
+        self.name = raw.get("name", self.method + " " + self.path)
+        self.weight = raw.get("weight", 1)
+        if not isinstance(self.weight, (int, float)) or self.weight <= 0:
+            raise WorkloadError("Scenario endpoint " + self.name + ": weight must be a positive number")
+        self.headers = dict(default_headers)
+        self.headers.update(raw.get("headers", {}))
+        body = raw.get("body")
+        if body is None:
+            self.body = b""
+        elif isinstance(body, str):
+            self.body = body.encode("utf-8")
+        else:
+            self.body = json.dumps(body).encode("utf-8")
+            self.headers.setdefault("Content-Type", "application/json")
+
+
+# Scenario file format:
+# {
+#   "baseUrl": "http://localhost:3000",
+#   "headers": {"Authorization": "..."},
+#   "endpoints": [
+#     {"name": "list users", "method": "GET", "path": "/users", "weight": 3},
+#     {"method": "POST", "path": "/users", "body": {"name": "a"}}
+#   ]
+# }
+class Scenario:
+    def __init__(self, raw: dict):
+        if "baseUrl" not in raw or not isinstance(raw["baseUrl"], str):
+            raise WorkloadError("Scenario: baseUrl must be provided as a string")
+        url = urlsplit(raw["baseUrl"])
+        if url.scheme not in ("http", "https"):
+            raise WorkloadError("Scenario: baseUrl must be an http or https url")
+        self.ssl = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port if url.port else (443 if self.ssl else 80)
+        self.base_path = url.path.rstrip("/")
+        if "endpoints" not in raw or not isinstance(raw["endpoints"], list) or not raw["endpoints"]:
+            raise WorkloadError("Scenario: at least one endpoint must be provided")
+        self.endpoints = [Endpoint(e, raw.get("headers", {})) for e in raw["endpoints"]]
+        self.weights = [e.weight for e in self.endpoints]
+
+    @staticmethod
+    def load(path: str) -> "Scenario":
+        try:
+            with open(path) as f:
+                raw = json.load(f)
+        except OSError as e:
+            raise WorkloadError("Failed to open scenario file: " + str(e)) from None
+        except json.decoder.JSONDecodeError:
+            raise WorkloadError("Scenario file must be in valid json format") from None
+        return Scenario(raw)
+
+
+class RequestRecord:
+    def __init__(self, endpoint: str, start: int, end: int, status: int, error=None):
+        self.endpoint = endpoint
+        self.start = start
+        self.end = end
+        self.status = status
+        self.error = error
+
+
+def monotonic_micros() -> int:
+    return time.monotonic_ns() // 1000
+
+
+# Minimal HTTP/1.1 client over a single keep-alive connection. Only what is needed
+# to drive a local server: Content-Length and chunked bodies, reconnect on close.
+class _Connection:
+    def __init__(self, scenario: Scenario):
+        self.scenario = scenario
+        self.reader = None
+        self.writer = None
+
+    async def _open(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(
+            self.scenario.host, self.scenario.port, ssl=self.scenario.ssl or None)
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self.reader, self.writer = None, None
+
+    async def request(self, endpoint: Endpoint) -> int:
+        if self.writer is None:
+            await self._open()
+        headers = dict(endpoint.headers)
+        headers["Host"] = self.scenario.host + ":" + str(self.scenario.port)
+        headers["Content-Length"] = str(len(endpoint.body))
+        headers.setdefault("Connection", "keep-alive")
+        head = endpoint.method + " " + self.scenario.base_path + endpoint.path + " HTTP/1.1\r\n"
+        head += "".join(k + ": " + str(v) + "\r\n" for k, v in headers.items()) + "\r\n"
+        self.writer.write(head.encode("latin-1") + endpoint.body)
+        await self.writer.drain()
+        status, keep_alive = await self._read_response(endpoint.method == "HEAD")
+        if not keep_alive:
+            await self.close()
+        return status
+
+    async def _read_response(self, head_only: bool) -> Tuple[int, bool]:
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        parts = status_line.decode("latin-1").split(" ", 2)
+        status = int(parts[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        keep_alive = headers.get("connection", "").lower() != "close" and parts[0] == "HTTP/1.1"
+        if head_only or status in (204, 304) or 100 <= status < 200:
+            return status, keep_alive
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif "content-length" in headers:
+            await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            await self.reader.read()
+            keep_alive = False
+        return status, keep_alive
+
+
+class WorkloadGenerator:
+    # rate is the target number of requests per second across all workers. A rate of 0
+    # runs closed-loop, each worker sending its next request as soon as the last completes.
+    # The generator stops after total_requests requests or duration seconds, whichever
+    # is reached first. At least one of the two must be provided.
+    def __init__(self, scenario: Scenario, concurrency=10, rate=0, total_requests=None,
+                 duration=None, seed=None):
+        if total_requests is None and duration is None:
+            raise WorkloadError("Workload must be bounded by a request count or a duration")
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.rate = rate
+        self.total_requests = total_requests
+        self.duration = duration
+        self.records = []
+        self._random = random.Random(seed)
+        self._issued = 0
+        self._start = None
+
+    def run(self) -> List[RequestRecord]:
+        return asyncio.run(self.run_async())
+
+    async def run_async(self) -> List[RequestRecord]:
+        self._start = time.monotonic()
+        await asyncio.gather(*[self._worker() for _ in range(self.concurrency)])
+        return self.records
+
+    # Hands out the next request slot, sleeping until its scheduled send time when rate limited.
+    # Returns None once the workload is exhausted.
+    async def _next_slot(self):
+        if self.total_requests is not None and self._issued >= self.total_requests:
+            return None
+        slot = self._issued
+        self._issued += 1
+        if self.rate:
+            delay = self._start + slot / self.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if self.duration is not None and time.monotonic() - self._start >= self.duration:
+            return None
+        return slot
+
+    async def _worker(self) -> None:
+        conn = _Connection(self.scenario)
+        try:
+            while await self._next_slot() is not None:
+                endpoint = self._random.choices(self.scenario.endpoints, self.scenario.weights)[0]
+                start = monotonic_micros()
+                try:
+                    status = await conn.request(endpoint)
+                    error = None
+                except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    await conn.close()
+                    status, error = 0, str(e) or type(e).__name__
+                self.records.append(RequestRecord(endpoint.name, start, monotonic_micros(), status, error))
+        finally:
+            await conn.close()
+
+    def save(self, path: str) -> None:
+        with open(path, "a") as f:
+            for r in self.records:
+                f.write(json.dumps(vars(r)) + "\n")
+
+
+def load_records(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def create_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description='internal workload generator interface for nodewatts')
+    parser.add_argument('--scenario', type=str, required=True)
+    parser.add_argument('--out', type=str, required=True)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=0)
+    parser.add_argument('--requests', type=int, default=None)
+    parser.add_argument('--duration', type=float, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_cli_parser().parse_args()
+    try:
+        gen = WorkloadGenerator(Scenario.load(args.scenario), args.concurrency, args.rate,
+                                args.requests, args.duration)
+        records = gen.run()
+        gen.save(args.out)
+    except WorkloadError as e:
+        print("Workload error: " + str(e), file=sys.stderr)
+        sys.exit(1)
+    failed = len([r for r in records if r.error is not None])
+    print("Workload: " + str(len(records)) + " requests sent, " + str(failed) + " failed.")
+    sys.exit(1 if records and failed == len(records) else 0)
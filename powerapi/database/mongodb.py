@@ -67,7 +67,7 @@ class MongoIterDB(IterDB):
         Create the iterator for get the data
         """
         if not self.stream_mode:
-            self.cursor = self.db.collection.find({})
+            self.cursor = self.db.collection.find({}).sort("timestamp", 1)
         return self
 
     def __next__(self) -> Report:
@@ -78,7 +78,7 @@ class MongoIterDB(IterDB):
         if not self.stream_mode:
             json = self.cursor.next()
         else:
-            json = self.db.collection.find_one_and_delete({})
+            json = self.db.collection.find_one_and_delete({}, sort=[("timestamp", 1)])
             if json is None:
                 raise StopIteration()
 
@@ -0,0 +1,90 @@
+// Serves the report embedded in a static NodeWatts export to the visualizer bundle, in
+// place of the NodeWatts server. The visualizer requests /options and /profiles with
+// XMLHttpRequest, so XMLHttpRequest is replaced by a stand-in answering those two from the
+// page. The report is gzip compressed and base64 encoded in #nodewatts-report, and is
+// decoded once, when the visualizer first asks for it.
+(function () {
+  "use strict";
+  var report = null;
+
+  function decodeReport() {
+    if (report === null) {
+      report = new Promise(function (resolve) {
+        if (typeof DecompressionStream === "undefined") {
+          throw new Error("This browser cannot decompress the embedded report.");
+        }
+        var encoded = document.getElementById("nodewatts-report").textContent.trim();
+        var binary = atob(encoded);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+          bytes[i] = binary.charCodeAt(i);
+        }
+        var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+        resolve(new Response(stream).text());
+      });
+    }
+    return report;
+  }
+
+  // Body of the server's answer to path, or null when the server has no such route
+  function respond(path) {
+    if (path === "/options") {
+      var options = JSON.parse(document.getElementById("nodewatts-options").textContent);
+      return Promise.resolve(JSON.stringify({ fail: false, reason: "", options: options }));
+    }
+    if (path === "/profiles") {
+      return decodeReport().then(function (text) {
+        // The visualizer reads the report as a json string, like the server sends it
+        return JSON.stringify({ fail: false, reason: "", profile: text });
+      });
+    }
+    return Promise.resolve(null);
+  }
+
+  function EmbeddedRequest() {
+    this.readyState = 0;
+    this.status = 0;
+    this.statusText = "";
+    this.response = "";
+    this.responseText = "";
+    this.responseType = "";
+    this.responseURL = "";
+    this.timeout = 0;
+    this.onloadend = null;
+    this.onerror = null;
+    this.onabort = null;
+    this.ontimeout = null;
+    this._path = null;
+  }
+
+  EmbeddedRequest.prototype.open = function (method, url) {
+    this._path = new URL(url, "http://nodewatts.invalid/").pathname;
+    this.responseURL = url;
+    this.readyState = 1;
+  };
+
+  EmbeddedRequest.prototype.setRequestHeader = function () {};
+
+  EmbeddedRequest.prototype.getAllResponseHeaders = function () {
+    return "content-type: application/json\r\n";
+  };
+
+  EmbeddedRequest.prototype.abort = function () {};
+
+  EmbeddedRequest.prototype.send = function () {
+    var request = this;
+    respond(this._path).then(function (body) {
+      request.readyState = 4;
+      request.status = body === null ? 404 : 200;
+      request.statusText = body === null ? "Not Found" : "OK";
+      request.response = request.responseText = body === null ? "" : body;
+      if (request.onloadend) request.onloadend();
+    }, function (err) {
+      console.error(err);
+      request.readyState = 4;
+      if (request.onerror) request.onerror(err);
+    });
+  };
+
+  window.XMLHttpRequest = EmbeddedRequest;
+})();
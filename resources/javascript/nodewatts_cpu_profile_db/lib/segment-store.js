@@ -0,0 +1,43 @@
+const fs = require("fs"),
+    path = require("path");
+
+// Writer for the embedded raw data store, see nodewatts/raw_store.py for the format.
+// Every record is appended with a single write so several writers never interleave, and
+// each process and thread writes to a segment of its own.
+
+const CRC_TABLE = (() => {
+    const table = new Int32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        }
+        table[n] = c;
+    }
+    return table;
+})();
+
+function crc32(buf) {
+    let crc = -1;
+    for (let i = 0; i < buf.length; i++) {
+        crc = CRC_TABLE[(crc ^ buf[i]) & 0xFF] ^ (crc >>> 8);
+    }
+    return (crc ^ -1) >>> 0;
+}
+
+function appendRecord(storePath, collection, timestamp, doc) {
+    const dir = path.join(storePath, collection);
+    fs.mkdirSync(dir, {recursive: true});
+    const threadId = require("worker_threads").threadId;
+    const writer = threadId ? `${process.pid}.${threadId}` : String(process.pid);
+    const payload = Buffer.from(JSON.stringify(doc));
+    const header = Buffer.alloc(16);
+    header.writeUInt32LE(payload.length, 0);
+    header.writeBigInt64LE(BigInt(Math.trunc(timestamp || 0)), 4);
+    header.writeUInt32LE(crc32(payload), 12);
+    fs.appendFileSync(path.join(dir, `${writer}-0.seg`), Buffer.concat([header, payload]));
+}
+
+module.exports = {
+    appendRecord
+}
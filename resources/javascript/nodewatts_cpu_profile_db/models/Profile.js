@@ -1,5 +1,6 @@
 const mongoose = require("mongoose"),
-        NodeSchema = require("./Node");
+        NodeSchema = require("./Node"),
+        RunSchema = require("./Run");
 
 const ProfileSchema = new mongoose.Schema({
     userProvidedName: {type: String, required: true},
@@ -10,7 +11,12 @@ const ProfileSchema = new mongoose.Schema({
     endTime: {type: Number, required: true},
     nodes: {type: [NodeSchema], required: false},
     samples: {type: [Number], required: true},
-    timeDeltas: {type: [Number], required: true}
+    timeDeltas: {type: [Number], required: true},
+    runs: {type: [RunSchema], required: false, default: []},
+    // Set for cluster workers and worker threads, parentTitle is the title of the main profile
+    pid: {type: Number, required: false},
+    threadId: {type: Number, required: false, default: 0},
+    parentTitle: {type: String, required: false, index: true}
 })
 
 module.exports = ProfileSchema;
\ No newline at end of file
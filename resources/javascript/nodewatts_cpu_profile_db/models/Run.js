@@ -0,0 +1,10 @@
+const mongoose = require("mongoose");
+
+// Boundaries of one test suite iteration, in monotonic microseconds
+const RunSchema = new mongoose.Schema({
+    run: {type: Number, required: true},
+    start: {type: Number, required: true},
+    end: {type: Number, required: false}
+})
+
+module.exports = RunSchema;
@@ -19,10 +19,15 @@ mongoose.connection.on('open', err => {
     console.log("Profile DB connection successful");
 })
 
+// Raw profile data is namespaced by the nodewatts session that collected it
+function sessionCollection(name) {
+    return process.env.NODEWATTS_SESSION_ID ? name + "_" + process.env.NODEWATTS_SESSION_ID : name;
+}
+
 // How to handle runtime errors with this connection object?
-const Callframe = conn.model('Callframe', require("../../models/Callframe"));
-const Node = conn.model('Node', require("../../models/Node"));
-const Profile = conn.model('Profile', require("../../models/Profile"));
+const Callframe = conn.model('Callframe', require("../../models/Callframe"), sessionCollection("callframes"));
+const Node = conn.model('Node', require("../../models/Node"), sessionCollection("nodes"));
+const Profile = conn.model('Profile', require("../../models/Profile"), sessionCollection("profiles"));
 
 module.exports = {
     conn, Node, Profile, Callframe
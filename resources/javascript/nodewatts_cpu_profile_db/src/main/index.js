@@ -1,9 +1,12 @@
 const fs = require("fs"),
     pathUtil = require("../../lib/path-utils"),
-    Profile = require("./db").Profile;
+    segmentStore = require("../../lib/segment-store");
+
+// Set when nodewatts runs with the embedded raw data store instead of MongoDB
+const rawStorePath = process.env.NODEWATTS_RAW_STORE;
 
 //export function to ingest file
-async function ingestFile(path, providedName) {
+async function ingestFile(path, providedName, extra) {
     if (!pathUtil.directoryExists(path)) {
         throw "Invalid or Non-existent Directory"
     }
@@ -32,6 +35,11 @@ async function ingestFile(path, providedName) {
         newProfile.userProvidedName = (new Date).getTime().toString();
     }
 
+    // Additional fields recorded by the agent, e.g. test run boundaries
+    if (extra) {
+        Object.assign(newProfile, extra);
+    }
+
     newProfile.nodes.forEach((res) => {
         if (res.id) {
             Object.defineProperty(res, "profilerId", Object.getOwnPropertyDescriptor(res,"id"))
@@ -39,6 +47,12 @@ async function ingestFile(path, providedName) {
         }
     })
     
+    if (rawStorePath) {
+        segmentStore.appendRecord(rawStorePath, "profiles", newProfile.startTime, newProfile);
+        return Promise.resolve(newProfile);
+    }
+    // Only connect when it is needed, the embedded store runs without a MongoDB server
+    const Profile = require("./db").Profile;
     let doc = new Profile(newProfile);
     return doc.save();
 }
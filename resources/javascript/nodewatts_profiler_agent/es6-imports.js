@@ -3,8 +3,21 @@ const NWrequire = createRequire(import.meta.url);
 var nodeWattsZmq = NWrequire("nw-zeromq");
 const nodeWattsV8Profiler = NWrequire('nw-prof');
 const nodeWattsFs = NWrequire("fs");
+const nodeWattsCluster = NWrequire("cluster");
+const nodeWattsThreads = NWrequire("worker_threads");
 var nodeWattsSaveToDB = NWrequire(process.env.PATH_TO_DB_SERVICE).ingestFile;
 const nodeWattsTitle = String(process.env.PROFILE_TITLE);
 const nodeWattsPort = String(process.env.TEST_SOCKET_PORT);
 const nodeWattsPath = String(process.env.NODEWATTS_TMP_PATH);
-nodeWattsV8Profiler.setGenerateType(1);
\ No newline at end of file
+nodeWattsV8Profiler.setGenerateType(1);
+// Worker threads are profiled by a preloaded thread agent. Must be patched before user code runs.
+const nodeWattsLiveThreads = new Set();
+nodeWattsThreads.Worker = class extends nodeWattsThreads.Worker {
+  constructor(filename, options = {}) {
+    const execArgv = (options.execArgv || process.execArgv).concat(["--require", process.env.NODEWATTS_THREAD_AGENT]);
+    super(filename, Object.assign({}, options, {execArgv}));
+    this.on("online", () => nodeWattsLiveThreads.add(this.threadId));
+    this.on("exit", () => nodeWattsLiveThreads.delete(this.threadId));
+  }
+};
+NWrequire("module").syncBuiltinESMExports();
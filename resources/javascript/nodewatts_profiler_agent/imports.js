@@ -2,8 +2,20 @@
 var nodeWattsZmq = require("nw-zeromq");
 const nodeWattsV8Profiler = require('nw-prof');
 const nodeWattsFs = require("fs");
+const nodeWattsCluster = require("cluster");
+const nodeWattsThreads = require("worker_threads");
 var nodeWattsSaveToDB = require(process.env.PATH_TO_DB_SERVICE).ingestFile;
 const nodeWattsTitle = String(process.env.PROFILE_TITLE);
 const nodeWattsPort = String(process.env.TEST_SOCKET_PORT);
 const nodeWattsPath = String(process.env.NODEWATTS_TMP_PATH);
 nodeWattsV8Profiler.setGenerateType(1);
+// Worker threads are profiled by a preloaded thread agent. Must be patched before user code runs.
+const nodeWattsLiveThreads = new Set();
+nodeWattsThreads.Worker = class extends nodeWattsThreads.Worker {
+  constructor(filename, options = {}) {
+    const execArgv = (options.execArgv || process.execArgv).concat(["--require", process.env.NODEWATTS_THREAD_AGENT]);
+    super(filename, Object.assign({}, options, {execArgv}));
+    this.on("online", () => nodeWattsLiveThreads.add(this.threadId));
+    this.on("exit", () => nodeWattsLiveThreads.delete(this.threadId));
+  }
+};
@@ -1,35 +1,181 @@
+;const nodeWattsIsPrimary = nodeWattsCluster.isPrimary !== undefined ? nodeWattsCluster.isPrimary : nodeWattsCluster.isMaster;
+// Worker threads of this process listen on this channel, see thread-agent.js
+const nodeWattsChannel = new BroadcastChannel("nodewatts-" + String(process.pid));
+nodeWattsChannel.unref();
+let nodeWattsNextMsgId = 0;
+// How long to wait for sub-profilers (cluster workers, threads) to acknowledge a command
+const nodeWattsAckTimeout = 10000;
+
+function nodeWattsAwaitAcks(register, expected) {
+  return new Promise((resolve) => {
+    if (expected === 0) return resolve(0);
+    let received = 0;
+    let unregister = null;
+    const timer = setTimeout(() => { unregister(); resolve(received) }, nodeWattsAckTimeout);
+    unregister = register(() => {
+      received++;
+      if (received === expected) {
+        clearTimeout(timer);
+        unregister();
+        resolve(received);
+      }
+    });
+  });
+}
+
+// Forwards a command to the worker threads of this process and waits for each to acknowledge
+function nodeWattsCommandThreads(msg) {
+  const id = nodeWattsNextMsgId++;
+  const acks = nodeWattsAwaitAcks((onAck) => {
+    const listener = (event) => { if (event.data && event.data.ack === id) onAck() };
+    nodeWattsChannel.addEventListener("message", listener);
+    return () => nodeWattsChannel.removeEventListener("message", listener);
+  }, nodeWattsLiveThreads.size);
+  nodeWattsChannel.postMessage(Object.assign({target: "threads", id: id}, msg));
+  return acks;
+}
+
+// Forwards a command to the cluster workers and waits for each to acknowledge. Workers
+// acknowledge once they and their threads have handled it.
+function nodeWattsCommandWorkers(msg) {
+  const workers = Object.values(nodeWattsCluster.workers || {}).filter((w) => w.isConnected());
+  const id = nodeWattsNextMsgId++;
+  const acks = nodeWattsAwaitAcks((onAck) => {
+    const listener = (worker, m) => { if (m && m.nodewattsAck === id) onAck() };
+    nodeWattsCluster.on("message", listener);
+    return () => nodeWattsCluster.removeListener("message", listener);
+  }, workers.length);
+  workers.forEach((w) => w.send(Object.assign({nodewatts: true, id: id}, msg)));
+  return acks;
+}
+
+function nodeWattsExportProfile(profile) {
+  return new Promise((resolve) => {
+    profile.export(function (error, result) {
+      if (error) {
+        console.error("NodeWatts CPU Profile Export Error: " + error);
+        process.exit(9)
+      }
+      resolve(result)
+    })
+  });
+}
+
 ;async function nodeWattsRunProfilerHandler() {
   const nodeWattsSock = new nodeWattsZmq.Reply();
+  // Run boundaries reported by the test runner, saved alongside the profile
+  let nodeWattsRuns = [];
+  // Title of the profile in progress. Window mode passes a title per window with start.
+  let nodeWattsCurrentTitle = nodeWattsTitle;
   await nodeWattsSock.bind("tcp://127.0.0.1:" + nodeWattsPort);
   for await (const [msg] of nodeWattsSock) {
-    if (msg.toString() === "start") {
-    nodeWattsV8Profiler.startProfiling(nodeWattsTitle, true);
+    // Commands take the form "cmd" or "cmd:arg". Titles may contain colons so only split once.
+    const nodeWattsMsg = msg.toString();
+    const nodeWattsSep = nodeWattsMsg.indexOf(":");
+    const nodeWattsCmd = nodeWattsSep === -1 ? nodeWattsMsg : nodeWattsMsg.slice(0, nodeWattsSep);
+    const nodeWattsArg = nodeWattsSep === -1 ? null : nodeWattsMsg.slice(nodeWattsSep + 1);
+    if (nodeWattsCmd === "start") {
+    nodeWattsRuns = [];
+    nodeWattsCurrentTitle = nodeWattsArg !== null ? nodeWattsArg : nodeWattsTitle;
+    nodeWattsV8Profiler.startProfiling(nodeWattsCurrentTitle, true);
+    await Promise.all([nodeWattsCommandWorkers({cmd: "start", title: nodeWattsCurrentTitle}),
+      nodeWattsCommandThreads({cmd: "start", title: nodeWattsCurrentTitle})]);
     await nodeWattsSock.send("start-success")
-    } else if (msg.toString() === "stop-save") {
-      const nodeWattsProfile = nodeWattsV8Profiler.stopProfiling(nodeWattsTitle);
-      const nodeWattsProfilePath = `${nodeWattsPath}/${nodeWattsTitle}.cpuprofile`;
-      nodeWattsProfile.export( async function (error, result) {
-        if (error) {
-          console.error("NodeWatts CPU Profile Export Error: " + error);
-          process.exit(9)
-          }
-        nodeWattsFs.writeFileSync(nodeWattsProfilePath, result); 
+    } else if (nodeWattsCmd === "interval") {
+      // Sampling interval in microseconds, applies to the next start
+      nodeWattsV8Profiler.setSamplingInterval(Number(nodeWattsArg));
+      await Promise.all([nodeWattsCommandWorkers({cmd: "interval", interval: Number(nodeWattsArg)}),
+        nodeWattsCommandThreads({cmd: "interval", interval: Number(nodeWattsArg)})]);
+      await nodeWattsSock.send("interval-success")
+    } else if (nodeWattsCmd === "run-start") {
+      const [nodeWattsRunIdx, nodeWattsRunTs] = nodeWattsArg.split(":");
+      nodeWattsRuns.push({run: Number(nodeWattsRunIdx), start: Number(nodeWattsRunTs), end: null});
+      await nodeWattsSock.send("run-start-success")
+    } else if (nodeWattsCmd === "run-end") {
+      const [nodeWattsRunIdx, nodeWattsRunTs] = nodeWattsArg.split(":");
+      const nodeWattsRun = nodeWattsRuns.find((r) => r.run === Number(nodeWattsRunIdx));
+      if (nodeWattsRun) nodeWattsRun.end = Number(nodeWattsRunTs);
+      await nodeWattsSock.send("run-end-success")
+    } else if (nodeWattsCmd === "stop-save") {
+      const nodeWattsSavedTitle = nodeWattsCurrentTitle;
+      const nodeWattsProfile = nodeWattsV8Profiler.stopProfiling(nodeWattsSavedTitle);
+      const nodeWattsProfilePath = `${nodeWattsPath}/${nodeWattsSavedTitle}.cpuprofile`;
+      // Workers and threads save their own profiles before acknowledging, so the engine
+      // finds every sub-profile once the reply is sent
+      const nodeWattsSubResults = Promise.all([nodeWattsCommandWorkers({cmd: "stop-save"}),
+        nodeWattsCommandThreads({cmd: "stop-save"})]);
+      // The reply must be sent before the next message is received, so wait for the export
+      const nodeWattsResult = await nodeWattsExportProfile(nodeWattsProfile);
+      nodeWattsFs.writeFileSync(nodeWattsProfilePath, nodeWattsResult);
+      nodeWattsProfile.delete();
+      await nodeWattsSubResults;
+      await nodeWattsSock.send("stop-success");
+      nodeWattsSaveToDB(nodeWattsProfilePath, nodeWattsSavedTitle, {runs: nodeWattsRuns, pid: process.pid, threadId: 0})
+      .then(() => {
+        console.log("Profile Saved to DB Successfully.")
+        // Window mode produces a file per window, the DB copy is all that is needed
+        if (nodeWattsSavedTitle !== nodeWattsTitle) nodeWattsFs.unlinkSync(nodeWattsProfilePath);
+      })
+      .catch((err) => {
+        console.error("NodeWatts DB Save Error: " + err )
+        process.exit(9)
+      });
+    } else if (nodeWattsCmd === 'stop-discard'){
+        nodeWattsV8Profiler.stopProfiling(nodeWattsCurrentTitle)
+        await Promise.all([nodeWattsCommandWorkers({cmd: "stop-discard"}),
+          nodeWattsCommandThreads({cmd: "stop-discard"})]);
+        await nodeWattsSock.send("discard-success")
+    }
+  }
+}
+
+// Cluster workers run the same entry file. They take commands from the primary over IPC
+// instead of binding the socket, and save their profile as "<title>#<pid>".
+;function nodeWattsRunWorkerHandler() {
+  let nodeWattsWorkerTitle = null;
+  let nodeWattsParentTitle = null;
+  process.on("message", async (m) => {
+    if (!m || m.nodewatts !== true) return;
+    try {
+      if (m.cmd === "start") {
+        nodeWattsParentTitle = m.title;
+        nodeWattsWorkerTitle = m.title + "#" + String(process.pid);
+        nodeWattsV8Profiler.startProfiling(nodeWattsWorkerTitle, true);
+        await nodeWattsCommandThreads({cmd: "start", title: m.title});
+      } else if (m.cmd === "interval") {
+        nodeWattsV8Profiler.setSamplingInterval(m.interval);
+        await nodeWattsCommandThreads({cmd: "interval", interval: m.interval});
+      } else if (m.cmd === "stop-save" && nodeWattsWorkerTitle !== null) {
+        const nodeWattsThreadAcks = nodeWattsCommandThreads({cmd: "stop-save"});
+        const nodeWattsProfile = nodeWattsV8Profiler.stopProfiling(nodeWattsWorkerTitle);
+        const nodeWattsProfilePath = `${nodeWattsPath}/${nodeWattsWorkerTitle}.cpuprofile`;
+        nodeWattsFs.writeFileSync(nodeWattsProfilePath, await nodeWattsExportProfile(nodeWattsProfile));
         nodeWattsProfile.delete();
-        await nodeWattsSock.send("stop-success");
-        await nodeWattsSaveToDB(nodeWattsProfilePath, nodeWattsTitle)
-        .then(() => {
-          console.log("Profile Saved to DB Successfully.")
-        })
-        .catch((err) => {
-          console.error("NodeWatts DB Save Error: " + err )
-          process.exit(9)
-        });
+        await nodeWattsSaveToDB(nodeWattsProfilePath, nodeWattsWorkerTitle,
+          {pid: process.pid, threadId: 0, parentTitle: nodeWattsParentTitle});
+        nodeWattsFs.unlinkSync(nodeWattsProfilePath);
+        await nodeWattsThreadAcks;
+        nodeWattsWorkerTitle = null;
+      } else if (m.cmd === "stop-discard" && nodeWattsWorkerTitle !== null) {
+        nodeWattsV8Profiler.stopProfiling(nodeWattsWorkerTitle);
+        await nodeWattsCommandThreads({cmd: "stop-discard"});
+        nodeWattsWorkerTitle = null;
       }
-    )} else if (msg.toString() === 'stop-discard'){
-        nodeWattsV8Profiler.stopProfiling(nodeWattsTitle)
+    } catch (err) {
+      console.error("NodeWatts worker " + String(process.pid) + " error: " + err)
     }
-  }
+    process.send({nodewattsAck: m.id});
+  });
+}
+
+if (nodeWattsIsPrimary) {
+  nodeWattsRunProfilerHandler();
+  var nodeWattsPID = process.pid;
+  nodeWattsFs.writeFileSync(nodeWattsPath+'/PID.txt', nodeWattsPID.toString());
+  // Worker pids are picked up by nodewatts so each worker gets its own cgroup
+  nodeWattsCluster.on("online", (worker) => {
+    nodeWattsFs.appendFileSync(nodeWattsPath+'/workers.txt', String(worker.process.pid) + "\n");
+  });
+} else {
+  nodeWattsRunWorkerHandler();
 }
-nodeWattsRunProfilerHandler();
-var nodeWattsPID = process.pid;
-nodeWattsFs.writeFileSync(nodeWattsPath+'/PID.txt', nodeWattsPID.toString());
\ No newline at end of file
@@ -1,25 +1,35 @@
 const port = process.env.TEST_SOCKET_PORT; // Nodewatts processs will inject these vars
-const testCmd = process.env.TESTCMD.split(' ')
+// The built-in load driver passes its arguments as a JSON array, they may contain spaces
+const testCmd = process.env.TESTCMD_ARGS ? JSON.parse(process.env.TESTCMD_ARGS) : process.env.TESTCMD.split(' ')
+const testRuns = parseInt(process.env.TEST_RUNS || "1")
+// Optional: V8 sampling interval in microseconds and a profile title other than the session's
+const samplingInterval = process.env.V8_SAMPLING_INTERVAL
+const runTitle = process.env.RUN_TITLE
 const zmqModule = process.env.ZMQ_INSTALLED_PATH
 var zmq = require(zmqModule);
 const { spawn } = require('child_process');
-const events = require('events');
 const { exit } = require("process");
-const emitter = new events.EventEmitter();
 
 var cmd = testCmd[0]
 testCmd.splice(0,1)
 var args = testCmd
 
-async function testRunner() {
-  const sock = new zmq.Request();
-  sock.connect("tcp://127.0.0.1:" + String(port));
-  console.log("Runner: Test runner started.")
-  await sock.send("start");
+// Microseconds on the monotonic clock, the same clock used by the V8 profiler
+// timestamps and the python side's time.monotonic_ns()
+function nowMicros() {
+  return (process.hrtime.bigint() / 1000n).toString()
+}
+
+// Every message on the REQ socket must be answered before the next one is sent
+async function request(sock, msg) {
+  await sock.send(msg)
   const [res] = await sock.receive();
-  if (res.toString() === "start-success") {
-    console.log("Runner: Test Runner received successful start msg from server. Running test suite")
-    testingProc = spawn(cmd, args);
+  return res.toString()
+}
+
+function runSuiteOnce() {
+  return new Promise((resolve) => {
+    const testingProc = spawn(cmd, args);
     // Parrot child output stream up to parent so python script can use for debugging output
     testingProc.stderr.on('data',(data)=>{
       console.error(data.toString('utf8'))
@@ -27,29 +37,43 @@ async function testRunner() {
     testingProc.stdout.on('data', (data) => {
       console.log(data.toString('utf8'))
     })
-    testingProc.on('close', async function(exitCode) {
-      if (parseInt(exitCode) !== 0) {
-          console.error("Runner: Testing child process exited with return code " + String(exitCode))
-          console.error("Runner: Telling server to discard profile.")
-          await sock.send('stop-discard')
-          exit(1)
-      }
-      if (process.env.FINAL_RUN){
-        emitter.emit('tests-success');
-      } else{
-        exit(0)
-      }
-    });
-    emitter.on('tests-success', async function() {
-      console.log("Runner: Tests completed Successfully. Sending stop message to server")
-      await sock.send("stop-save")
-      const [res] = await sock.receive();
-      if (res.toString() === "stop-success") {
-        console.log("Runner: Received stop success message from server. Exiting")
-        exit(0)
-      };
-    })
+    testingProc.on('close', (exitCode) => resolve(parseInt(exitCode)));
+  })
+}
+
+async function testRunner() {
+  const sock = new zmq.Request();
+  sock.connect("tcp://127.0.0.1:" + String(port));
+  console.log("Runner: Test runner started.")
+  if (samplingInterval) {
+    await request(sock, "interval:" + samplingInterval)
+  }
+  if (await request(sock, runTitle ? "start:" + runTitle : "start") !== "start-success") {
+    console.error("Runner: Server failed to start profiling.")
+    exit(1)
+  }
+  console.log("Runner: Test Runner received successful start msg from server. Running test suite " + String(testRuns) + " times")
+  for (let i = 0; i < testRuns; i++) {
+    const start = nowMicros()
+    await request(sock, "run-start:" + String(i) + ":" + start)
+    const exitCode = await runSuiteOnce()
+    const end = nowMicros()
+    if (exitCode !== 0) {
+      console.error("Runner: Testing child process exited with return code " + String(exitCode))
+      console.error("Runner: Telling server to discard profile.")
+      await request(sock, "stop-discard")
+      exit(1)
+    }
+    await request(sock, "run-end:" + String(i) + ":" + end)
+    console.log("Runner: Run " + String(i+1) + "/" + String(testRuns) + " complete in "
+      + String((BigInt(end) - BigInt(start)) / 1000n) + "ms")
   }
+  console.log("Runner: Tests completed Successfully. Sending stop message to server")
+  if (await request(sock, "stop-save") === "stop-success") {
+    console.log("Runner: Received stop success message from server. Exiting")
+    exit(0)
+  };
+  exit(1)
 }
 
-testRunner();
\ No newline at end of file
+testRunner();
@@ -0,0 +1,50 @@
+// Preloaded into every worker thread of the profiled server. Profiles the thread when
+// told to by its process's agent over a per-process broadcast channel, and saves the
+// profile under the session title suffixed with the pid and thread id.
+const { isMainThread, threadId } = require("worker_threads");
+
+if (!isMainThread) {
+  const fs = require("fs");
+  const v8Profiler = require(process.env.PROFILER_INSTALLED_PATH);
+  const saveToDB = require(process.env.PATH_TO_DB_SERVICE).ingestFile;
+  const tmpPath = String(process.env.NODEWATTS_TMP_PATH);
+  v8Profiler.setGenerateType(1);
+  const channel = new BroadcastChannel("nodewatts-" + String(process.pid));
+  channel.unref();
+  let current = null;
+  let parentTitle = null;
+
+  function exportProfile(profile) {
+    return new Promise((resolve, reject) => {
+      profile.export((error, result) => error ? reject(error) : resolve(result))
+    })
+  }
+
+  channel.onmessage = async (event) => {
+    const msg = event.data;
+    if (!msg || msg.target !== "threads") return;
+    try {
+      if (msg.cmd === "interval") {
+        v8Profiler.setSamplingInterval(msg.interval);
+      } else if (msg.cmd === "start") {
+        parentTitle = msg.title;
+        current = msg.title + "#" + String(process.pid) + "." + String(threadId);
+        v8Profiler.startProfiling(current, true);
+      } else if (msg.cmd === "stop-save" && current !== null) {
+        const profile = v8Profiler.stopProfiling(current);
+        const path = `${tmpPath}/${current}.cpuprofile`;
+        fs.writeFileSync(path, await exportProfile(profile));
+        profile.delete();
+        await saveToDB(path, current, {pid: process.pid, threadId: threadId, parentTitle: parentTitle});
+        fs.unlinkSync(path);
+        current = null;
+      } else if (msg.cmd === "stop-discard" && current !== null) {
+        v8Profiler.stopProfiling(current);
+        current = null;
+      }
+    } catch (err) {
+      console.error("NodeWatts thread agent error in thread " + String(threadId) + ": " + err);
+    }
+    channel.postMessage({ack: msg.id, threadId: threadId});
+  };
+}
@@ -0,0 +1,73 @@
+const port = process.env.TEST_SOCKET_PORT; // Nodewatts processs will inject these vars
+const title = process.env.PROFILE_TITLE
+const windowSeconds = parseFloat(process.env.WINDOW_SECONDS)
+// Total capture time in seconds, runs until signalled when not provided
+const duration = process.env.WINDOW_DURATION ? parseFloat(process.env.WINDOW_DURATION) : null
+const samplingInterval = process.env.V8_SAMPLING_INTERVAL
+const zmqModule = process.env.ZMQ_INSTALLED_PATH
+var zmq = require(zmqModule);
+const { exit } = require("process");
+
+// Microseconds on the monotonic clock, the same clock used by the V8 profiler
+// timestamps and the python side's time.monotonic_ns()
+function nowMicros() {
+  return (process.hrtime.bigint() / 1000n).toString()
+}
+
+async function request(sock, msg) {
+  await sock.send(msg)
+  const [res] = await sock.receive();
+  return res.toString()
+}
+
+// The current window is closed and saved before exiting when asked to stop
+let stopRequested = false
+let wake = null
+function requestStop() {
+  stopRequested = true
+  if (wake) wake()
+}
+process.on('SIGTERM', requestStop)
+process.on('SIGINT', requestStop)
+
+function sleep(seconds) {
+  return new Promise((resolve) => {
+    const timer = setTimeout(resolve, seconds * 1000)
+    wake = () => { clearTimeout(timer); resolve() }
+  })
+}
+
+async function windowRunner() {
+  const sock = new zmq.Request();
+  sock.connect("tcp://127.0.0.1:" + String(port));
+  console.log("Runner: Window runner started.")
+  if (samplingInterval) {
+    await request(sock, "interval:" + samplingInterval)
+  }
+  const began = Date.now()
+  for (let i = 0; !stopRequested; i++) {
+    const windowTitle = title + "-w" + String(i)
+    const start = nowMicros()
+    if (await request(sock, "start:" + windowTitle) !== "start-success") {
+      console.error("Runner: Server failed to start profiling window " + String(i))
+      exit(1)
+    }
+    let length = windowSeconds
+    if (duration !== null) {
+      length = Math.min(length, duration - (Date.now() - began) / 1000)
+    }
+    await sleep(length)
+    const end = nowMicros()
+    if (await request(sock, "stop-save") !== "stop-success") {
+      console.error("Runner: Server failed to save profile for window " + String(i))
+      exit(1)
+    }
+    // Parsed by nodewatts: index, profile title, start and end in microseconds
+    console.log("Window: " + [String(i), windowTitle, start, end].join(" "))
+    if (duration !== null && (Date.now() - began) / 1000 >= duration) break
+  }
+  console.log("Runner: Window capture finished. Exiting")
+  exit(0)
+}
+
+windowRunner();
@@ -0,0 +1,15 @@
+// The visualizer bundle requests the server at http://localhost:8080, where the local
+// viewer runs. Requests are made relative to the page instead, so the served visualizer
+// works on any host and port. Loaded by the server ahead of the bundle.
+(function () {
+  "use strict";
+  var origin = "http://localhost:8080/";
+  var open = XMLHttpRequest.prototype.open;
+  XMLHttpRequest.prototype.open = function (method, url) {
+    var args = Array.prototype.slice.call(arguments);
+    if (typeof url === "string" && url.indexOf(origin) === 0) {
+      args[1] = url.slice(origin.length);
+    }
+    return open.apply(this, args);
+  };
+})();
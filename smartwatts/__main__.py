@@ -52,7 +52,6 @@ from smartwatts.actor import SmartWattsFormulaActor, SmartwattsValues
 from smartwatts.context import SmartWattsFormulaScope, SmartWattsFormulaConfig
 from smartwatts.topology import CPUTopology
 
-from nodewatts.__main__ import term_handler as nodewatts_term_handler
 
 
 def generate_smartwatts_parser():
@@ -176,11 +175,15 @@ class SmartwattsRuntimeException(Exception):
         super().__init__(msg, *args, **kwargs)
 
 
-def run_smartwatts(args, direct_call=False) -> None:
+def run_smartwatts(args, direct_call=False, on_terminate=None, db_factories=None) -> None:
     """
     Run PowerAPI with the SmartWatts formula.
     :param args: CLI arguments namespace
     :param logger: Logger to use for the actors
+    :param on_terminate: Called after the actors are shut down on SIGINT/SIGTERM.
+                         Defaults to the handler installed before this call, such as
+                         the NodeWatts term handler.
+    :param db_factories: Additional output database types, name to factory taking the pusher config
     """
     """
     NodeWatts branch note:
@@ -217,9 +220,17 @@ def run_smartwatts(args, direct_call=False) -> None:
 
     supervisor = Supervisor(args['verbose'])
 
-    def term_handler(_, __):
+    # Chaining to the previous handler keeps this module independent of the caller
+    previous_handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    def term_handler(signum, frame):
         supervisor.shutdown()
-        nodewatts_term_handler(_, __)
+        if on_terminate is not None:
+            on_terminate(signum, frame)
+        elif callable(previous_handlers[signum]):
+            previous_handlers[signum](signum, frame)
+        else:
+            sys.exit(0)
 
     signal.signal(signal.SIGTERM, term_handler)
     signal.signal(signal.SIGINT, term_handler)
@@ -228,6 +239,8 @@ def run_smartwatts(args, direct_call=False) -> None:
 
         pusher_generator = PusherGenerator()
         pusher_generator.add_model_factory('FormulaReport', FormulaReport)
+        for db_name, db_factory in (db_factories or {}).items():
+            pusher_generator.add_db_factory(db_name, db_factory)
         pushers_info = pusher_generator.generate(args)
         pushers_formula = {}
         pushers_power = {}
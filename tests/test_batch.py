@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from nodewatts.batch import BatchError, failure_reason, load_batch
+
+
+def write(path, content):
+    path.write_text(json.dumps(content))
+    return str(path)
+
+
+@pytest.fixture
+def configs(tmp_path):
+    write(tmp_path / "api.json", {"rootDirectory": "/srv/api", "env": {"PORT": "3000"}})
+    write(tmp_path / "worker.json", {"rootDirectory": "/srv/worker"})
+    return tmp_path
+
+
+def test_config_list(configs):
+    settings, entries = load_batch(write(configs / "nightly.json", {"configs": ["api.json", "worker.json"]}))
+    assert settings["name"] == "nightly"
+    assert settings["engine_workers"] >= 1
+    assert settings["summary_file"] is None
+    assert [e.label for e in entries] == ["api", "worker"]
+    assert entries[0].raw["rootDirectory"] == "/srv/api"
+
+
+def test_matrix(configs):
+    path = write(configs / "batch.json", {
+        "name": "matrix",
+        "matrix": {"config": "api.json", "nodeVersions": ["16.15.1", "18.12.0"],
+                   "env": [{"NODE_ENV": "production"}, {"NODE_ENV": "development"}]},
+        "engineWorkers": 2,
+        "summaryFile": "summary.json"
+    })
+    settings, entries = load_batch(path)
+    assert settings == {"name": "matrix", "engine_workers": 2, "summary_file": str(configs / "summary.json")}
+    assert [e.label for e in entries] == [
+        "api-node16.15.1-NODE_ENV=production", "api-node16.15.1-NODE_ENV=development",
+        "api-node18.12.0-NODE_ENV=production", "api-node18.12.0-NODE_ENV=development"]
+    first = entries[0].raw
+    assert first["nvm-mode"] is True
+    assert first["nvm-node-version"] == "16.15.1"
+    assert first["env"] == {"PORT": "3000", "NODE_ENV": "production"}
+    # Entries are independent copies of the base config
+    assert entries[1].raw["env"]["NODE_ENV"] == "development"
+
+
+def test_duplicate_labels_are_numbered(configs):
+    _, entries = load_batch(write(configs / "b.json", {"configs": ["api.json", "api.json", "api.json"]}))
+    assert [e.label for e in entries] == ["api", "api-2", "api-3"]
+
+
+@pytest.mark.parametrize("content, message", [
+    ([], "expected object"),
+    ({}, "lists no configs"),
+    ({"configs": "api.json"}, "configs"),
+    ({"configs": ["missing.json"]}, "Failed to read config file"),
+    ({"configs": ["api.json"], "engineWorkers": 0}, "engineWorkers"),
+    ({"matrix": {"config": "api.json", "env": ["production"]}}, "env"),
+])
+def test_invalid_batch_files(configs, content, message):
+    with pytest.raises(BatchError, match=message):
+        load_batch(write(configs / "bad.json", content))
+
+
+def test_invalid_json(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text("{")
+    with pytest.raises(BatchError, match="valid json"):
+        load_batch(str(path))
+
+
+def test_failure_reason():
+    assert failure_reason("report generation failed", ValueError("max() arg is an empty sequence")) \
+        == "report generation failed: max() arg is an empty sequence"
+    # Errors logged where they were raised have no message
+    assert failure_reason("profiling failed", BatchError(None)) == "profiling failed: BatchError"
+    assert failure_reason("profiling failed", RuntimeError()) == "profiling failed: RuntimeError"
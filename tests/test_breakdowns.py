@@ -0,0 +1,100 @@
+import re
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+from nodewatts.nwengine.report import Report
+from nodewatts.viz_server.breakdowns import _CLASSIFY_PIPELINE, BreakdownError, energy_by, energy_by_time
+
+REPORT = ObjectId()
+
+
+def rollups(node_map, start_time=0):
+    # Only the fields _build_rollups reads
+    r = Report.__new__(Report)
+    r.node_map = {i: SimpleNamespace(call_frame={"functionName": name, "url": url}, joules=joules,
+                                     hit_count=hit_count)
+                  for i, (name, url, joules, hit_count) in node_map.items()}
+    r._window_width = 100000
+    r._window_joules = {}
+    return r._build_rollups(start_time)
+
+
+class Reports:
+    def __init__(self, doc):
+        self.doc = doc
+
+    def find_one(self, report_id, projection=None):
+        return self.doc if report_id == REPORT else None
+
+
+# The $switch of the aggregation fallback, evaluated in Python over one node
+def classify_like_pipeline(call_frame: dict) -> list:
+    key = next(stage["$project"]["key"]["$let"] for stage in _CLASSIFY_PIPELINE
+               if "key" in stage.get("$project", {}))
+    url = call_frame.get("url") or ""
+    if url == "":
+        return ["system", call_frame.get("functionName")]
+    core = re.search(key["vars"]["core"]["$regexFind"]["regex"], url)
+    if core is not None:
+        return ["core_modules", core.group(1)]
+    pkg = re.search(key["vars"]["pkg"]["$regexFind"]["regex"], url)
+    if pkg is not None:
+        return ["packages", pkg.group(1)]
+    return ["files", url]
+
+
+@pytest.mark.parametrize("url", [
+    "",
+    "node:internal/timers",
+    "node:events",
+    "file:///srv/api/node_modules/express/lib/router/layer.js",
+    "file:///srv/api/node_modules/@types/node/index.js",
+    "file:///srv/api/node_modules/body-parser/node_modules/qs/lib/parse.js",
+    "/srv/api/node_modules/pg/lib/client.js",
+    "file:///srv/api/app.js",
+    "file:///srv/my_node_modules/app.js",
+])
+def test_fallback_classifies_like_the_engine(url):
+    totals = rollups({1: ("fn", url, 1.0, 1)})
+    group = next(g for g in ("packages", "core_modules", "files", "system") if totals[g])
+    assert [group, next(iter(totals[group]))] == classify_like_pipeline({"functionName": "fn", "url": url})
+
+
+def time_windows(joules, start=1200000, origin=1150000, width=100000):
+    return Reports({"stats": {"joules": sum(joules)},
+                    "rollups": {"time_windows": {"start": start, "origin": origin, "width": width,
+                                                 "joules": joules}}})
+
+
+def test_saved_windows():
+    res = energy_by_time(time_windows([1.0, 0, 2.0]), REPORT, None)
+    assert res["width"] == 100
+    assert [w["start"] for w in res["windows"]] == [50, 150, 250]
+    assert [w["avg_watts"] for w in res["windows"]] == pytest.approx([10.0, 0, 20.0])
+
+
+def test_windows_are_merged_to_a_multiple_of_the_saved_width():
+    # 250ms rounds up to three 100ms windows, the last merged window is partial
+    res = energy_by_time(time_windows([1.0, 1.0, 1.0, 2.0, 2.0]), REPORT, 250)
+    assert res["width"] == 300
+    assert [w["start"] for w in res["windows"]] == [50, 350]
+    assert [w["joules"] for w in res["windows"]] == [3.0, 4.0]
+    assert res["windows"][0]["avg_watts"] == pytest.approx(10.0)
+
+
+def test_empty_profile():
+    reports = Reports({"stats": {"joules": 0}, "rollups": rollups({1: ("(root)", "", 0, 0)}, 1150000)})
+    res = energy_by_time(reports, REPORT, 1000)
+    assert res["windows"] == [{"start": -50, "joules": 0, "avg_watts": 0}]
+    page = energy_by(reports, REPORT, "files", 0, 10)
+    assert (page["total"], page["joules"], page["entries"]) == (0, 0, [])
+
+
+def test_old_and_missing_reports():
+    with pytest.raises(BreakdownError, match="older"):
+        energy_by_time(Reports({"stats": {"joules": 1.0}}), REPORT, None)
+    with pytest.raises(BreakdownError, match="not found"):
+        energy_by_time(Reports({}), ObjectId(), None)
+
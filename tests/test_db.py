@@ -0,0 +1,35 @@
+import pytest
+
+from nodewatts import db as nwdb
+from nodewatts.db import Database
+
+
+class FakeDB:
+    def __init__(self, names):
+        self.names = set(names)
+
+    def list_collection_names(self):
+        return sorted(self.names)
+
+    def drop_collection(self, name):
+        self.names.discard(name)
+
+    def __getitem__(self, name):
+        return None
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    fake = FakeDB(["reports", "catalogue", "live_updates", "cpu", "profiles",
+                   "sensor_raw_live", "cpu_live", "nodes_live",
+                   "sensor_raw_gone", "cpu_gone", "profiles_gone", "requests_gone",
+                   "nodes_gone", "callframes_gone", "cpu_old_run"])
+    monkeypatch.setattr(nwdb.clients, "get", lambda uri: {"nodewatts": fake})
+    return fake
+
+
+def test_drop_orphaned_raw_data(mongo, tmp_path):
+    (tmp_path / "live").mkdir()
+    Database("mongodb://localhost:27017", session_id="live").drop_orphaned_raw_data(str(tmp_path))
+    assert mongo.list_collection_names() == ["catalogue", "cpu", "cpu_live", "live_updates",
+                                             "nodes_live", "profiles", "reports", "sensor_raw_live"]
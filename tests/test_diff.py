@@ -0,0 +1,107 @@
+import pytest
+from bson import ObjectId
+
+from nodewatts.viz_server.diff import DiffError, FunctionDiff, function_energy
+
+BASE, HEAD = ObjectId(), ObjectId()
+
+
+def energy(name, functions):
+    return {"name": name, "joules": sum(own for own, _ in functions.values()), "functions": functions}
+
+
+@pytest.fixture
+def changes():
+    base = energy("before", {
+        "same@file:///a.js:1:0": (1.0, 2.0),
+        "slower@file:///a.js:2:0": (1.0, 1.0),
+        "faster@file:///a.js:3:0": (3.0, 3.0),
+        "callee_slower@file:///a.js:4:0": (0.5, 1.0),
+        "gone@file:///b.js:1:0": (0.5, 0.5),
+    })
+    head = energy("after", {
+        "same@file:///a.js:1:0": (1.0, 2.0),
+        "slower@file:///a.js:2:0": (2.0, 2.0),
+        "faster@file:///a.js:3:0": (1.0, 1.0),
+        "callee_slower@file:///a.js:4:0": (0.5, 3.0),
+        "new@file:///c.js:10:4": (0.25, 0.25),
+    })
+    return FunctionDiff(base, head, BASE, HEAD)
+
+
+def names(page):
+    return [f["function_name"] for f in page["functions"]]
+
+
+def test_summary(changes):
+    page = changes.page("impact", False, 0, 50)
+    assert page["base"] == {"id": str(BASE), "name": "before", "joules": 6.0}
+    assert page["head"]["joules"] == 4.75
+    assert page["delta_joules"] == -1.25
+    assert (page["unchanged"], page["added"], page["removed"]) == (1, 1, 1)
+    assert page["total"] == 5
+
+
+def test_impact_ranks_every_change(changes):
+    page = changes.page("impact", False, 0, 50)
+    assert names(page) == ["faster", "slower", "gone", "new", "callee_slower"]
+    assert names(changes.page("impact", False, 1, 2)) == ["slower", "gone"]
+
+
+def test_regressions_and_improvements_are_filtered(changes):
+    regressions = changes.page("regressions", False, 0, 50)
+    assert names(regressions) == ["slower", "new"]
+    assert regressions["total"] == 2
+    improvements = changes.page("improvements", False, 0, 50)
+    assert names(improvements) == ["faster", "gone"]
+    assert improvements["total"] == 2
+    # The callee's energy only shows in the caller's inclusive energy
+    regressions = changes.page("regressions", True, 0, 1)
+    assert names(regressions) == ["callee_slower"]
+    assert regressions["total"] == 3
+
+
+def test_rows(changes):
+    rows = {f["function_name"]: f for f in changes.page("impact", True, 0, 50)["functions"]}
+    assert rows["new"]["url"] == "file:///c.js"
+    assert (rows["new"]["line"], rows["new"]["column"]) == (10, 4)
+    assert rows["new"]["status"] == "added"
+    assert rows["new"]["change"] is None
+    assert rows["gone"]["status"] == "removed"
+    assert rows["faster"]["delta_joules"] == -2.0
+    assert rows["faster"]["change"] == pytest.approx(-2 / 3)
+    assert rows["callee_slower"]["delta_inclusive_joules"] == 2.0
+
+
+def test_old_reports_have_no_inclusive_energy():
+    base = energy("before", {"f@file:///a.js:1:0": (1.0, None)})
+    head = energy("after", {"f@file:///a.js:1:0": (2.0, None)})
+    changes = FunctionDiff(base, head, BASE, HEAD)
+    assert not changes.has_inclusive
+    assert changes.page("impact", False, 0, 10)["functions"][0]["delta_inclusive_joules"] is None
+    with pytest.raises(DiffError, match="Inclusive"):
+        changes.page("impact", True, 0, 10)
+
+
+def test_unknown_sort(changes):
+    with pytest.raises(DiffError, match="sort"):
+        changes.page("largest", False, 0, 10)
+
+
+class Reports:
+    def __init__(self, docs):
+        self.docs = {d["_id"]: d for d in docs}
+
+    def find_one(self, report_id, projection=None):
+        return self.docs.get(report_id)
+
+
+def test_function_energy_from_collapsed_stacks():
+    # a calls b, b calls itself: b counts once per stack in its inclusive energy
+    report = {"_id": BASE, "name": "r", "stats": {"joules": 3.0}, "flame": {
+        "frames": ["a@x:1:0", "b@x:2:0"],
+        "stacks": {"frames": [[0], [0, 1], [0, 1, 1]], "self": [1.0, 1.0, 1.0]}}}
+    res = function_energy(Reports([report]), BASE)
+    assert res["functions"] == {"a@x:1:0": (1.0, 3.0), "b@x:2:0": (2.0, 2.0)}
+    with pytest.raises(DiffError, match="not found"):
+        function_energy(Reports([]), HEAD)
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+from nodewatts.journal import SessionJournal
+
+
+def session(sessions_dir, session_id, config_file, *stages):
+    path = sessions_dir / session_id
+    path.mkdir()
+    journal = SessionJournal(str(path))
+    journal.record("session", session_id=session_id, config_file=config_file)
+    for stage in stages:
+        journal.record(stage)
+    return journal
+
+
+def test_entries_are_read_back(tmp_path):
+    journal = session(tmp_path, "s", "/c.json", "collect")
+    journal.record("formula")
+    read = SessionJournal(str(tmp_path / "s"))
+    assert read.get("session")["config_file"] == "/c.json"
+    assert read.done("formula")
+    assert read.next_stage() == "engine"
+
+
+def test_torn_line_is_cut_off_before_appending(tmp_path):
+    session(tmp_path, "s", "/c.json", "collect")
+    with open(tmp_path / "s" / SessionJournal.file_name, "a") as f:
+        f.write('{"stage": "form')
+    journal = SessionJournal(str(tmp_path / "s"))
+    assert not journal.done("formula")
+    journal.record("formula")
+    journal.record("engine")
+    read = SessionJournal(str(tmp_path / "s"))
+    assert read.next_stage() is None
+    with open(tmp_path / "s" / SessionJournal.file_name) as f:
+        assert [json.loads(line)["stage"] for line in f] == ["session", "collect", "formula", "engine"]
+
+
+def test_unterminated_last_line_is_torn(tmp_path):
+    session(tmp_path, "s", "/c.json")
+    with open(tmp_path / "s" / SessionJournal.file_name, "a") as f:
+        f.write(json.dumps({"stage": "collect"}))
+    assert not SessionJournal(str(tmp_path / "s")).done("collect")
+
+
+def test_lock_is_exclusive(tmp_path):
+    journal = session(tmp_path, "s", "/c.json")
+    assert not SessionJournal.in_use(journal.dir)
+    assert journal.lock()
+    assert SessionJournal.in_use(journal.dir)
+    assert not SessionJournal(journal.dir).lock()
+    assert not SessionJournal(str(tmp_path / "missing")).lock()
+
+
+def test_find_resumable(tmp_path):
+    config = os.path.abspath("nodewatts.json")
+    assert SessionJournal.find_resumable(str(tmp_path / "none"), config) is None
+    session(tmp_path, "not_collected", config)
+    session(tmp_path, "finished", config, "collect", "formula", "engine")
+    session(tmp_path, "other_config", "/other.json", "collect")
+    session(tmp_path, "older", config, "collect")
+    time.sleep(0.01)
+    running = session(tmp_path, "running", config, "collect")
+    assert running.lock()
+    assert SessionJournal.find_resumable(str(tmp_path), config) == "older"
+    time.sleep(0.01)
+    session(tmp_path, "newer", config, "collect", "formula")
+    assert SessionJournal.find_resumable(str(tmp_path), "nodewatts.json") == "newer"
@@ -0,0 +1,44 @@
+import pytest
+
+from nodewatts.viz_server import server
+
+
+class Changes:
+    def try_next(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class Updates:
+    def watch(self, pipeline, **kwargs):
+        return Changes()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Only the first event of each stream is read, the collection is not queried
+    monkeypatch.setattr(server.clients, "get", lambda uri: {"nodewatts": {"live_updates": Updates()}})
+    return server.create_app(max_live_streams=1).test_client()
+
+
+def test_live_streams_are_capped(client):
+    first = client.get("/live/session")
+    assert first.status_code == 200
+    assert first.mimetype == "text/event-stream"
+    refused = client.get("/live/session")
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "30"
+    # Closing a stream frees its slot
+    first.close()
+    second = client.get("/live/session")
+    assert second.status_code == 200
+    second.close()
+
+
+def test_invalid_event_id_does_not_take_a_slot(client):
+    assert client.get("/live/session", headers={"Last-Event-ID": "nope"}).status_code == 400
+    res = client.get("/live/session")
+    assert res.status_code == 200
+    res.close()
@@ -0,0 +1,19 @@
+from nodewatts.mongo import ClientRegistry
+
+
+def test_configure_replaces_open_clients(monkeypatch):
+    registry = ClientRegistry()
+    # No server is needed to open a client, only the health check contacts it
+    monkeypatch.setattr(registry, "check", lambda uri, client: None)
+    first = registry.get("mongodb://localhost:1")
+    assert registry.get("mongodb://localhost:1") is first
+
+    registry.configure(max_pool_size=50)
+    assert registry.get("mongodb://localhost:1") is first
+
+    registry.configure(server_selection_timeout_ms=1000, max_pool_size=5)
+    second = registry.get("mongodb://localhost:1")
+    assert second is not first
+    assert second.options.pool_options.max_pool_size == 5
+    assert second.options.server_selection_timeout == 1
+    registry.close_all()
@@ -0,0 +1,38 @@
+from nodewatts.profiler_handler import ProfilerHandler
+
+
+def handler(tmp_path):
+    # Only the fields follow_workers uses, the server is not started
+    profiler = ProfilerHandler.__new__(ProfilerHandler)
+    profiler.tmp_path = str(tmp_path)
+    profiler._on_worker = None
+    profiler._workers_read = 0
+    return profiler
+
+
+def test_workers_forked_later_are_followed(tmp_path):
+    profiler = handler(tmp_path)
+    workers = tmp_path / "workers.txt"
+    workers.write_text("101\n102\n")
+    seen = []
+    profiler.follow_workers(seen.append, settle=0)
+    assert seen == [101, 102]
+    profiler._poll_workers()
+    assert seen == [101, 102]
+    # A pid still being written is picked up once its line is complete
+    with open(workers, "a") as f:
+        f.write("103\n10")
+    profiler._poll_workers()
+    assert seen == [101, 102, 103]
+    with open(workers, "a") as f:
+        f.write("4\n")
+    profiler._poll_workers()
+    assert seen == [101, 102, 103, 104]
+
+
+def test_no_workers(tmp_path):
+    profiler = handler(tmp_path)
+    seen = []
+    profiler.follow_workers(seen.append, settle=0)
+    profiler._poll_workers()
+    assert seen == []
@@ -0,0 +1,144 @@
+import os
+import threading
+import zlib
+
+import pytest
+
+from nodewatts.raw_store import RECORD_HEADER, SegmentCollection, SegmentStore
+
+
+def reports(timestamps, **fields):
+    return [dict({"timestamp": ts, "target": "app"}, **fields) for ts in timestamps]
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SegmentStore(str(tmp_path / "store"))
+    yield s
+    s.close()
+
+
+def test_round_trip(store):
+    store.insert_many("cpu", reports([30, 10, 20]))
+    store.insert_many("cpu", reports([40], target="other"))
+    assert [d["timestamp"] for d in store.find("cpu")] == [10, 20, 30, 40]
+    assert [d["timestamp"] for d in store.find("cpu", start=10, end=40)] == [20, 30]
+    assert [d["timestamp"] for d in store.find("cpu", {"target": "other"})] == [40]
+    assert store.find("cpu", projection=["timestamp"])[0] == {"timestamp": 10}
+    assert store.find_one("cpu", {"timestamp": 20})["target"] == "app"
+    assert store.count("cpu") == 4
+    assert store.count("cpu", {"target": "app"}) == 3
+    assert store.latest_timestamp("cpu") == 40
+
+
+def test_delete_and_delete_before(store):
+    store.insert_many("cpu", reports([10, 20, 30, 40]))
+    store.delete("cpu", {"timestamp": 30})
+    assert store.count("cpu") == 3
+    store.delete_before("cpu", 25)
+    assert [d["timestamp"] for d in store.find("cpu")] == [40]
+    assert store.count("cpu") == 1
+    store.delete_before("cpu", 50)
+    assert store.count("cpu") == 0
+    assert store.latest_timestamp("cpu") is None
+
+
+def test_count_ignores_deletions_below_watermark(store):
+    store.insert_many("cpu", reports([10, 20, 30, 40]))
+    store.delete("cpu", {"timestamp": 10})
+    store.delete("cpu", {"timestamp": 40})
+    store.delete_before("cpu", 25)
+    assert store.count("cpu") == 1
+
+
+def test_reopen_uses_saved_index(tmp_path):
+    path = str(tmp_path / "store")
+    first = SegmentStore(path)
+    first.insert_many("cpu", reports([10, 20, 30]))
+    first.delete("cpu", {"timestamp": 20})
+    first.close()
+    second = SegmentStore(path)
+    assert [d["timestamp"] for d in second.find("cpu")] == [10, 30]
+    second.insert_many("cpu", reports([40]))
+    assert second.count("cpu") == 3
+    second.close()
+
+
+def segment_files(path):
+    return sorted(n for n in os.listdir(path) if n.endswith(".seg"))
+
+
+def test_torn_trailing_record_is_skipped(tmp_path):
+    coll = SegmentCollection(str(tmp_path / "cpu"), "cpu")
+    coll.append(reports([10, 20]))
+    coll.close()
+    seg = os.path.join(coll.path, segment_files(coll.path)[0])
+    payload = b'{"timestamp": 30, "target": "app"}'
+    with open(seg, "ab") as f:
+        f.write(RECORD_HEADER.pack(len(payload), 30, zlib.crc32(payload)) + payload[:10])
+    reader = SegmentCollection(coll.path, "cpu")
+    assert [d["timestamp"] for d in reader.find()] == [10, 20]
+    # The rest of the record arrives and becomes readable
+    with open(seg, "ab") as f:
+        f.write(payload[10:])
+    assert [d["timestamp"] for d in reader.find()] == [10, 20, 30]
+    reader.close()
+
+
+def test_corrupted_trailing_record_is_skipped(tmp_path):
+    coll = SegmentCollection(str(tmp_path / "cpu"), "cpu")
+    coll.append(reports([10, 20]))
+    coll.close()
+    seg = os.path.join(coll.path, segment_files(coll.path)[0])
+    payload = b'{"timestamp": 30, "target": "app"}'
+    with open(seg, "ab") as f:
+        f.write(RECORD_HEADER.pack(len(payload), 30, zlib.crc32(payload) ^ 1) + payload)
+    reader = SegmentCollection(coll.path, "cpu")
+    assert [d["timestamp"] for d in reader.find()] == [10, 20]
+    assert reader.count() == 2
+    reader.close()
+
+
+def test_rotation_and_segment_removal(tmp_path, monkeypatch):
+    monkeypatch.setattr(SegmentCollection, "segment_bytes", 200)
+    coll = SegmentCollection(str(tmp_path / "cpu"), "cpu")
+    for ts in range(0, 100, 10):
+        coll.append(reports([ts]))
+    segments = segment_files(coll.path)
+    assert len(segments) > 2
+    assert all(os.path.getsize(os.path.join(coll.path, s)) <= 200 for s in segments)
+    coll.delete_before(75)
+    assert len(segment_files(coll.path)) < len(segments)
+    assert [d["timestamp"] for d in coll.find()] == [80, 90]
+    coll.close()
+    # A new writer in the same process does not reuse a removed segment name
+    reopened = SegmentCollection(coll.path, "cpu")
+    reopened.append(reports([100]))
+    assert [d["timestamp"] for d in reopened.find()] == [80, 90, 100]
+    reopened.close()
+
+
+def test_threads_write_their_own_segments(tmp_path):
+    coll = SegmentCollection(str(tmp_path / "cpu"), "cpu")
+    coll.append(reports([10]))
+    thread = threading.Thread(target=coll.append, args=(reports([20]),))
+    thread.start()
+    thread.join()
+    assert len(segment_files(coll.path)) == 2
+    assert coll.count() == 2
+    coll.close()
+
+
+def test_concurrent_saves_merge_deletions(tmp_path):
+    path = str(tmp_path / "cpu")
+    writer = SegmentCollection(path, "cpu")
+    writer.append(reports([10, 20, 30]))
+    writer.save()
+    first = SegmentCollection(path, "cpu")
+    second = SegmentCollection(path, "cpu")
+    first.delete({"timestamp": 10})
+    second.delete({"timestamp": 30})
+    assert not [n for n in os.listdir(path) if n.endswith(".tmp")]
+    for coll in (writer, first, second):
+        coll.close()
+    assert [d["timestamp"] for d in SegmentCollection(path, "cpu").find()] == [20]
@@ -0,0 +1,108 @@
+from types import SimpleNamespace
+
+import pytest
+
+from nodewatts.nwengine.report import Report
+
+
+def node(name, url, joules, children=(), hit_count=1):
+    return SimpleNamespace(call_frame={"functionName": name, "url": url, "lineNumber": 0, "columnNumber": 0},
+                           joules=joules, hit_count=hit_count, children=list(children))
+
+
+def report(node_map):
+    # Only the node map is needed by the call tree, flame and rollup builders
+    r = Report.__new__(Report)
+    r.node_map = node_map
+    return r
+
+
+@pytest.fixture
+def tree():
+    # parse calls itself, log used no energy
+    return report({
+        1: node("(root)", "", 0, [2, 3]),
+        2: node("handler", "file:///app.js", 1.0, [4, 6]),
+        3: node("(garbage collector)", "", 4.0),
+        4: node("parse", "file:///app.js", 0, [5], hit_count=0),
+        5: node("parse", "file:///app.js", 2.0),
+        6: node("log", "file:///app.js", 0, hit_count=0),
+    })
+
+
+def test_call_tree_index(tree):
+    index = tree._index_call_tree(1)
+    assert index == {"root": 1, "by_joules": [3, 5, 2]}
+    assert [tree.node_map[i].inclusive_joules for i in range(1, 7)] == [7.0, 3.0, 4.0, 2.0, 2.0, 0]
+    # Children heaviest first
+    assert tree.node_map[1].children == [3, 2]
+    assert tree.node_map[2].children == [4, 6]
+
+
+def test_icicle_layout(tree):
+    tree._index_call_tree(1)
+    icicle = tree._build_flame_data(1)["icicle"]
+    # Depth first, heaviest child first, zero width branches left out
+    assert icicle["id"] == [1, 3, 2, 4, 5]
+    assert icicle["depth"] == [0, 1, 1, 2, 3]
+    assert icicle["x"] == [0, 0, 4.0, 4.0, 4.0]
+    assert icicle["width"] == [7.0, 4.0, 3.0, 2.0, 2.0]
+    assert icicle["self"] == [0, 4.0, 1.0, 0, 2.0]
+
+
+def test_stacks_and_function_totals(tree):
+    tree._index_call_tree(1)
+    flame = tree._build_flame_data(1)
+    frames = {name.split("@")[0]: i for i, name in enumerate(flame["frames"])}
+    assert "log" not in frames
+    root, gc, handler, parse = (frames[n] for n in ("(root)", "(garbage collector)", "handler", "parse"))
+    stacks = {tuple(s): (own, incl) for s, own, incl in zip(
+        flame["stacks"]["frames"], flame["stacks"]["self"], flame["stacks"]["inclusive"])}
+    assert stacks == {(root, gc): (4.0, 4.0), (root, handler): (1.0, 3.0),
+                      (root, handler, parse, parse): (2.0, 2.0)}
+    functions = flame["functions"]
+    assert functions["self"][parse] == 2.0
+    # The recursive call is already counted in its caller's inclusive energy
+    assert functions["inclusive"][parse] == 2.0
+    assert functions["inclusive"][handler] == 3.0
+    assert functions["inclusive"][root] == 7.0
+
+
+def rollup_report(node_map, window_joules=None, width=100000):
+    r = report(node_map)
+    r._window_width = width
+    r._window_joules = window_joules or {}
+    return r
+
+
+def test_rollup_classification():
+    r = rollup_report({
+        1: node("(root)", "", 0, hit_count=0),
+        2: node("(garbage collector)", "", 1.0),
+        3: node("listOnTimeout", "node:internal/timers", 0.5),
+        4: node("emit", "node:events", 0.25),
+        5: node("handle", "file:///srv/api/node_modules/express/lib/router/layer.js", 2.0),
+        6: node("parse", "file:///srv/api/node_modules/body-parser/node_modules/qs/lib/parse.js", 1.0),
+        7: node("handler", "file:///srv/api/app.js", 3.0),
+        8: node("idle", "file:///srv/api/app.js", 0, hit_count=2),
+    })
+    rollups = r._build_rollups(0)
+    assert rollups["system"] == {"(garbage collector)": {"joules": 1.0, "hit_count": 1, "nodes": 1}}
+    assert set(rollups["core_modules"]) == {"node:internal", "node:events"}
+    # A package's own dependencies count towards the package that was installed
+    assert rollups["packages"]["body-parser"]["joules"] == 1.0
+    assert set(rollups["packages"]) == {"express", "body-parser"}
+    assert rollups["files"] == {"file:///srv/api/app.js": {"joules": 3.0, "hit_count": 3, "nodes": 2}}
+
+
+def test_time_windows_rollup():
+    r = rollup_report({1: node("(root)", "", 0)}, {12: 1.0, 14: 2.0})
+    windows = r._build_rollups(1150000)["time_windows"]
+    assert windows == {"start": 1200000, "origin": 1150000, "width": 100000, "joules": [1.0, 0, 2.0]}
+
+
+def test_empty_profile_rollups():
+    r = rollup_report({1: node("(root)", "", 0, hit_count=0)})
+    rollups = r._build_rollups(1150000)
+    assert all(rollups[g] == {} for g in ("packages", "core_modules", "files", "system"))
+    assert rollups["time_windows"] == {"start": 1100000, "origin": 1150000, "width": 100000, "joules": [0]}
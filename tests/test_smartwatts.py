@@ -0,0 +1,31 @@
+import pytest
+from powerapi.database.base_db import DBError
+from powerapi.report import PowerReport
+
+from nodewatts.config import InvalidConfig, NWConfig
+from nodewatts.smartwatts import SegmentDB
+
+
+def smartwatts_config(input_type):
+    db = {"uri": "mongodb://localhost:27017", "db": "nodewatts", "collection": "sensor_raw"}
+    return {
+        "verbose": False, "stream": False,
+        "input": {"puller": dict(db, model="HWPCReport", type=input_type)},
+        "output": {"pusher_power": dict(db, model="PowerReport", type="mongodb", collection="cpu")},
+        "cpu-frequency-base": 19, "cpu-frequency-min": 4, "cpu-frequency-max": 42,
+        "cpu-error-threshold": 2.0, "disable-dram-formula": True, "sensor-report-sampling-interval": 1000
+    }
+
+
+def test_segment_store_is_not_an_input():
+    NWConfig.validate_smartwatts_config(smartwatts_config("mongodb"))
+    with pytest.raises(InvalidConfig, match="only available as an output"):
+        NWConfig.validate_smartwatts_config(smartwatts_config("segment"))
+
+
+def test_segment_store_cannot_be_read(tmp_path):
+    db = SegmentDB(PowerReport, str(tmp_path), "cpu")
+    with pytest.raises(DBError) as e:
+        db.iter(False)
+    # powerapi errors keep their message in msg
+    assert "only be a formula output" in e.value.msg
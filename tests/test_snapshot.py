@@ -0,0 +1,38 @@
+import fcntl
+import os
+import time
+
+from nodewatts.snapshot import ProjectSnapshot
+
+
+def old_snapshot(base_dir, name, days):
+    path = base_dir / name
+    path.mkdir()
+    manifest = path / ProjectSnapshot.manifest_name
+    manifest.write_text("{}")
+    used = time.time() - days * 86400
+    os.utime(manifest, (used, used))
+    return path
+
+
+def test_evict_removes_unused_snapshots(tmp_path):
+    stale = old_snapshot(tmp_path, "stale", 10)
+    recent = old_snapshot(tmp_path, "recent", 1)
+    in_use = old_snapshot(tmp_path, "in_use", 10)
+    with open(in_use / "lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        ProjectSnapshot.evict(str(tmp_path), 7)
+    assert not stale.exists()
+    assert recent.exists()
+    assert in_use.exists()
+
+
+def test_upper_takes_the_project_owner_and_mode(tmp_path):
+    project = tmp_path / "project"
+    project.mkdir()
+    os.chmod(project, 0o770)
+    snapshot = ProjectSnapshot(str(project), str(tmp_path / "snapshots"), "index.js")
+    snapshot._refresh_upper(set())
+    st = os.stat(snapshot.upper)
+    assert (st.st_uid, st.st_gid) == (os.stat(project).st_uid, os.stat(project).st_gid)
+    assert st.st_mode & 0o7777 == 0o770
@@ -0,0 +1,67 @@
+import math
+
+from nodewatts.nwengine.timeline import TimelinePyramid, lttb
+
+
+def series(n):
+    ts = list(range(0, n * 1000, 1000))
+    values = [10 + math.sin(i / 10) for i in range(n)]
+    return ts, values
+
+
+def test_lttb_short_series_is_unchanged():
+    ts, values = series(10)
+    assert lttb(ts, values, 10) == (ts, values)
+    assert lttb(ts, values, 50) == (ts, values)
+    # Fewer than three points cannot keep both ends and a bucket
+    assert lttb(ts, values, 2) == (ts, values)
+
+
+def test_lttb_keeps_ends_and_threshold():
+    ts, values = series(1000)
+    out_ts, out_values = lttb(ts, values, 100)
+    assert len(out_ts) == len(out_values) == 100
+    assert (out_ts[0], out_ts[-1]) == (ts[0], ts[-1])
+    assert out_ts == sorted(out_ts)
+    # Every point kept is a point of the series
+    points = dict(zip(ts, values))
+    assert all(points[t] == v for t, v in zip(out_ts, out_values))
+
+
+def test_lttb_keeps_spikes():
+    ts, values = series(1000)
+    values[537] = 500
+    out_ts, out_values = lttb(ts, values, 50)
+    assert 500 in out_values
+    assert ts[537] in out_ts
+
+
+def test_pyramid_levels():
+    ts, values = series(20000)
+    pyramid = TimelinePyramid([t + 5000 for t in ts], values, origin=5000, factor=4, min_points=1000)
+    sizes = [len(level_ts) for level_ts, _ in pyramid.levels]
+    assert sizes == [20000, 5000, 1250, 1000]
+    assert pyramid.levels[0][0][0] == 0
+    summary = pyramid.summary()
+    assert summary["origin"] == 5000
+    assert [level["points"] for level in summary["levels"]] == sizes
+    assert all(level["start"] == 0 and level["end"] == ts[-1] for level in summary["levels"])
+
+
+def test_pyramid_short_timeline_has_one_level():
+    ts, values = series(500)
+    pyramid = TimelinePyramid(ts, values, origin=0)
+    assert len(pyramid.levels) == 1
+    assert TimelinePyramid([], [], origin=0).summary()["levels"] == [
+        {"level": 0, "points": 0, "start": 0, "end": 0}]
+
+
+def test_pyramid_chunks():
+    ts, values = series(5000)
+    pyramid = TimelinePyramid(ts, values, origin=0, min_points=1000, chunk_size=2000)
+    chunks = pyramid.chunks()
+    level0 = [c for c in chunks if c["level"] == 0]
+    assert [len(c["t"]) for c in level0] == [2000, 2000, 1000]
+    assert [t for c in level0 for t in c["t"]] == ts
+    assert all(c["start"] == c["t"][0] and c["end"] == c["t"][-1] for c in chunks)
+    assert {c["level"] for c in chunks} == set(range(len(pyramid.levels)))
@@ -0,0 +1,103 @@
+import gzip
+import json
+
+import pytest
+from bson import ObjectId
+
+from nodewatts.viz_server import cache, server
+from nodewatts.viz_server.cache import EncodedResponse, ResponseCache, negotiate_encoding
+
+
+def test_lru_eviction_by_size():
+    responses = ResponseCache(max_bytes=25)
+    for key in "abc":
+        responses.put(key, EncodedResponse(b"x" * 10))
+    assert responses.get("a") is None
+    assert responses.get("b") is not None
+    # b was used last, c is evicted next
+    responses.put("d", EncodedResponse(b"x" * 10))
+    assert responses.get("c") is None
+    assert responses.get("b") is not None
+
+
+def test_newest_entry_is_kept_over_budget():
+    responses = ResponseCache(max_bytes=5)
+    responses.put("big", EncodedResponse(b"x" * 100))
+    assert responses.get("big") is not None
+
+
+def test_variants_are_cached_and_counted():
+    responses = ResponseCache(max_bytes=10 ** 6)
+    entry = responses.put("k", EncodedResponse(b"abc" * 1000))
+    data = responses.encode("k", entry, "gzip")
+    assert gzip.decompress(data) == entry.body
+    assert responses.encode("k", entry, "gzip") is data
+    assert responses._size == entry.size == len(entry.body) + len(data)
+
+
+def test_etags_differ_by_encoding():
+    entry = EncodedResponse(b"{}")
+    assert entry.etag_for("identity") == entry.etag
+    assert len({entry.etag_for(e) for e in ("identity", "gzip", "br")}) == 3
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("", "identity"),
+    ("gzip, deflate", "gzip"),
+    ("br;q=0, gzip;q=0.5", "gzip"),
+    ("gzip;q=0", "identity"),
+    ("*", "gzip"),
+    ("deflate", "identity"),
+])
+def test_negotiate_encoding_without_brotli(monkeypatch, header, expected):
+    monkeypatch.setattr(cache, "brotli", None)
+    assert negotiate_encoding(header) == expected
+
+
+def test_negotiate_encoding_prefers_brotli(monkeypatch):
+    monkeypatch.setattr(cache, "brotli", object())
+    assert negotiate_encoding("gzip, br") == "br"
+    assert negotiate_encoding("gzip, br;q=0") == "gzip"
+
+
+class Reports:
+    def __init__(self, docs):
+        self.docs = {d["_id"]: d for d in docs}
+
+    def find_one(self, report_id, projection=None):
+        return self.docs.get(report_id)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    report = {"_id": ObjectId(), "name": "report", "stats": {"joules": 1.0}, "node_map": {"1": "x" * 4000}}
+    monkeypatch.setattr(server.clients, "get", lambda uri: {"nodewatts": {"reports": Reports([report])}})
+    app = server.create_app()
+    yield app.test_client(), {"profile": json.dumps({"$oid": str(report["_id"])})}
+
+
+def test_profile_revalidation_per_encoding(client):
+    client, args = client
+    plain = client.get("/profiles", query_string=args)
+    assert json.loads(json.loads(plain.data)["profile"])["name"] == "report"
+    zipped = client.get("/profiles", query_string=args, headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert zipped.get_etag() != plain.get_etag()
+    # The identity etag does not validate the gzip variant
+    res = client.get("/profiles", query_string=args,
+                     headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"]})
+    assert res.status_code == 200
+    res = client.get("/profiles", query_string=args,
+                     headers={"Accept-Encoding": "gzip", "If-None-Match": zipped.headers["ETag"]})
+    assert res.status_code == 304
+
+
+def test_page_limit_is_at_least_one(client, monkeypatch):
+    client, args = client
+    report_id = json.loads(args["profile"])["$oid"]
+    pages = []
+    monkeypatch.setattr(server.call_tree, "top_nodes",
+                        lambda coll, id, offset, limit: pages.append((offset, limit)) or {})
+    for query in ({"limit": 0}, {"limit": -5, "offset": -1}, {"limit": 10000}):
+        assert client.get("/profiles/" + report_id + "/top", query_string=query).status_code == 200
+    assert pages == [(0, 1), (0, 1), (0, server.MAX_PAGE)]
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import pytest
+
+from nodewatts.nwengine.workload_profile import WorkloadProfile
+
+
+def power(timestamps, watts=10.0):
+    # Only the fields attribute reads of a PowerProfile
+    timeline = [SimpleNamespace(timestamp=ts, power_val_watts=watts) for ts in timestamps]
+    return SimpleNamespace(cgroup_timeline=timeline, cgroup_delta_stats={"med": 1000})
+
+
+def record(endpoint, start, end, status=200):
+    return {"endpoint": endpoint, "start": start, "end": end, "status": status}
+
+
+def test_energy_is_split_by_overlap():
+    workload = WorkloadProfile([record("GET /b", 500, 2000), record("GET /a", 0, 1500)])
+    workload.attribute(power([0, 1000, 2000, 3000]))
+    a, b = workload.requests
+    assert a.joules == pytest.approx(0.01 * 2 / 3 + 0.01 / 3)
+    assert b.joules == pytest.approx(0.01 / 3 + 0.01 * 2 / 3)
+    assert workload.attributed_joules == pytest.approx(0.02)
+    assert workload.idle_joules == pytest.approx(0.01)
+
+
+def test_gaps_are_not_charged():
+    workload = WorkloadProfile([record("GET /a", 0, 10000)])
+    workload.attribute(power([0, 1000, 9000]))
+    assert workload.requests[0].joules == pytest.approx(0.01)
+    assert workload.attributed_joules + workload.idle_joules == pytest.approx(0.01)
+
+
+def test_summary_by_endpoint():
+    workload = WorkloadProfile([record("GET /a", 0, 1000), record("GET /a", 1000, 2000, status=500),
+                                record("GET /b", 2000, 2500)])
+    workload.attribute(power([0, 1000, 2000, 3000]))
+    summary = {e["endpoint"]: e for e in workload.summarize()}
+    assert summary["GET /a"]["requests"] == 2
+    assert summary["GET /a"]["errors"] == 1
+    assert summary["GET /a"]["joules"] == pytest.approx(0.02)
+    assert summary["GET /a"]["joules_per_request"] == pytest.approx(0.01)
+    assert summary["GET /b"]["joules"] == pytest.approx(0.01)
+    assert [e["endpoint"] for e in workload.summarize()] == ["GET /a", "GET /b"]